@@ -1,10 +1,17 @@
-# Input of this script
-# word_file_path document_file_path topic_num minibatch_size tau0 kappa num_mapper hadoop_hdfs_root
-# Example
-# sh DoLDA.sh ../Twitter_Conversation/Voca_TC.txt ../Twitter_Conversation/BOW_TC.txt 100 16384 1024 0.7 3 /user/hadoop_usr
-
-hadoop dfs -rmr $8/output*
-hadoop dfs -rmr $8/lambda*
-rm -rf ./output*
-time python26 DoLDA_Driver.py $1 $2 $3 $4 $5 $6 $7 $8
-hadoop dfs -copyToLocal $8/output* ./
\ No newline at end of file
+# Input of this script
+# [--resume] word_file_path document_file_path topic_num minibatch_size tau0 kappa num_mapper num_reducer hadoop_hdfs_root hadoop_library_path python_bin_path
+# Example
+# sh DoLDA.sh ../Twitter_Conversation/Voca_TC.txt ../Twitter_Conversation/BOW_TC.txt 100 16384 1024 0.7 3 3 /user/hadoop_usr /usr/lib/hadoop-0.20 /usr/bin/python26
+# After a failure, continue from the last finished job
+# sh DoLDA.sh --resume ../Twitter_Conversation/Voca_TC.txt ../Twitter_Conversation/BOW_TC.txt 100 16384 1024 0.7 3 3 /user/hadoop_usr /usr/lib/hadoop-0.20 /usr/bin/python26
+
+if [ "$1" = "--resume" ]; then
+    shift
+    time python26 DoLDA_Driver.py --resume $1 $2 $3 $4 $5 $6 $7 $8 $9 ${10} ${11} || exit 1
+else
+    hadoop dfs -rmr $9/output*
+    hadoop dfs -rmr $9/lambda*
+    rm -rf ./output*
+    time python26 DoLDA_Driver.py $1 $2 $3 $4 $5 $6 $7 $8 $9 ${10} ${11} || exit 1
+fi
+hadoop dfs -copyToLocal $9/output* ./
@@ -0,0 +1,315 @@
+#!/usr/bin/python26
+
+'''
+Distributed Online Learning for Topic Models
+JinYeong Bak, Dongwoo Kim, Alice Oh
+http://uilab.kaist.ac.kr/research/DoLDA
+
+Synchronous training with a ring allreduce of sufficient statistics, instead of the shuffle to reducers.
+Ranks start once, keep their shard of the corpus (documents by line index modulo number of ranks)
+and a whole copy of the parameters in an OnlineLDA.
+For each minibatch every rank runs the E step of its documents,
+then sstats, E[log theta] and bound terms are summed around a ring of sockets,
+so every rank gets the same sums and does the same M step, without a central reducer.
+sstats are summed only for words of the minibatch, found by an allreduce of word counts first.
+Ranks talk over sockets of multiprocessing.connection, like DoLDA_Workers.py,
+ranks are started on this machine, or by hand on other machines with
+python DoLDA_Allreduce.py rank host port [listen_host]
+'''
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+import tempfile
+import shutil
+import threading
+import traceback
+import numpy
+from multiprocessing.connection import Listener, Client
+
+import DoLDA_Params
+import DoLDA_Corpus
+import DoLDA_Online
+import DoLDA_Workers
+
+
+class Ring(object):
+    '''
+    Connections of one rank to the next and the previous ranks of the ring
+    '''
+    def __init__(self, rank, size, listener, next_address):
+        self.rank = rank
+        self.size = size
+        self._next = None
+        self._previous = None
+        if 1 == size:
+            return
+
+        # the next rank accepts only after it connects itself, so accept in a thread
+        accepted = []
+        acceptor = threading.Thread(target=lambda: accepted.append(listener.accept()))
+        acceptor.start()
+        self._next = Client(next_address, authkey=DoLDA_Workers.authkey())
+        acceptor.join()
+        self._previous = accepted[0]
+
+    def _exchange(self, send_chunk, receive_chunk, add):
+        '''
+        Send send_chunk to the next rank while receiving receive_chunk from the previous rank
+        add - add the received values to receive_chunk, instead of replacing them
+        '''
+        sender = threading.Thread(target=self._next.send_bytes, args=(send_chunk.tostring(),))
+        sender.start()
+        received = numpy.fromstring(self._previous.recv_bytes(), dtype=receive_chunk.dtype)
+        sender.join()
+        if add:
+            receive_chunk += received
+        else:
+            receive_chunk[:] = received
+
+    def allreduce(self, array):
+        '''
+        Return sum of array over all ranks, every rank gets the same values
+        The array is split into one chunk for each rank,
+        chunks are summed around the ring (reduce-scatter), then passed around once more (allgather).
+        Each rank sends and receives about 2 * array size, whatever the number of ranks.
+        '''
+        result = numpy.array(array, copy=True)
+        if 1 == self.size:
+            return result
+        flat = result.reshape(-1)
+        bounds = [len(flat) * idx / self.size for idx in range(0, self.size + 1)]
+        def chunk(idx):
+            idx %= self.size
+            return flat[bounds[idx]:bounds[idx + 1]]
+
+        for step in range(0, self.size - 1):
+            self._exchange(chunk(self.rank - step), chunk(self.rank - step - 1), True)
+        # rank holds the sum of chunk rank + 1
+        for step in range(0, self.size - 1):
+            self._exchange(chunk(self.rank - step + 1), chunk(self.rank - step), False)
+        return result
+
+    def close(self):
+        for connection in (self._next, self._previous):
+            if connection is not None:
+                connection.close()
+
+
+def train_shard(ring, document_file_path, word_num, topic_num, document_num, tau0, kappa, dtype,
+                job_params, minibatches):
+    '''
+    Train with the documents of this rank in minibatches
+    Return ([(perplexity, seconds of allreduce), ...] of each minibatch, parameters)
+    '''
+    worker = DoLDA_Workers.Worker(document_file_path, word_num, topic_num, dtype, ring.rank, ring.size)
+    olda = DoLDA_Online.OnlineLDA(word_num, topic_num, document_num, tau0, kappa, dtype=dtype, **job_params)
+
+    results = []
+    for doc_indices in minibatches:
+        doc_indices = list(doc_indices)
+        ordinals = sorted([ordinal for ordinal in doc_indices if ring.rank == ordinal % ring.size])
+        word_ids = worker.assign(ordinals)
+        parameters = olda.job_parameters()
+        (word_ids, sstats, Elogtheta, score, sum_cts, bound_doc_num) = worker.e_step(
+                olda.job_params(len(doc_indices)), parameters['new_alpha'], parameters['new_lambda_sum'],
+                word_ids, parameters['new_psi_lambda'].take(word_ids))
+
+        start_time = time.time()
+        # words of the whole minibatch
+        word_counts = numpy.zeros(word_num)
+        word_counts[word_ids] = 1.
+        columns = numpy.flatnonzero(ring.allreduce(word_counts))
+
+        # sstats of the words, E[log theta] in order of doc_indices and bound terms in one array
+        positions = dict([(ordinal, idx) for (idx, ordinal) in enumerate(doc_indices)])
+        sums = numpy.zeros(topic_num * len(columns) + len(doc_indices) * topic_num + 3)
+        column_sstats = numpy.zeros((topic_num, len(columns)))
+        column_sstats[:, numpy.searchsorted(columns, word_ids)] = sstats
+        sums[:topic_num * len(columns)] = column_sstats.ravel()
+        minibatch_Elogtheta = numpy.zeros((len(doc_indices), topic_num))
+        minibatch_Elogtheta[[positions[ordinal] for ordinal in ordinals]] = Elogtheta
+        sums[topic_num * len(columns):-3] = minibatch_Elogtheta.ravel()
+        sums[-3:] = (score, sum_cts, bound_doc_num)
+        sums = ring.allreduce(sums)
+        seconds = time.time() - start_time
+
+        column_sstats = sums[:topic_num * len(columns)].reshape(topic_num, len(columns))
+        minibatch_Elogtheta = sums[topic_num * len(columns):-3].reshape(len(doc_indices), topic_num)
+        perplexity = olda.update(len(doc_indices), column_sstats, minibatch_Elogtheta,
+                sums[-3], int(sums[-2]), int(sums[-1]), columns)
+        results.append((perplexity, seconds))
+
+    # parameters are the same in every rank
+    parameters = None
+    if 0 == ring.rank:
+        parameters = olda.parameters()
+    return (results, parameters)
+
+
+def run_rank(address, listen_host):
+    '''
+    Join the ring of the driver at address and serve its requests until it says stop
+    Requests are (name, arguments...), replies are ('ok', result) or ('error', traceback)
+    listen_host - host the previous rank connects to
+    '''
+    connection = Client(address, authkey=DoLDA_Workers.authkey())
+    listener = Listener((listen_host, 0), authkey=DoLDA_Workers.authkey())
+    connection.send(listener.address)
+    (rank, size, next_address) = connection.recv()
+    ring = Ring(rank, size, listener, next_address)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if 'stop' == request[0]:
+            break
+        try:
+            if 'train' == request[0]:
+                result = train_shard(ring, *request[1:])
+            else:
+                raise ValueError('Unknown request %s' % request[0])
+            connection.send(('ok', result))
+        except Exception:
+            connection.send(('error', traceback.format_exc()))
+    ring.close()
+    listener.close()
+    connection.close()
+
+
+class RingPool(object):
+    '''
+    Driver side of ranks of the ring
+    '''
+    def __init__(self, worker_num, address=('localhost', 0), external_num=0):
+        '''
+        worker_num - number of ranks started on this machine
+        address - (host, port) the driver listens on, port 0 for any free port
+        external_num - number of ranks started by hand, they connect to address
+        '''
+        self._listener = Listener(address, authkey=DoLDA_Workers.authkey())
+        (host, port) = self._listener.address[:2]
+        sys.stderr.write('Ranks connect to %s %d\n' % (host, port))
+
+        self._processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'rank', host, str(port)])
+                for worker_idx in range(0, worker_num)]
+        self._connections = [self._listener.accept() for worker_idx in range(0, worker_num + external_num)]
+
+        # rank r connects to rank r + 1
+        addresses = [connection.recv() for connection in self._connections]
+        size = len(self._connections)
+        for (rank, connection) in enumerate(self._connections):
+            connection.send((rank, size, addresses[(rank + 1) % size]))
+
+    def train(self, document_file_path, word_num, topic_num, document_num, tau0, kappa, dtype,
+              job_params, minibatches):
+        '''
+        Train with all ranks, minibatches are doc_indices of each minibatch
+        Return ([(perplexity, seconds of allreduce), ...] of each minibatch, parameters)
+        '''
+        minibatches = [list(doc_indices) for doc_indices in minibatches]
+        for connection in self._connections:
+            connection.send(('train', os.path.abspath(document_file_path), word_num, topic_num, document_num,
+                    tau0, kappa, dtype, job_params, minibatches))
+        results = []
+        for (rank, connection) in enumerate(self._connections):
+            (status, result) = connection.recv()
+            if 'error' == status:
+                raise RuntimeError('Rank %d failed\n%s' % (rank, result))
+            results.append(result)
+        return results[0]
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(('stop',))
+            connection.close()
+        for process in self._processes:
+            process.wait()
+        self._listener.close()
+
+
+def run_driver_local(args, options, worker_num):
+    '''
+    Run the same training with DoLDA_Driver.py --local, worker_num mappers and reducers
+    Return seconds
+    '''
+    root = tempfile.mkdtemp(prefix='DoLDA_benchmark_')
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DoLDA_Driver.py'),
+            '--local', '--dtype', options.dtype, '--order', options.order, '--seed', str(options.seed),
+            '--checkpoint', os.path.join(root, 'DoLDA_checkpoint.json')]
+    for param in options.param:
+        command.extend(['--param', param])
+    command.extend(args[:6] + [str(worker_num), str(worker_num), os.path.join(root, 'hdfs'), 'none', 'none'])
+    start_time = time.time()
+    try:
+        subprocess.check_call(command, stdout=file(os.devnull, 'w'))
+        return time.time() - start_time
+    finally:
+        shutil.rmtree(root)
+
+
+# main function start
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and 'rank' == sys.argv[1]:
+        if len(sys.argv) < 4:
+            sys.exit('Usage: %s rank host port [listen_host]' % sys.argv[0])
+        listen_host = sys.argv[2]
+        if len(sys.argv) > 4:
+            listen_host = sys.argv[4]
+        run_rank((sys.argv[2], int(sys.argv[3])), listen_host)
+        sys.exit(0)
+
+    option_parser = optparse.OptionParser(usage='%prog [options] word_file_path document_file_path topic_num minibatch_size tau0 kappa worker_num [output_parameter_file]')
+    option_parser.add_option('--dtype', default='float64',
+            help='floating point type of lambda, gamma and sstats: float64 or float32 [default: %default]')
+    option_parser.add_option('--order', default='sequential', choices=DoLDA_Corpus.MinibatchSampler.ORDERS,
+            help='order of documents: sequential, shuffle or stratified by document length [default: %default]')
+    option_parser.add_option('--seed', type='int', default=100000001,
+            help='random seed of document order [default: %default]')
+    option_parser.add_option('--param', action='append', default=[], metavar='NAME=VALUE',
+            help='additional job parameter of DoLDA_MR.py, can be repeated')
+    option_parser.add_option('--address', default='localhost:0', metavar='HOST:PORT',
+            help='address ranks connect to [default: %default]')
+    option_parser.add_option('--external', type='int', default=0,
+            help='number of ranks started by hand on other machines [default: %default]')
+    option_parser.add_option('--benchmark', action='store_true', default=False,
+            help='also run DoLDA_Driver.py --local with worker_num mappers and reducers, and compare times')
+    (options, args) = option_parser.parse_args()
+    if len(args) < 7:
+        option_parser.error('7 arguments are needed')
+
+    word_file_path = args[0]
+    document_file_path = args[1]
+    topic_num = int(args[2])
+    minibatch_size = int(args[3])
+    tau0 = float(args[4])
+    kappa = float(args[5])
+    worker_num = int(args[6])
+
+    manifest = DoLDA_Corpus.load_manifest(document_file_path, word_file_path)
+    sampler = DoLDA_Corpus.MinibatchSampler(manifest, minibatch_size, options.order, options.seed)
+    job_params = dict([param.split('=', 1) for param in options.param])
+
+    start_time = time.time()
+    (host, port) = options.address.rsplit(':', 1)
+    pool = RingPool(worker_num, (host, int(port)), options.external)
+    try:
+        (results, parameters) = pool.train(document_file_path, manifest.word_num, topic_num, manifest.document_num,
+                tau0, kappa, options.dtype, job_params, sampler.minibatches(0))
+    finally:
+        pool.close()
+    seconds = time.time() - start_time
+    for (updatect, (perplexity, allreduce_seconds)) in enumerate(results):
+        print '%d\t%s\t%f' % (updatect, perplexity, allreduce_seconds)
+
+    if len(args) > 7:
+        DoLDA_Params.write_parameters(args[7], parameters)
+
+    if options.benchmark:
+        driver_seconds = run_driver_local(args, options, worker_num)
+        print 'allreduce\t%d ranks\t%f seconds\t%f seconds of allreduce' % (worker_num + options.external,
+                seconds, sum([allreduce_seconds for (perplexity, allreduce_seconds) in results]))
+        print 'combiner_reducer\t%d mappers and reducers\t%f seconds' % (worker_num, driver_seconds)
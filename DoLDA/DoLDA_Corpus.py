@@ -0,0 +1,533 @@
+#!/usr/bin/python26
+
+'''
+Distributed Online Learning for Topic Models
+JinYeong Bak, Dongwoo Kim, Alice Oh
+http://uilab.kaist.ac.kr/research/DoLDA
+
+Manifest of the document file.
+It records number of documents, byte offset and token count of each document,
+total token count, vocabulary size, malformed lines and md5 checksum of the document file.
+The manifest is built once and cached next to the document file as <document file>.manifest.npz.
+It is rebuilt only when size or modification time of the document file changes,
+when only the word file changes, lines of unknown word ids are marked malformed from the cached largest word ids.
+
+MinibatchSampler orders documents of each epoch only with the manifest,
+so documents are never loaded into memory.
+
+The document file can be converted once into a binary corpus, <document file>.csr.seq.
+It is a SequenceFile of doc_id and int32 ordinal, word ids and word counts of each document,
+so mappers get ids and cts without parsing text.
+<document file>.csr.seq.index.npy has the position of each record, for reading ranges of documents.
+
+Lines of the documents are cut into blocks of about the same size, which can be copied into files of their own,
+so a job on Hadoop reads only the blocks of its minibatch, not the whole documents.
+
+GammaStore keeps gamma of the last visit of each document over epochs, a memory-mapped .npy file.
+'''
+
+import os
+import sys
+import hashlib
+import tempfile
+import numpy
+from hadoop.io import SequenceFile
+from hadoop.typedbytes import TypedBytesWritable
+
+import DoLDA_MR
+import DoLDA_Parser
+
+MANIFEST_SUFFIX = '.manifest.npz'
+
+# version of the manifest format, older manifests are rebuilt
+# 3: lines with word ids or counts over int32 are malformed
+# 4: largest word id of each line, malformed lines are found again when only the vocabulary changes
+MANIFEST_VERSION = 4
+
+# number of lines parsed together
+CHUNK_SIZE = 10000
+
+CSR_SUFFIX = '.csr.seq'
+INDEX_SUFFIX = '.index.npy'
+
+
+def file_stat(path):
+    '''
+    Return (size, modification time) of path
+    '''
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime)
+
+
+def count_lines(path):
+    '''
+    Return number of lines of path
+    '''
+    line_num = 0
+    each_file = open(path, 'rb')
+    for line in each_file:
+        line_num += 1
+    each_file.close()
+    return line_num
+
+
+def read_chunks(document_file_path, chunk_size=CHUNK_SIZE):
+    '''
+    Generate (index of the first line, lines) of each chunk of the document file
+    '''
+    lines = []
+    first_line = 0
+    document_file = open(document_file_path, 'rb')
+    for line in document_file:
+        lines.append(line)
+        if len(lines) >= chunk_size:
+            yield (first_line, lines)
+            first_line += len(lines)
+            lines = []
+    document_file.close()
+    if lines:
+        yield (first_line, lines)
+
+
+def scan_documents(document_file_path):
+    '''
+    Scan the document file once
+    Return (offsets, token_counts, malformed, max_ids, md5 hex digest)
+    offsets has one more element, the size of the file
+    malformed lines do not depend on the vocabulary, their token count is 0
+    max_ids - largest word id of each line, -1 for malformed and empty lines
+    '''
+    offsets = [numpy.zeros(1, dtype=numpy.int64)]
+    token_counts = []
+    malformed = []
+    max_ids = []
+    checksum = hashlib.md5()
+
+    position = 0
+    for (first_line, lines) in read_chunks(document_file_path):
+        line_lengths = numpy.array([len(line) for line in lines], dtype=numpy.int64)
+        offsets.append(position + numpy.cumsum(line_lengths))
+        position += int(numpy.sum(line_lengths))
+        for line in lines:
+            checksum.update(line)
+
+        chunk = DoLDA_Parser.parse_lines(lines)
+        chunk_token_counts = numpy.zeros(len(lines), dtype=numpy.int64)
+        chunk_token_counts[chunk.line_indices] = chunk.token_counts()
+        token_counts.append(chunk_token_counts)
+        malformed.append(first_line + chunk.malformed)
+
+        chunk_max_ids = numpy.zeros(len(lines), dtype=numpy.int64) - 1
+        non_empty = numpy.flatnonzero(numpy.diff(chunk.doc_offsets) > 0)
+        if len(non_empty) > 0:
+            chunk_max_ids[chunk.line_indices[non_empty]] = numpy.maximum.reduceat(chunk.ids, chunk.doc_offsets[non_empty])
+        max_ids.append(chunk_max_ids)
+
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    return (numpy.concatenate(offsets), numpy.concatenate(token_counts or [empty]),
+            numpy.concatenate(malformed or [empty]), numpy.concatenate(max_ids or [empty]), checksum.hexdigest())
+
+
+class Manifest(object):
+    '''
+    Manifest of a document file
+
+    line_token_counts, format_malformed, max_ids - scan_documents results, independent of the vocabulary
+    token_counts, malformed - with lines of unknown word ids malformed too
+    '''
+    def __init__(self, offsets, line_token_counts, format_malformed, max_ids, word_num, checksum, document_stat, word_stat):
+        self.offsets = offsets
+        self.line_token_counts = line_token_counts
+        self.format_malformed = format_malformed
+        self.max_ids = max_ids
+        self.checksum = checksum
+        self.document_stat = document_stat
+        self.set_vocabulary(word_num, word_stat)
+
+    def set_vocabulary(self, word_num, word_stat):
+        '''
+        Mark lines with word ids not less than word_num malformed
+        The document file is not scanned again
+        '''
+        self.word_num = word_num
+        self.word_stat = word_stat
+        is_malformed = self.max_ids >= word_num
+        is_malformed[self.format_malformed] = True
+        self.malformed = numpy.flatnonzero(is_malformed)
+        self.token_counts = numpy.where(is_malformed, 0, self.line_token_counts)
+
+    @property
+    def line_num(self):
+        return len(self.token_counts)
+
+    @property
+    def document_num(self):
+        '''
+        Number of documents, malformed lines are not documents
+        '''
+        return self.line_num - len(self.malformed)
+
+    @property
+    def total_token_num(self):
+        return int(numpy.sum(self.token_counts))
+
+    def document_indices(self):
+        '''
+        Return line indices of documents, without malformed lines
+        '''
+        is_document = numpy.ones(self.line_num, dtype=bool)
+        is_document[self.malformed] = False
+        return numpy.flatnonzero(is_document)
+
+    def byte_ranges(self, doc_indices):
+        '''
+        Return [(start, end), ...] byte ranges of documents doc_indices
+        Ranges of consecutive documents are merged
+        '''
+        return [(int(self.offsets[first]), int(self.offsets[last]))
+                for (first, last) in self.index_ranges(doc_indices)]
+
+    def index_ranges(self, doc_indices):
+        '''
+        Return [(first, last), ...] ranges of documents doc_indices, last is not included
+        Consecutive documents are merged
+        '''
+        doc_indices = numpy.unique(numpy.asarray(doc_indices, dtype=numpy.int64))
+        if 0 == len(doc_indices):
+            return []
+        # a new range starts where the previous document is not selected
+        firsts = numpy.flatnonzero(numpy.diff(doc_indices) != 1) + 1
+        starts = doc_indices[numpy.concatenate(([0], firsts))]
+        ends = doc_indices[numpy.concatenate((firsts - 1, [len(doc_indices) - 1]))] + 1
+        return zip(starts.tolist(), ends.tolist())
+
+    def block_lines(self, block_size):
+        '''
+        Return [(first, last), ...] ranges of lines of blocks of about block_size bytes, last is not included
+        A block has whole lines, at least one
+        '''
+        cuts = numpy.searchsorted(self.offsets[:-1], numpy.arange(block_size, self.offsets[-1], block_size))
+        bounds = numpy.unique(numpy.concatenate(([0], cuts, [self.line_num])))
+        return zip(bounds[:-1].tolist(), bounds[1:].tolist())
+
+    def save(self, path):
+        '''
+        Write the manifest into path
+        It is written into a temporary file first, and renamed
+        '''
+        (manifest_fd, manifest_tmp_path) = tempfile.mkstemp(prefix='.manifest_', dir=os.path.dirname(os.path.abspath(path)))
+        manifest_file = os.fdopen(manifest_fd, 'wb')
+        numpy.savez(manifest_file, version=MANIFEST_VERSION,
+                offsets=self.offsets, line_token_counts=self.line_token_counts,
+                format_malformed=self.format_malformed, max_ids=self.max_ids,
+                word_num=self.word_num, checksum=self.checksum,
+                document_stat=numpy.array(self.document_stat, dtype=numpy.float64),
+                word_stat=numpy.array(self.word_stat, dtype=numpy.float64))
+        manifest_file.close()
+        os.rename(manifest_tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read the manifest from path
+        Return None when it is not readable or of another version
+        '''
+        try:
+            manifest_file = numpy.load(path)
+            if MANIFEST_VERSION != int(manifest_file['version']):
+                return None
+            return cls(manifest_file['offsets'], manifest_file['line_token_counts'],
+                    manifest_file['format_malformed'], manifest_file['max_ids'],
+                    int(manifest_file['word_num']), str(manifest_file['checksum']),
+                    tuple(manifest_file['document_stat'].tolist()), tuple(manifest_file['word_stat'].tolist()))
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+
+def manifest_path(document_file_path):
+    return document_file_path + MANIFEST_SUFFIX
+
+
+def load_manifest(document_file_path, word_file_path):
+    '''
+    Return Manifest of document_file_path with vocabulary size of word_file_path
+    Cached manifest is reused if the document file is not changed,
+    only the vocabulary is recounted when the word file is changed
+    '''
+    path = manifest_path(document_file_path)
+    document_stat = file_stat(document_file_path)
+    word_stat = file_stat(word_file_path)
+
+    manifest = None
+    if os.path.exists(path):
+        manifest = Manifest.load(path)
+    if manifest is not None and manifest.document_stat == document_stat:
+        if manifest.word_stat == word_stat:
+            return manifest
+        # word ids are checked with the new vocabulary size
+        manifest.set_vocabulary(count_lines(word_file_path), word_stat)
+    else:
+        (offsets, token_counts, malformed, max_ids, checksum) = scan_documents(document_file_path)
+        manifest = Manifest(offsets, token_counts, malformed, max_ids, count_lines(word_file_path), checksum,
+                document_stat, word_stat)
+    if len(manifest.malformed) > 0:
+        sys.stderr.write('%d malformed lines in %s are not used, line numbers %s\n' %
+                (len(manifest.malformed), document_file_path, ' '.join([str(x + 1) for x in manifest.malformed[:10]])))
+
+    try:
+        manifest.save(path)
+    except (IOError, OSError):
+        # directory of the document file is not writable, do not cache
+        pass
+    return manifest
+
+
+def convert_documents(document_file_path, output_path, checksum, word_num):
+    '''
+    Convert the document file into binary corpus output_path
+    and write position of each record into output_path + INDEX_SUFFIX
+    Return number of malformed lines, they have no record
+
+    checksum - md5 of the document file, stored in the metadata
+    word_num - vocabulary size, lines with word ids out of it are malformed
+    '''
+    # SequenceFile writer does not overwrite, so temporary path is not created before
+    corpus_tmp_path = '%s.%d.tmp' % (output_path, os.getpid())
+    if os.path.exists(corpus_tmp_path):
+        os.remove(corpus_tmp_path)
+
+    metadata = SequenceFile.Metadata()
+    metadata.set('checksum', checksum)
+    metadata.set('word_num', str(word_num))
+    writer = SequenceFile.createWriter(corpus_tmp_path, TypedBytesWritable, TypedBytesWritable, metadata)
+
+    # ordinal is line index, malformed lines have no record
+    positions = []
+    malformed_num = 0
+    for (first_line, lines) in read_chunks(document_file_path):
+        chunk = DoLDA_Parser.parse_lines(lines, word_num)
+        malformed_num += len(chunk.malformed)
+        record_positions = numpy.zeros(len(lines), dtype=numpy.int64) - 1
+        for d in range(0, len(chunk)):
+            (doc_id, ids, cts) = chunk.document(d)
+            output_key = TypedBytesWritable()
+            output_value = TypedBytesWritable()
+            output_key.set(doc_id)
+            output_value.set(DoLDA_MR.pack_document(first_line + chunk.line_indices[d], ids, cts))
+            record_positions[chunk.line_indices[d]] = writer.getLength()
+            writer.append(output_key, output_value)
+        positions.append(record_positions)
+    positions.append(numpy.array([writer.getLength()], dtype=numpy.int64))
+    positions = numpy.concatenate(positions)
+    # a malformed line has an empty range at the next record
+    for idx in range(len(positions) - 2, -1, -1):
+        if positions[idx] < 0:
+            positions[idx] = positions[idx + 1]
+    writer.close()
+
+    (index_fd, index_tmp_path) = tempfile.mkstemp(prefix='.csr_index_', dir=os.path.dirname(os.path.abspath(output_path)))
+    index_file = os.fdopen(index_fd, 'wb')
+    numpy.save(index_file, positions)
+    index_file.close()
+
+    os.rename(index_tmp_path, output_path + INDEX_SUFFIX)
+    os.rename(corpus_tmp_path, output_path)
+    return malformed_num
+
+
+def read_record_index(path):
+    '''
+    Return positions of records of binary corpus path
+    It has one more element, the end of the last record
+    '''
+    return numpy.load(path + INDEX_SUFFIX)
+
+
+def copy_text_ranges(path, output_path, byte_ranges):
+    '''
+    Write byte ranges of text file path into output_path, one after another
+    byte_ranges - sorted [(start, end), ...] ranges of whole lines
+    '''
+    input_file = open(path, 'rb')
+    output_file = open(output_path, 'wb')
+    last = ''
+    for (start, end) in byte_ranges:
+        input_file.seek(start)
+        data = input_file.read(end - start)
+        output_file.write(data)
+        last = data[-1:] or last
+    if last and '\n' != last:
+        # the last line of the file has no newline
+        output_file.write('\n')
+    output_file.close()
+    input_file.close()
+
+
+def copy_record_ranges(path, output_path, index_ranges):
+    '''
+    Write records of ranges of document ordinals of binary corpus path into output_path
+    Records keep their ordinals
+    index_ranges - sorted [(first, last), ...] ranges of document ordinals, last is not included
+    '''
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    positions = read_record_index(path)
+    reader = SequenceFile.Reader(path)
+    writer = SequenceFile.createWriter(output_path, TypedBytesWritable, TypedBytesWritable)
+    key_instance = reader.getKeyClass()()
+    value_instance = reader.getValueClass()()
+    for (first, last) in index_ranges:
+        reader.seek(int(positions[first]))
+        while reader.getPosition() < positions[last] and reader.next(key_instance, value_instance):
+            writer.append(key_instance, value_instance)
+    writer.close()
+    reader.close()
+
+
+def csr_path(document_file_path):
+    return document_file_path + CSR_SUFFIX
+
+
+def load_csr_corpus(document_file_path, manifest):
+    '''
+    Return path of binary corpus of document_file_path
+    It is converted only when it is missing or made from other contents
+    '''
+    path = csr_path(document_file_path)
+    if os.path.exists(path) and os.path.exists(path + INDEX_SUFFIX):
+        reader = SequenceFile.Reader(path)
+        metadata = reader.getMetadata()
+        reader.close()
+        if 'checksum' in metadata.keys() and manifest.checksum == metadata.get('checksum') and \
+                'word_num' in metadata.keys() and str(manifest.word_num) == metadata.get('word_num'):
+            return path
+
+    malformed_num = convert_documents(document_file_path, path, manifest.checksum, manifest.word_num)
+    if malformed_num != len(manifest.malformed):
+        raise ValueError('%d malformed lines in binary corpus, %d in manifest' % (malformed_num, len(manifest.malformed)))
+    return path
+
+
+class MinibatchSampler(object):
+    '''
+    Minibatches of document indices in an epoch
+
+    order - sequential, shuffle or stratified
+        sequential - documents in the file order
+        shuffle - random order, different in each epoch
+        stratified - random order, and every minibatch has documents of every length
+                     in proportion to the corpus
+    '''
+    ORDERS = ('sequential', 'shuffle', 'stratified')
+
+    def __init__(self, manifest, minibatch_size, order='sequential', seed=100000001, strata_num=10):
+        if order not in self.ORDERS:
+            raise ValueError('Unknown order %s' % order)
+        self._manifest = manifest
+        self._minibatch_size = minibatch_size
+        self._order = order
+        self._seed = seed
+        self._strata_num = strata_num
+
+    def epoch_order(self, epoch):
+        '''
+        Return document indices of epoch in the order of training
+        The order depends only on seed and epoch
+        '''
+        document_indices = self._manifest.document_indices()
+        document_num = len(document_indices)
+        if 'sequential' == self._order:
+            return document_indices
+
+        random_state = numpy.random.RandomState(self._seed + epoch)
+        if 'shuffle' == self._order:
+            return random_state.permutation(document_indices)
+
+        # stratified
+        # equal sized strata of document length, ties are broken randomly
+        tie_breaks = random_state.random_sample(document_num)
+        by_length = numpy.lexsort((tie_breaks, self._manifest.token_counts[document_indices]))
+        strata = numpy.zeros(document_num, dtype=numpy.int64)
+        strata[by_length] = numpy.arange(document_num) * self._strata_num / max(1, document_num)
+
+        # documents of each stratum are spread evenly over the epoch in random order
+        position = numpy.zeros(document_num)
+        for stratum in range(0, self._strata_num):
+            members = random_state.permutation(numpy.flatnonzero(strata == stratum))
+            position[members] = (numpy.arange(len(members)) + random_state.random_sample(len(members))) / len(members)
+        return document_indices[numpy.argsort(position, kind='mergesort')]
+
+    def minibatch_num(self):
+        return (self._manifest.document_num + self._minibatch_size - 1) / self._minibatch_size
+
+    def minibatches(self, epoch=0):
+        '''
+        Generate document indices of each minibatch of epoch
+        '''
+        order = self.epoch_order(epoch)
+        for start in range(0, len(order), self._minibatch_size):
+            yield order[start:start + self._minibatch_size]
+
+
+class GammaStore(object):
+    '''
+    gamma of the last visit of each document, line_num x topic_num .npy file memory-mapped
+    Rows are line indices of the document file, a row of zeros is a document not visited yet
+    '''
+    def __init__(self, path, line_num, topic_num, dtype='float64', reset=False):
+        '''
+        reset - start with no visited document even if path exists
+        '''
+        if reset or not os.path.exists(path):
+            self._gamma = numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.dtype(dtype),
+                    shape=(line_num, topic_num))
+        else:
+            self._gamma = numpy.load(path, mmap_mode='r+')
+            if self._gamma.shape != (line_num, topic_num):
+                raise ValueError('%s has gamma of shape %s, not %s' % (path, self._gamma.shape, (line_num, topic_num)))
+
+    def get(self, indices):
+        '''
+        Return (indices, gamma) of visited documents among indices
+        '''
+        indices = numpy.sort(numpy.asarray(indices, dtype=numpy.int64))
+        gamma = numpy.asarray(self._gamma[indices])
+        visited = numpy.any(gamma != 0, 1)
+        return (indices[visited], gamma[visited])
+
+    def put(self, indices, gamma):
+        self._gamma[numpy.asarray(indices, dtype=numpy.int64)] = gamma
+        self._gamma.flush()
+
+
+def read_gamma(paths, topic_num, dtype='float64'):
+    '''
+    Read gamma output of DoLDA_MR.py with gamma_store
+    Return (positions, gamma), positions are byte offsets of text or ordinals of binary corpus
+    '''
+    positions = []
+    gamma = []
+    for path in paths:
+        reader = SequenceFile.Reader(path)
+        key_instance = reader.getKeyClass()()
+        value_instance = reader.getValueClass()()
+        while reader.next(key_instance, value_instance):
+            positions.append(int(key_instance.toString()))
+            gamma.append(numpy.fromstring(value_instance.toString(), dtype=dtype))
+        reader.close()
+    return (numpy.array(positions, dtype=numpy.int64), numpy.array(gamma).reshape(-1, topic_num))
+
+
+# main function start
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.exit('Usage: %s document_file_path word_file_path [csr]' % sys.argv[0])
+
+    manifest = load_manifest(sys.argv[1], sys.argv[2])
+    if len(sys.argv) > 3 and 'csr' == sys.argv[3]:
+        print 'csr\t%s' % load_csr_corpus(sys.argv[1], manifest)
+    print 'document_num\t%d' % manifest.document_num
+    print 'total_token_num\t%d' % manifest.total_token_num
+    print 'malformed_lines\t%d' % len(manifest.malformed)
+    print 'word_num\t%d' % manifest.word_num
+    print 'md5\t%s' % manifest.checksum
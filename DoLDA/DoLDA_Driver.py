@@ -14,79 +14,385 @@ When you got troubles to run this code, please contact to Author (jy.bak@kaist.a
 import sys
 import subprocess
 import os
+import shutil
+import tempfile
 import numpy
 from scipy.special import gammaln, psi
 import re
+import optparse
+import json
+import threading
+import Queue
 import ctypedbytes
-from hadoop.io import SequenceFile
-from hadoop.typedbytes import TypedBytesWritable
+import DoLDA_Params
+import DoLDA_MR
+import DoLDA_Corpus
+import DoLDA_Local
 
-def file_len(fname):
+def init_parameters(topic_num, word_num, hadoop_hdfs_root, dtype='float64', local=False, column_store=False):
     '''
-    Return file length of fname
+    Initialize parameters, alpha, lambda and eta
+    
+    dtype - floating point type of lambda
+    local - hadoop_hdfs_root is a local directory
+    column_store - psi(lambda) is stored word by word
+    '''
+    # file setting
+    parameter_target_filename = 'parameters_for_0.txt'
+    
+    parameters = DoLDA_Params.initial_parameters(topic_num, word_num, dtype)
+    if column_store:
+        parameters = DoLDA_Params.word_major_parameters(parameters)
+    DoLDA_Params.write_parameters(parameter_target_filename, parameters)
+    
+    put_file(parameter_target_filename, hadoop_hdfs_root, local)
+    os.remove(parameter_target_filename)
+    
+    return parameter_target_filename
     
-    fname - File path. String
     
-    It comes from
-    http://stackoverflow.com/questions/845058/how-to-get-line-count-cheaply-in-python
+def put_file(local_path, hadoop_hdfs_root, local=False):
     '''
-    with open(fname) as f:
-        for i, l in enumerate(f):
-            pass
-    return i + 1
-
-
-def init_parameters(topic_num, word_num, hadoop_hdfs_root):
+    Copy local_path into hadoop_hdfs_root, replacing the old one
+    local - hadoop_hdfs_root is a local directory
     '''
-    Initialize parameters, alpha, lambda and eta
+    if local:
+        shutil.copy(local_path, hadoop_hdfs_root)
+    else:
+        subprocess.call("hadoop dfs -rm %s/%s" % (hadoop_hdfs_root, os.path.basename(local_path)), shell=True, stdout=file(os.devnull, "w"))
+        subprocess.call("hadoop dfs -copyFromLocal %s %s/" % (local_path, hadoop_hdfs_root), shell=True, stdout=file(os.devnull, "w"))
+    
+    
+def list_files(hadoop_hdfs_root, directory, local=False):
+    '''
+    Return names of files in directory of hadoop_hdfs_root
     '''
-    # parameter initialized    
-    numpy.random.seed(100000001)
+    if local:
+        return os.listdir(os.path.join(hadoop_hdfs_root, directory))
     
-    # file setting
-    parameter_target_filename = 'parameters_for_0.txt'
+    ls_output = subprocess.Popen("hadoop dfs -ls %s/%s" % (hadoop_hdfs_root, directory), shell=True, stdout=subprocess.PIPE).communicate()[0]
     
-    writer = SequenceFile.createWriter(parameter_target_filename, TypedBytesWritable, TypedBytesWritable)
+    filenames = []
+    for line in ls_output.splitlines():
+        # permission replication user group size date time path
+        fields = line.split()
+        if len(fields) < 8:
+            continue
+        filenames.append(os.path.basename(fields[-1]))
+    return filenames
     
-    # For alpha
-    _alpha = numpy.zeros(topic_num) + 1./topic_num
     
-    output_key_a = TypedBytesWritable()
-    output_value_a = TypedBytesWritable()
-
-    output_key_a.set('new_alpha')
-    output_value_a.set(_alpha.tostring())
-
-    writer.append(output_key_a, output_value_a)
+def list_parameter_files(hadoop_hdfs_root, updatect, local=False):
+    '''
+    Return parameter files written by job updatect
+    Each reducer writes its own shards of lambda into a separate file
+    '''
+    parameter_dir = 'output_%d/parameters' % updatect
     
-    # For lambda
-    _lambda = 1*numpy.random.gamma(100., 1./100., (topic_num, word_num))
+    parameter_filenames = []
+    for filename in list_files(hadoop_hdfs_root, parameter_dir, local):
+        if filename.startswith('_') or filename.startswith('.'):
+            # _logs, _SUCCESS
+            continue
+        parameter_filenames.append('%s/%s' % (parameter_dir, filename))
     
-    output_key_l = TypedBytesWritable()
-    output_value_l = TypedBytesWritable()
-
-    output_key_l.set('new_lambda')
-    output_value_l.set(_lambda.tostring())
-
-    writer.append(output_key_l, output_value_l)
+    return sorted(parameter_filenames)
     
-    # For eta
-    _eta = numpy.zeros(word_num) + 1./topic_num
     
-    output_key_e = TypedBytesWritable()
-    output_value_e = TypedBytesWritable()
-
-    output_key_e.set('new_eta')
-    output_value_e.set(_eta.tostring())
-
-    writer.append(output_key_e, output_value_e)
-
-    writer.close()
+def parameter_cachefiles(parameter_filenames):
+    '''
+    Return [(filename, link name), ...] of parameter files
+    Tasks see them as _params_0, _params_1, ...
+    '''
+    return [(parameter_filename, '_params_%d' % idx)
+            for (idx, parameter_filename) in enumerate(parameter_filenames)]
     
-    subprocess.call("hadoop dfs -copyFromLocal " + parameter_target_filename + " " + hadoop_hdfs_root, shell=True, stdout=file(os.devnull, "w"))
-    os.remove(parameter_target_filename)
     
-    return parameter_target_filename
+def cachefile_options(hadoop_hdfs_root, cachefiles):
+    '''
+    Return -cachefile options of [(filename, link name), ...]
+    '''
+    return ' '.join(['-cachefile %s/%s#%s' % (hadoop_hdfs_root, filename, link_name)
+            for (filename, link_name) in cachefiles])
+    
+    
+def input_options(hadoop_hdfs_root, input_filenames):
+    '''
+    Return -input options of input files
+    '''
+    return ' '.join(['-input %s/%s' % (hadoop_hdfs_root, filename) for filename in input_filenames])
+    
+    
+def param_options(job_params):
+    '''
+    Return -param options of job parameters
+    '''
+    return ' '.join(['-param %s=%s' % (name, value) for (name, value) in sorted(job_params.items())])
+    
+    
+def remove_file(filename, hadoop_hdfs_root, local=False):
+    '''
+    Remove filename in hadoop_hdfs_root
+    '''
+    if local:
+        if os.path.exists(os.path.join(hadoop_hdfs_root, filename)):
+            os.remove(os.path.join(hadoop_hdfs_root, filename))
+    else:
+        subprocess.call("hadoop dfs -rm %s/%s" % (hadoop_hdfs_root, filename), shell=True,
+                stdout=file(os.devnull, "w"), stderr=file(os.devnull, "w"))
+    
+    
+def upload_blocks(manifest, input_file_path, hadoop_hdfs_root, block_size, csr=False, local=False):
+    '''
+    Upload the whole documents once, as block files of about block_size bytes of whole lines
+    Blocks uploaded by an earlier run are not uploaded again
+    Return [(start, end, filename), ...] of blocks, byte ranges of text or ordinal ranges of binary corpus
+    '''
+    if csr:
+        suffix = DoLDA_Corpus.CSR_SUFFIX
+    else:
+        suffix = '.txt'
+    uploaded = set(list_files(hadoop_hdfs_root, '.', local))
+    
+    blocks = []
+    for (first, last) in manifest.block_lines(block_size):
+        if csr:
+            (start, end) = (first, last)
+        else:
+            (start, end) = (int(manifest.offsets[first]), int(manifest.offsets[last]))
+        block_filename = DoLDA_MR.BLOCK_FILENAME % (manifest.checksum[:8], start, end, suffix)
+        if block_filename not in uploaded:
+            if csr:
+                DoLDA_Corpus.copy_record_ranges(input_file_path, block_filename, [(start, end)])
+            else:
+                DoLDA_Corpus.copy_text_ranges(input_file_path, block_filename, [(start, end)])
+            put_file(block_filename, hadoop_hdfs_root, local)
+            os.remove(block_filename)
+        blocks.append((start, end, block_filename))
+    
+    uploaded = set(list_files(hadoop_hdfs_root, '.', local))
+    for (start, end, block_filename) in blocks:
+        if block_filename not in uploaded:
+            raise IOError('%s is not uploaded into %s' % (block_filename, hadoop_hdfs_root))
+    return blocks
+    
+    
+class MinibatchStager(object):
+    '''
+    Prepare inputs of minibatch jobs: job parameters, the uploaded ranges file and the input files
+    On Hadoop the input of a job is the blocks of the whole documents which have its minibatch,
+    so mappers do not read the whole documents. Local jobs read the ranges of the whole documents.
+    With pipeline, a background thread prepares the next minibatch while the current job runs
+    Parameters of a job are written by the previous job, they are not prepared here
+    '''
+    RANGES_FILENAME = 'BOW_LDA_minibatch_ranges_%d.npy'
+    # longest input_ranges given as it is, and as packed ranges, in the job command
+    MAX_RANGES_LENGTH = 1024
+    MAX_PACKED_LENGTH = 65536
+    
+    def __init__(self, manifest, hadoop_hdfs_root, input_file_path, csr=False, local=False, pipeline=False,
+                 blocks=None):
+        '''
+        input_file_path - whole documents, text or binary corpus with csr
+        blocks - [(start, end, filename), ...] of upload_blocks, None to read input_file_path
+        '''
+        self._manifest = manifest
+        self._hadoop_hdfs_root = hadoop_hdfs_root
+        self._input_file_path = input_file_path
+        self._csr = csr
+        self._local = local
+        self._pipeline = pipeline
+        self._blocks = blocks
+        if blocks is not None:
+            self._block_starts = numpy.array([start for (start, end, filename) in blocks], dtype=numpy.int64)
+            self._block_ends = numpy.array([end for (start, end, filename) in blocks], dtype=numpy.int64)
+        # staged files of finished jobs, removed by the thread which uploads
+        self._finished = Queue.Queue()
+        
+    def input_filenames(self, input_ranges):
+        '''
+        Return input filenames of a job of input_ranges, blocks which have any of them
+        '''
+        if self._blocks is None:
+            return [os.path.basename(self._input_file_path)]
+        is_used = numpy.zeros(len(self._blocks), dtype=bool)
+        for (start, end) in input_ranges:
+            is_used[numpy.searchsorted(self._block_ends, start, 'right'):numpy.searchsorted(self._block_starts, end)] = True
+        return [self._blocks[idx][2] for idx in numpy.flatnonzero(is_used)]
+        
+    def stage(self, updatect, doc_indices):
+        '''
+        Prepare input of job updatect
+        Return (job parameters of the minibatch, [(filename, link name), ...] of cache files,
+                input filenames)
+        '''
+        # byte ranges or ordinal ranges of minibatch
+        if self._csr:
+            input_ranges = self._manifest.index_ranges(doc_indices)
+        else:
+            input_ranges = self._manifest.byte_ranges(doc_indices)
+        minibatch_params = {'minibatch_size': len(doc_indices), 'updatect': updatect}
+        cachefiles = []
+        formatted_ranges = DoLDA_MR.format_input_ranges(input_ranges)
+        packed_ranges = None
+        if len(formatted_ranges) > self.MAX_RANGES_LENGTH:
+            packed_ranges = DoLDA_MR.pack_input_ranges(input_ranges)
+        if packed_ranges is None:
+            minibatch_params['input_ranges'] = formatted_ranges
+        elif len(packed_ranges) <= self.MAX_PACKED_LENGTH:
+            # many ranges of a shuffled minibatch are compressed
+            minibatch_params['input_ranges_packed'] = packed_ranges
+        else:
+            # too many ranges for the job command are sent as a file
+            ranges_filename = self.RANGES_FILENAME % updatect
+            numpy.save(ranges_filename, numpy.array(input_ranges, dtype=numpy.int64))
+            put_file(ranges_filename, self._hadoop_hdfs_root, self._local)
+            os.remove(ranges_filename)
+            if ranges_filename not in list_files(self._hadoop_hdfs_root, '.', self._local):
+                raise IOError('%s is not uploaded into %s' % (ranges_filename, self._hadoop_hdfs_root))
+            minibatch_params['input_ranges_file'] = '_input_ranges'
+            cachefiles.append((ranges_filename, '_input_ranges'))
+        
+        return (minibatch_params, cachefiles, self.input_filenames(input_ranges))
+        
+    def finished(self, filenames):
+        '''
+        Job of cache files filenames from stage is finished, they are removed
+        The whole documents and their blocks are never removed
+        '''
+        for filename in filenames:
+            self._finished.put(filename)
+        if not self._pipeline:
+            self.remove_finished()
+            
+    def remove_finished(self):
+        while not self._finished.empty():
+            remove_file(self._finished.get(), self._hadoop_hdfs_root, self._local)
+            
+    def _stage_all(self, minibatches, staged):
+        try:
+            for (updatect, doc_indices) in minibatches:
+                self.remove_finished()
+                staged.put((updatect, doc_indices) + self.stage(updatect, doc_indices))
+            staged.put(None)
+        except:
+            staged.put(sys.exc_info())
+            
+    def staged(self, minibatches):
+        '''
+        Generate (updatect, doc_indices, job parameters, cache files, input filenames) of each minibatch
+        minibatches - (updatect, doc_indices) of each minibatch
+        '''
+        if not self._pipeline:
+            for (updatect, doc_indices) in minibatches:
+                yield (updatect, doc_indices) + self.stage(updatect, doc_indices)
+            return
+        
+        # one minibatch is prepared ahead
+        staged = Queue.Queue(1)
+        thread = threading.Thread(target=self._stage_all, args=(minibatches, staged))
+        thread.setDaemon(True)
+        thread.start()
+        while True:
+            item = staged.get()
+            if item is None:
+                break
+            if 3 == len(item):
+                # exception of the thread
+                raise item[0], item[1], item[2]
+            yield item
+        thread.join()
+        self.remove_finished()
+    
+    
+def numbered_minibatches(sampler, epoch_num, first_updatect=0):
+    '''
+    Generate (updatect, doc_indices) of minibatches of epoch_num epochs, from job first_updatect
+    '''
+    updatect = 0
+    for epoch in range(0, epoch_num):
+        for doc_indices in sampler.minibatches(epoch):
+            if updatect >= first_updatect:
+                yield (updatect, doc_indices)
+            updatect += 1
+    
+    
+def document_positions(manifest, indices, csr=False):
+    '''
+    Return positions of documents as mappers see them, byte offsets of text or ordinals of binary corpus
+    '''
+    if csr:
+        return numpy.asarray(indices, dtype=numpy.int64)
+    return manifest.offsets[numpy.asarray(indices, dtype=numpy.int64)]
+    
+    
+def position_indices(manifest, positions, csr=False):
+    '''
+    Return line indices of documents at positions
+    '''
+    if csr:
+        return positions
+    return numpy.searchsorted(manifest.offsets, positions)
+    
+    
+def fetch_gamma(hadoop_hdfs_root, updatect, topic_num, dtype, local=False):
+    '''
+    Return (positions, gamma) written by job updatect with gamma_store
+    '''
+    gamma_dir = 'output_%d/gamma' % updatect
+    temp_dir = None
+    if local:
+        directory = os.path.join(hadoop_hdfs_root, gamma_dir)
+    else:
+        temp_dir = tempfile.mkdtemp(prefix='DoLDA_gamma_')
+        subprocess.call("hadoop dfs -copyToLocal %s/%s %s/" % (hadoop_hdfs_root, gamma_dir, temp_dir), shell=True,
+                stdout=file(os.devnull, "w"), stderr=file(os.devnull, "w"))
+        directory = os.path.join(temp_dir, 'gamma')
+    
+    gamma_paths = []
+    if os.path.isdir(directory):
+        # _logs, _SUCCESS
+        gamma_paths = [os.path.join(directory, filename) for filename in sorted(os.listdir(directory))
+                if not filename.startswith('_') and not filename.startswith('.')]
+    gamma = DoLDA_Corpus.read_gamma(gamma_paths, topic_num, dtype)
+    if temp_dir is not None:
+        shutil.rmtree(temp_dir)
+    return gamma
+    
+    
+def remove_output(hadoop_hdfs_root, updatect, local=False):
+    '''
+    Remove output of job updatect, left by a failed or interrupted job
+    '''
+    output_dir = 'output_%d' % updatect
+    if local:
+        if os.path.exists(os.path.join(hadoop_hdfs_root, output_dir)):
+            shutil.rmtree(os.path.join(hadoop_hdfs_root, output_dir))
+    else:
+        subprocess.call("hadoop dfs -rmr %s/%s" % (hadoop_hdfs_root, output_dir), shell=True,
+                stdout=file(os.devnull, "w"), stderr=file(os.devnull, "w"))
+    
+    
+def write_checkpoint(checkpoint_path, checkpoint):
+    '''
+    Write checkpoint, a dict, into a json file
+    The old checkpoint is replaced at once, a crash never leaves a broken one
+    '''
+    temp_path = '%s.%d.tmp' % (checkpoint_path, os.getpid())
+    checkpoint_file = open(temp_path, 'w')
+    json.dump(checkpoint, checkpoint_file, indent=1, sort_keys=True)
+    checkpoint_file.close()
+    os.rename(temp_path, checkpoint_path)
+    
+    
+def read_checkpoint(checkpoint_path):
+    '''
+    Return checkpoint dict of a json file
+    '''
+    checkpoint_file = open(checkpoint_path, 'r')
+    checkpoint = json.load(checkpoint_file)
+    checkpoint_file.close()
+    return checkpoint
     
     
 def dirichlet_expectation(alpha):
@@ -102,80 +408,196 @@ def dirichlet_expectation(alpha):
 # main function start
 if __name__ == "__main__":
     # input check
-    if len(sys.argv) < 11:
-        sys.exit('Usage: %s word_file_path document_file_path topic_num minibatch_size tau0 kappa num_mapper num_reducer hadoop_hdfs_root hadoop_library_path' % sys.argv[0])
+    option_parser = optparse.OptionParser(usage='%prog [options] word_file_path document_file_path topic_num minibatch_size tau0 kappa num_mapper num_reducer hadoop_hdfs_root hadoop_library_path python_bin_path')
+    option_parser.add_option('--local', action='store_true', default=False,
+            help='run jobs on this machine without Hadoop, hadoop_hdfs_root is a local directory')
+    option_parser.add_option('--dtype', default='float64',
+            help='floating point type of lambda, gamma and sstats: float64 or float32 [default: %default]')
+    option_parser.add_option('--order', default='sequential', choices=DoLDA_Corpus.MinibatchSampler.ORDERS,
+            help='order of documents: sequential, shuffle or stratified by document length [default: %default]')
+    option_parser.add_option('--csr', action='store_true', default=False,
+            help='read documents from binary corpus, it is converted once and reused')
+    option_parser.add_option('--seed', type='int', default=100000001,
+            help='random seed of document order [default: %default]')
+    option_parser.add_option('--param', action='append', default=[], metavar='NAME=VALUE',
+            help='additional job parameter of DoLDA_MR.py, can be repeated')
+    option_parser.add_option('--checkpoint', default='DoLDA_checkpoint.json',
+            help='progress file written after each finished job [default: %default]')
+    option_parser.add_option('--resume', action='store_true', default=False,
+            help='continue from the last finished job of the checkpoint')
+    option_parser.add_option('--epochs', type='int', default=1,
+            help='number of passes over the documents [default: %default]')
+    option_parser.add_option('--gamma-store', dest='gamma_store', metavar='PATH',
+            help='keep gamma of the last visit of each document in PATH, E step of the next visit starts from it')
+    option_parser.add_option('--pipeline', action='store_true', default=False,
+            help='prepare and upload input of the next minibatch while a job runs')
+    option_parser.add_option('--block-size', dest='block_size', type='int', default=67108864,
+            help='bytes of a block of the documents uploaded for jobs on Hadoop [default: %default]')
+    option_parser.add_option('--retries', type='int', default=2,
+            help='number of times a failed job is run again [default: %default]')
+    (options, args) = option_parser.parse_args()
+    if len(args) < 11:
+        option_parser.error('11 arguments are needed')
         
     # input setting
-    word_file_path = sys.argv[1]
-    document_file_path = sys.argv[2]
-    topic_num = int(sys.argv[3])
-    minibatch_size = int(sys.argv[4])
-    tau0 = float(sys.argv[5])
-    kappa = float(sys.argv[6])
-    num_mapper = int(sys.argv[7])
-    num_reducer = int(sys.argv[8])
-    hadoop_hdfs_root = sys.argv[9]
-    hadoop_lib_path = sys.argv[10]   # example: '/usr/lib/hadoop-0.20'    # CDH3
-    python_bin_path = sys.argv[11]  # example: '/usr/bin/python26'        # CentOS 5
+    word_file_path = args[0]
+    document_file_path = args[1]
+    topic_num = int(args[2])
+    minibatch_size = int(args[3])
+    tau0 = float(args[4])
+    kappa = float(args[5])
+    num_mapper = int(args[6])
+    num_reducer = int(args[7])
+    hadoop_hdfs_root = args[8]
+    hadoop_lib_path = args[9]   # example: '/usr/lib/hadoop-0.20'    # CDH3
+    python_bin_path = args[10]  # example: '/usr/bin/python26'        # CentOS 5
     
     # parameter setting
-    word_num = file_len(word_file_path)
-    document_num = file_len(document_file_path)
+    # manifest is built at the first run and reused
+    manifest = DoLDA_Corpus.load_manifest(document_file_path, word_file_path)
+    word_num = manifest.word_num
+    document_num = manifest.document_num
     
     # from online lda code
     meanchangethresh = 0.001
     updatect = 0
     
-    minibatch_filename = 'BOW_LDA_minibatch_%s.txt' % minibatch_size
+    job_params = {'word_num': word_num, 'document_num': document_num, 'meanchangethresh': meanchangethresh,
+            'topic_num': topic_num, 'tau0': tau0, 'kappa': kappa, 'num_shards': num_reducer, 'num_reducer': num_reducer,
+            'dtype': options.dtype}
+    if options.gamma_store:
+        job_params['gamma_store'] = 1
+    job_params.update(dict([param.split('=', 1) for param in options.param]))
+    if '1' == job_params.get('lazy_lambda'):
+        # reducers of the jobs write all of lambda in each update
+        option_parser.error('lazy_lambda is a job parameter of OnlineLDA, DoLDA_Driver.py jobs do not support it')
+    
+    if options.local and not os.path.isdir(hadoop_hdfs_root):
+        os.makedirs(hadoop_hdfs_root)
+    
+    # each minibatch is byte ranges of the documents, or ranges of document ordinals of binary corpus
+    # local jobs read the ranges of the whole documents, uploaded once,
+    # jobs on Hadoop read the blocks of their minibatch, the blocks are uploaded once
+    if options.csr:
+        input_file_path = DoLDA_Corpus.load_csr_corpus(document_file_path, manifest)
+        job_params['input_format'] = 'csr'
+        input_format_options = ' -inputformat sequencefile'
+    else:
+        input_file_path = document_file_path
+        input_format_options = ''
+    blocks = None
+    if options.local:
+        if options.csr:
+            put_file(input_file_path + DoLDA_Corpus.INDEX_SUFFIX, hadoop_hdfs_root, options.local)
+        put_file(input_file_path, hadoop_hdfs_root, options.local)
+    else:
+        blocks = upload_blocks(manifest, input_file_path, hadoop_hdfs_root, options.block_size, options.csr)
     
     # divide the document
-    # loop
-    doc_loop_count = (document_num / minibatch_size) + 1
-    BOW_file = open(document_file_path, 'r')
+    # minibatches are sampled with document offsets of the manifest
+    sampler = DoLDA_Corpus.MinibatchSampler(manifest, minibatch_size, options.order, options.seed)
+    stager = MinibatchStager(manifest, hadoop_hdfs_root, input_file_path, options.csr, options.local, options.pipeline,
+            blocks)
     
-    job_execute_command_template = "dumbo start DoLDA_MR.py -input %s/%s -output %s/output_%s -python %s -memlimit 4294967296 -hadoop /usr -hadooplib %s -outputformat sequencefile -nummaptasks %d -getpath yes -file DoLDA_MR.py -param word_num=%s -param document_num=%s -param minibatch_size=%s -param meanchangethresh=%s -param topic_num=%s -param tau0=%s -param updatect=%s -param kappa=%s -libjar feathers.jar -hadoopconf stream.recordreader.compression=gzip -numreducetasks %d -libegg ctypedbytes-0.1.9-py2.6-linux-x86_64.egg -libegg Hadoop-0.1-py2.6.egg -cmdenv PYTHON_EGG_CACHE=/tmp/eggcache -cachefile %s/%s#_params"
+    # settings which must not change between a run and its resume
+    # the order of documents depends only on order, seed and epoch
+    run_settings = {'word_file_path': os.path.abspath(word_file_path),
+            'document_file_path': os.path.abspath(document_file_path), 'checksum': manifest.checksum,
+            'topic_num': topic_num, 'minibatch_size': minibatch_size, 'tau0': tau0, 'kappa': kappa,
+            'num_reducer': num_reducer, 'hadoop_hdfs_root': hadoop_hdfs_root,
+            'order': options.order, 'seed': options.seed, 'csr': options.csr,
+            'job_params': dict([(name, str(value)) for (name, value) in job_params.iteritems()])}
+    first_updatect = 0
+    if options.resume:
+        if not os.path.exists(options.checkpoint):
+            option_parser.error('checkpoint %s does not exist' % options.checkpoint)
+        checkpoint = read_checkpoint(options.checkpoint)
+        for (name, value) in sorted(run_settings.items()):
+            if checkpoint['settings'].get(name) != value:
+                option_parser.error('%s is different from the checkpoint, %s and %s' %
+                        (name, value, checkpoint['settings'].get(name)))
+        first_updatect = checkpoint['updatect']
+        if first_updatect > 0 and not list_parameter_files(hadoop_hdfs_root, first_updatect-1, options.local):
+            option_parser.error('parameters %s of the checkpoint do not exist' % checkpoint['parameters'])
+        sys.stderr.write('Resume from job %d\n' % first_updatect)
+    else:
+        # a failure of the first job can be resumed too, from the initial parameters
+        write_checkpoint(options.checkpoint, {'settings': run_settings, 'updatect': 0,
+                'epoch': 0, 'minibatch': 0, 'parameters': None})
     
-    #doc_loop_count = 2  # For debugging
-    doc_loop_count_m1 = doc_loop_count - 1
-    for updatect in range(0, doc_loop_count):
-        # generate new target document file
-        target_file = open(minibatch_filename, 'w')
-        
-        if doc_loop_count_m1 == updatect:
-            # last docs
-            docs_num = 0
-            for iter in range(0, minibatch_size):
-                one_doc = BOW_file.readline()
-                #print >>target_file, one_doc
-                if one_doc:
-                    # one_doc is existed
-                    docs_num += 1
-                    target_file.write(one_doc)
-                else:
-                    # reach the end line
-                    break
-            minibatch_size = docs_num
-        else:        
-            for iter in range(0, minibatch_size):
-                one_doc = BOW_file.readline()
-                target_file.write(one_doc)
-            
-        target_file.close()
-        
-        # delete and upload input file
-        subprocess.call("hadoop dfs -rm %s/%s" % (hadoop_hdfs_root, minibatch_filename), shell=True, stdout=file(os.devnull, "w"))
-        subprocess.call("hadoop dfs -copyFromLocal %s %s/" % (minibatch_filename, hadoop_hdfs_root), shell=True, stdout=file(os.devnull, "w"))
-        
+    # gamma of documents over epochs, rows are line indices
+    gamma_store = None
+    if options.gamma_store:
+        gamma_store = DoLDA_Corpus.GammaStore(options.gamma_store, manifest.line_num, topic_num, options.dtype,
+                reset=not options.resume)
+    
+    job_execute_command_template = "dumbo start DoLDA_MR.py %s -output %s/output_%s -python %s -memlimit 4294967296 -hadoop /usr -hadooplib %s -outputformat sequencefile -nummaptasks %d -getpath yes -file DoLDA_MR.py -file DoLDA_Params.py -file DoLDA_Parser.py -libjar feathers.jar -hadoopconf stream.recordreader.compression=gzip -numreducetasks %d -libegg ctypedbytes-0.1.9-py2.6-linux-x86_64.egg -libegg Hadoop-0.1-py2.6.egg -cmdenv PYTHON_EGG_CACHE=/tmp/eggcache %s %s"
+    
+    # minibatches finished before the resume are skipped
+    minibatch_num = sampler.minibatch_num()
+    minibatches = numbered_minibatches(sampler, options.epochs, first_updatect)
+    for (updatect, doc_indices, minibatch_params, input_cachefiles, input_filenames) in stager.staged(minibatches):
          # parameter lambda, alpha, eta
         if 0 == updatect:
-            lambda_target_filename = init_parameters(topic_num, word_num, hadoop_hdfs_root)
+            parameter_filenames = [init_parameters(topic_num, word_num, hadoop_hdfs_root, options.dtype, options.local,
+                    '1' == str(job_params.get('column_store', '0')))]
         else:
-            lambda_target_filename = 'output_%d/parameters/parameters' % (updatect-1)
-     
+            # lambda is sharded over the reducers of the previous job
+            parameter_filenames = list_parameter_files(hadoop_hdfs_root, updatect-1, options.local)
+        cachefiles = parameter_cachefiles(parameter_filenames) + input_cachefiles
+        
+        minibatch_job_params = dict(job_params)
+        minibatch_job_params.update(minibatch_params)
+        
+        # gamma of documents visited before is sent to mappers
+        gamma_cachefiles = []
+        if gamma_store is not None:
+            (visited, gamma) = gamma_store.get(doc_indices)
+            if len(visited) > 0:
+                gamma_filename = 'BOW_LDA_gamma_init_%d.npz' % updatect
+                numpy.savez(gamma_filename, positions=document_positions(manifest, visited, options.csr), gamma=gamma)
+                put_file(gamma_filename, hadoop_hdfs_root, options.local)
+                os.remove(gamma_filename)
+                gamma_cachefiles.append((gamma_filename, '_gamma_init'))
+                minibatch_job_params['gamma_init_file'] = '_gamma_init'
+        cachefiles += gamma_cachefiles
+        staged_filenames = [filename for (filename, link_name) in input_cachefiles + gamma_cachefiles]
+        
         # job execute
-        job_execute_command = job_execute_command_template % (hadoop_hdfs_root, minibatch_filename, hadoop_hdfs_root, str(updatect), python_bin_path, hadoop_lib_path, num_mapper, str(word_num), str(document_num), str(minibatch_size), str(meanchangethresh), str(topic_num), str(tau0), str(updatect), str(kappa), num_reducer, hadoop_hdfs_root, lambda_target_filename)
-        subprocess.call(job_execute_command, shell=True, stdout=file(os.devnull, "w"))
+        # a failed job is run again from the same parameters
+        for attempt in range(0, options.retries + 1):
+            remove_output(hadoop_hdfs_root, updatect, options.local)
+            if options.local:
+                try:
+                    DoLDA_Local.run_job([os.path.join(hadoop_hdfs_root, filename) for filename in input_filenames],
+                            os.path.join(hadoop_hdfs_root, 'output_%d' % updatect),
+                            dict([(name, str(value)) for (name, value) in minibatch_job_params.iteritems()]),
+                            num_mapper, num_reducer,
+                            [(os.path.join(hadoop_hdfs_root, filename), link_name) for (filename, link_name) in cachefiles])
+                    returncode = 0
+                except Exception, e:
+                    sys.stderr.write('Job %d: %s\n' % (updatect, e))
+                    returncode = 1
+            else:
+                job_execute_command = job_execute_command_template % (input_options(hadoop_hdfs_root, input_filenames), hadoop_hdfs_root, str(updatect), python_bin_path, hadoop_lib_path, num_mapper, num_reducer, param_options(minibatch_job_params), cachefile_options(hadoop_hdfs_root, cachefiles))
+                job_execute_command += input_format_options
+                returncode = subprocess.call(job_execute_command, shell=True, stdout=file(os.devnull, "w"))
+            
+            if 0 == returncode and list_parameter_files(hadoop_hdfs_root, updatect, options.local):
+                break
+            sys.stderr.write('Job %d failed, attempt %d of %d\n' % (updatect, attempt + 1, options.retries + 1))
+        else:
+            # ranges and gamma files of the failed job are staged again by --resume
+            stager.finished(staged_filenames)
+            stager.remove_finished()
+            sys.exit('Job %d failed, run again with --resume to continue from it' % updatect)
         
         # job finish
-        
-    BOW_file.close()
+        stager.finished(staged_filenames)
+        if gamma_store is not None:
+            (positions, gamma) = fetch_gamma(hadoop_hdfs_root, updatect, topic_num, options.dtype, options.local)
+            gamma_store.put(position_indices(manifest, positions, options.csr), gamma)
+        # next run with --resume starts from the next minibatch
+        write_checkpoint(options.checkpoint, {'settings': run_settings, 'updatect': updatect + 1,
+                'epoch': (updatect + 1) / minibatch_num, 'minibatch': (updatect + 1) % minibatch_num,
+                'parameters': 'output_%d/parameters' % updatect})
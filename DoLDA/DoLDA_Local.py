@@ -0,0 +1,352 @@
+#!/usr/bin/python26
+
+'''
+Distributed Online Learning for Topic Models
+JinYeong Bak, Dongwoo Kim, Alice Oh
+http://uilab.kaist.ac.kr/research/DoLDA
+
+Local MapReduce runner of DoLDA_MR.py without Hadoop.
+It drives Mapper, Combiner and Reducer of DoLDA_MR.py with the same params dict as dumbo.
+Map tasks and reduce tasks run in a process pool.
+Map outputs are partitioned by reducer as DoLDA_MR.partition does, combined, sorted and spilled to local disk,
+and each reduce task merges the sorted spills of its partition.
+Outputs are written like dumbo with -getpath yes and -outputformat sequencefile,
+output_dir/<path>/part-<reducer>.
+'''
+
+import os
+import sys
+import shutil
+import heapq
+import itertools
+import tempfile
+import multiprocessing
+import cPickle as pickle
+from hadoop.io import SequenceFile
+from hadoop.typedbytes import TypedBytesWritable
+
+import DoLDA_MR
+import DoLDA_Corpus
+
+# map output records kept in memory before they are combined and spilled
+SPILL_RECORDS = 100000
+
+
+def job_class(base_class, params):
+    '''
+    Return subclass of base_class with params, as dumbo does
+    '''
+    return type(base_class)(base_class.__name__, (base_class,), {'params': params})
+
+
+def pack_splits(path_ranges, split_num):
+    '''
+    Pack ranges into about split_num splits of similar size
+    Return [(path, [(start, end), ...]), ...], each split reads ranges of one file
+
+    path_ranges - [(path, start, end), ...]
+    Small ranges are packed into one split, large ranges are cut into several splits
+    '''
+    total_size = sum([end - start for (path, start, end) in path_ranges])
+    split_size = max(1, total_size / max(1, split_num))
+
+    splits = []
+    (split_path, split_ranges, size) = (None, [], 0)
+    for (path, range_start, range_end) in path_ranges:
+        for start in range(range_start, range_end, split_size):
+            end = min(start + split_size, range_end)
+            if path != split_path or size >= split_size:
+                if split_ranges:
+                    splits.append((split_path, split_ranges))
+                (split_path, split_ranges, size) = (path, [], 0)
+            split_ranges.append((start, end))
+            size += end - start
+    if split_ranges:
+        splits.append((split_path, split_ranges))
+    return splits
+
+
+def text_splits(paths, split_num, input_ranges=None):
+    '''
+    Split text files into about split_num splits of byte ranges
+
+    input_ranges - [(start, end), ...] byte ranges to read, None for whole files
+                   a block file of DoLDA_Driver.py has the ranges from its first byte offset
+    '''
+    path_ranges = []
+    for path in paths:
+        file_size = os.path.getsize(path)
+        file_start = DoLDA_MR.block_start(path)
+        for (start, end) in (input_ranges or [(file_start, file_start + file_size)]):
+            (start, end) = (max(start - file_start, 0), min(end - file_start, file_size))
+            if end > start:
+                path_ranges.append((path, start, end))
+    return pack_splits(path_ranges, split_num)
+
+
+def record_splits(paths, split_num, input_ranges=None):
+    '''
+    Split binary corpora of DoLDA_Corpus.py into about split_num splits
+    Ranges of splits are positions of records
+
+    input_ranges - [(first, last), ...] ranges of document ordinals in each file, None for whole files
+    A block file of DoLDA_Driver.py has no index, it is one split and mappers skip records out of the ranges
+    '''
+    path_ranges = []
+    indexes = dict()
+    block_splits = []
+    for path in paths:
+        if not os.path.exists(path + DoLDA_Corpus.INDEX_SUFFIX):
+            reader = SequenceFile.Reader(path)
+            block_splits.append((path, [(reader.getPosition(), os.path.getsize(path))]))
+            reader.close()
+            continue
+        indexes[path] = DoLDA_Corpus.read_record_index(path)
+        doc_num = len(indexes[path]) - 1
+        for (first, last) in (input_ranges or [(0, doc_num)]):
+            if min(last, doc_num) > first:
+                path_ranges.append((path, first, min(last, doc_num)))
+
+    return [(path, [(int(indexes[path][first]), int(indexes[path][last])) for (first, last) in split_ranges])
+            for (path, split_ranges) in pack_splits(path_ranges, split_num)] + block_splits
+
+
+def read_text_split(split):
+    '''
+    Generate (byte offset, line) of lines starting in byte ranges of split, like TextInputFormat
+    '''
+    (path, split_ranges) = split
+    input_file = open(path, 'rb')
+    for (start, end) in split_ranges:
+        if start > 0:
+            # skip the line started before the range
+            input_file.seek(start - 1)
+            input_file.readline()
+        else:
+            input_file.seek(0)
+        while True:
+            position = input_file.tell()
+            if position >= end:
+                break
+            line = input_file.readline()
+            if not line:
+                break
+            yield (position, line.rstrip('\r\n'))
+    input_file.close()
+
+
+def read_record_split(split):
+    '''
+    Generate (doc_id, binary document) of records in ranges of split
+    '''
+    (path, split_ranges) = split
+    reader = SequenceFile.Reader(path)
+    key_instance = reader.getKeyClass()()
+    value_instance = reader.getValueClass()()
+    for (start, end) in split_ranges:
+        reader.seek(start)
+        while reader.getPosition() < end and reader.next(key_instance, value_instance):
+            yield (key_instance.toString(), value_instance.toString())
+    reader.close()
+
+
+def write_run(path, records):
+    '''
+    Write sorted records into a spill file
+    '''
+    run_file = open(path, 'wb')
+    for record in sorted(records, key=lambda record: record[0]):
+        pickle.dump(record, run_file, pickle.HIGHEST_PROTOCOL)
+    run_file.close()
+
+
+def read_run(path):
+    '''
+    Generate records of a spill file
+    '''
+    run_file = open(path, 'rb')
+    while True:
+        try:
+            yield pickle.load(run_file)
+        except EOFError:
+            break
+    run_file.close()
+
+
+def group_values(records):
+    '''
+    Generate (key, values) of records, like the input of combiner
+    '''
+    groups = dict()
+    for (key, value) in records:
+        groups.setdefault(key, []).append(value)
+    return groups.iteritems()
+
+
+class MapTask(object):
+    '''
+    One map task with combiner
+    Outputs are partitioned, combined and spilled
+    '''
+    def __init__(self, params, task_idx, reducer_num, spill_dir):
+        # task number, as Hadoop streaming gives it in mapred_task_partition
+        self._mapper = job_class(DoLDA_MR.Mapper, dict(params, task_partition=str(task_idx)))()
+        self._combiner = job_class(DoLDA_MR.Combiner, params)()
+        self._task_idx = task_idx
+        self._reducer_num = reducer_num
+        self._spill_dir = spill_dir
+        self._spill_num = 0
+        self._buffer = []
+
+    def collect(self, outputs):
+        for output in outputs:
+            self._buffer.append(output)
+            if len(self._buffer) >= SPILL_RECORDS:
+                self.spill()
+
+    def spill(self):
+        '''
+        Partition buffered records, combine each partition and write one sorted run for each
+        '''
+        partitions = [[] for reducer_idx in range(0, self._reducer_num)]
+        for (key, value) in self._buffer:
+            partitions[DoLDA_MR.partition(key, self._reducer_num)].append((key, value))
+        self._buffer = []
+
+        for reducer_idx in range(0, self._reducer_num):
+            combined = []
+            for (key, values) in group_values(partitions[reducer_idx]):
+                combined.extend(self._combiner(key, values))
+            if combined:
+                write_run(os.path.join(self._spill_dir, 'map-%05d-%05d-%05d' %
+                        (self._task_idx, self._spill_num, reducer_idx)), combined)
+        self._spill_num += 1
+
+    def run(self, records):
+        for (key, value) in records:
+            self.collect(self._mapper(key, value))
+        if hasattr(self._mapper, 'close'):
+            self.collect(self._mapper.close())
+        self.spill()
+
+
+def run_map_task(task):
+    '''
+    Run one map task in a worker process
+    task - (params, task_idx, split, reducer_num, spill_dir)
+    '''
+    (params, task_idx, split, reducer_num, spill_dir) = task
+    # input file of the task, as Hadoop streaming gives it in map_input_file
+    os.environ['map_input_file'] = split[0]
+    if 'csr' == params.get('input_format'):
+        records = read_record_split(split)
+    else:
+        records = read_text_split(split)
+    MapTask(params, task_idx, reducer_num, spill_dir).run(records)
+    return task_idx
+
+
+def run_reduce_task(task):
+    '''
+    Run one reduce task in a worker process
+    Merge sorted spills of the partition and write outputs
+    task - (params, reducer_idx, spill_paths, output_dir)
+    '''
+    (params, reducer_idx, spill_paths, output_dir) = task
+    reducer = job_class(DoLDA_MR.Reducer, params)()
+
+    records = heapq.merge(*[read_run(spill_path) for spill_path in spill_paths])
+    outputs = []
+    for (key, key_records) in itertools.groupby(records, lambda record: record[0]):
+        outputs.extend(reducer(key, (value for (each_key, value) in key_records)))
+    if hasattr(reducer, 'close'):
+        outputs.extend(reducer.close())
+
+    # -getpath yes, key is (path, key)
+    writers = dict()
+    for ((path, key), value) in outputs:
+        if path not in writers:
+            path_dir = os.path.join(output_dir, str(path))
+            try:
+                os.makedirs(path_dir)
+            except OSError:
+                # made by another reduce task at the same time
+                if not os.path.isdir(path_dir):
+                    raise
+            writers[path] = SequenceFile.createWriter(os.path.join(path_dir, 'part-%05d' % reducer_idx),
+                    TypedBytesWritable, TypedBytesWritable)
+        output_key = TypedBytesWritable()
+        output_value = TypedBytesWritable()
+        output_key.set(str(key))
+        output_value.set(str(value))
+        writers[path].append(output_key, output_value)
+    for writer in writers.itervalues():
+        writer.close()
+    return reducer_idx
+
+
+def link_cachefiles(task_dir, cachefiles):
+    '''
+    Link cache files into the working directory of tasks, like distributed cache
+    cachefiles - [(path, link name), ...]
+    '''
+    for (path, link_name) in cachefiles:
+        os.symlink(os.path.abspath(path), os.path.join(task_dir, link_name))
+
+
+def run_job(input_paths, output_dir, params, num_mapper, num_reducer, cachefiles=()):
+    '''
+    Run one DoLDA_MR.py job locally
+
+    input_paths - text input files, or binary corpora of DoLDA_Corpus.py with input_format=csr
+    output_dir - output directory, it must not exist
+    params - job parameters, {name: string value}
+    cachefiles - [(path, link name), ...] linked into the working directory of tasks
+    '''
+    if os.path.exists(output_dir):
+        raise IOError('Output directory %s already exists' % output_dir)
+    os.makedirs(output_dir)
+
+    # tasks run in task_dir
+    input_paths = [os.path.abspath(input_path) for input_path in input_paths]
+    output_dir = os.path.abspath(output_dir)
+    task_dir = tempfile.mkdtemp(prefix='DoLDA_job_')
+    spill_dir = os.path.join(task_dir, '_spill')
+    os.mkdir(spill_dir)
+    link_cachefiles(task_dir, cachefiles)
+
+    pool = multiprocessing.Pool(max(num_mapper, num_reducer), initializer=os.chdir, initargs=(task_dir,))
+    try:
+        # map
+        # only the minibatch is read when it is given as ranges
+        input_ranges = DoLDA_MR.read_input_ranges(params, task_dir)
+        if 'csr' == params.get('input_format'):
+            splits = record_splits(input_paths, num_mapper, input_ranges or None)
+        else:
+            splits = text_splits(input_paths, num_mapper, input_ranges or None)
+        pool.map(run_map_task, [(params, task_idx, split, num_reducer, spill_dir)
+                for (task_idx, split) in enumerate(splits)])
+
+        # reduce
+        spill_names = sorted(os.listdir(spill_dir))
+        reduce_tasks = []
+        for reducer_idx in range(0, num_reducer):
+            spill_paths = [os.path.join(spill_dir, spill_name) for spill_name in spill_names
+                    if spill_name.endswith('-%05d' % reducer_idx)]
+            reduce_tasks.append((params, reducer_idx, spill_paths, output_dir))
+        pool.map(run_reduce_task, reduce_tasks)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(task_dir)
+
+
+# main function start
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        sys.exit('Usage: %s input_path output_dir parameter_file [name=value ...]' % sys.argv[0])
+
+    job_params = dict([job_param.split('=', 1) for job_param in sys.argv[4:]])
+    run_job([sys.argv[1]], sys.argv[2], job_params,
+            int(job_params.get('num_mapper', '1')), int(job_params.get('num_reducer', '1')),
+            [(sys.argv[3], '_params_0')])
@@ -11,56 +11,271 @@ It tests on CentOS 5, Cloudera CDH3, Hadoop 0.20.2 and Python 2.6.8.
 When you got troubles to run this code, please contact to Author (jy.bak@kaist.ac.kr).
 '''
 
-import dumbo
 import sys
 import numpy
 from scipy.special import psi, gammaln, polygamma
-import re
+import scipy.sparse
 import json
-from hadoop.io import SequenceFile
-from hadoop.typedbytes import TypedBytesWritable
+import os
+import struct
+import bisect
+import re
+import zlib
+import base64
+import threading
+import multiprocessing.dummy
+import DoLDA_Params
+import DoLDA_Parser
+
+# word ids and counts of binary corpus
+# ordinal of document, number of words, word ids, word counts
+DOCUMENT_DTYPE = numpy.dtype('<i4')
+
+# dense iterations of sparse e step before topics are dropped
+SPARSE_WARMUP = 3
+
+# block file of the documents, checksum prefix, positions of its first and after its last document, suffix
+# positions are byte offsets of text or ordinals of binary corpus
+BLOCK_FILENAME = 'BOW_LDA_block_%s_%d-%d%s'
+BLOCK_PATTERN = re.compile(r'^BOW_LDA_block_[0-9a-f]+_(\d+)-(\d+)')
+
+
+def pack_document(ordinal, ids, cts):
+    '''
+    Return binary value of one document
+    '''
+    return numpy.concatenate(([ordinal, len(ids)], ids, cts)).astype(DOCUMENT_DTYPE).tostring()
+
+
+def unpack_document(value):
+    '''
+    Return (ordinal, ids, cts) of binary value of one document
+    ids and cts are arrays, no text is parsed
+    '''
+    record = numpy.fromstring(value, dtype=DOCUMENT_DTYPE)
+    word_num = record[1]
+    return (int(record[0]), record[2:2 + word_num], record[2 + word_num:2 + 2 * word_num])
+
+
+def hadoop_hash(data, value=1):
+    '''
+    Return hash of BytesWritable of data as Hadoop computes it, 32 bit unsigned
+    value - hash of the bytes before data
+    '''
+    for byte in struct.unpack('%db' % len(data), data):
+        value = (31 * value + byte) & 0xffffffff
+    return value
+
+
+def sstats_key(shard, reducer_num):
+    '''
+    Return key of sstats of shard, ('sstats_sum', shard, salt)
+    HashPartitioner of Hadoop sends a key to the reducer of the hash of its typed bytes,
+    salt is the first number which sends the key to reducer shard modulo reducer_num.
+    Typed bytes of the key are those of dumbo, a vector of a string and two ints.
+    '''
+    prefix_hash = hadoop_hash(struct.pack('>BiBi', 8, 3, 7, len('sstats_sum')) + 'sstats_sum' +
+            struct.pack('>Bi', 3, shard))
+    salt = 0
+    while (hadoop_hash(struct.pack('>Bi', 3, salt), prefix_hash) & 0x7fffffff) % reducer_num != \
+            shard % reducer_num:
+        salt += 1
+    return ('sstats_sum', shard, salt)
+
+
+def partition(key, reducer_num):
+    '''
+    Return reducer of a map output key
+    sstats of a shard go to reducer shard modulo reducer_num, as sstats_key makes Hadoop do
+    '''
+    if isinstance(key, tuple) and 'sstats_sum' == key[0]:
+        return key[1] % reducer_num
+    return hash(key) % reducer_num
+
+
+def block_start(path):
+    '''
+    Return position of the first document of block file path, 0 for other files
+    '''
+    match = BLOCK_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return 0
+    return int(match.group(1))
+
+
+def pack_input_ranges(input_ranges):
+    '''
+    Return input_ranges_packed job parameter of sorted [(start, end), ...] ranges,
+    differences of the bounds compressed and base64 encoded
+    '''
+    bounds = numpy.array(input_ranges, dtype=numpy.int64).ravel()
+    differences = numpy.diff(numpy.concatenate(([0], bounds))).astype('<i8')
+    return base64.urlsafe_b64encode(zlib.compress(differences.tostring(), 9))
+
+
+def unpack_input_ranges(value):
+    '''
+    Return sorted [(start, end), ...] of input_ranges_packed job parameter
+    '''
+    if not value:
+        return []
+    bounds = numpy.cumsum(numpy.fromstring(zlib.decompress(base64.urlsafe_b64decode(value)), dtype='<i8'))
+    return [(int(start), int(end)) for (start, end) in bounds.reshape(-1, 2)]
+
+
+def format_input_ranges(input_ranges):
+    '''
+    Return input_ranges job parameter of [(start, end), ...] ranges
+    '''
+    return ','.join(['%d-%d' % (start, end) for (start, end) in input_ranges])
+
+
+def parse_input_ranges(value):
+    '''
+    Return sorted [(start, end), ...] of input_ranges job parameter
+    '''
+    input_ranges = []
+    for each_range in value.split(','):
+        if each_range:
+            (start, end) = each_range.split('-')
+            input_ranges.append((int(start), int(end)))
+    return sorted(input_ranges)
+
+
+def read_input_ranges(params, directory='.'):
+    '''
+    Return sorted [(start, end), ...] ranges of the minibatch
+    They are byte ranges of text input, or ranges of document ordinals of binary input
+    They are given by input_ranges job parameter, packed ranges of input_ranges_packed job parameter,
+    or by a .npy file of start and end pairs whose name in directory is input_ranges_file job parameter
+    '''
+    input_ranges = parse_input_ranges(params.get('input_ranges', ''))
+    input_ranges.extend(unpack_input_ranges(params.get('input_ranges_packed', '')))
+    if params.get('input_ranges_file'):
+        ranges_file = open(os.path.join(directory, params['input_ranges_file']), 'rb')
+        input_ranges.extend([(int(start), int(end)) for (start, end) in numpy.load(ranges_file).reshape(-1, 2)])
+        ranges_file.close()
+        input_ranges.sort()
+    return input_ranges
+
 
 # E step
 class Mapper:
-    def __init__(self):
-        numpy.random.seed(100000001)
+    def __init__(self, parameters=None):
+        '''
+        parameters - {name: value} of new_alpha, new_psi_lambda and new_lambda_sum,
+                     None to load them from distributed cache
+        '''
+        # random initial gamma, the global random state of the caller is not touched
+        self._random = numpy.random.RandomState(100000001)
         
         self._word_num = int(self.params['word_num'])
         self._meanchangethresh = float(self.params['meanchangethresh'])
         self._topic_num = int(self.params['topic_num'])
         
+        # Floating point type of lambda, gamma and sstats
+        self._dtype = numpy.dtype(self.params.get('dtype', 'float64'))
+        # added to phi normalizer, it must not underflow in self._dtype
+        self._phinorm_eps = max(1e-100, numpy.finfo(self._dtype).tiny)
+        
+        # Number of documents processed together in one E step
+        # 1 means one document at a time
+        self._batch_size = int(self.params.get('batch_size', '1'))
+        self._batch = []
+        
+        # sstats are emitted separately for each vocabulary shard, keyed for the reducer of the shard
+        self._shard_num = int(self.params.get('num_shards', '1'))
+        self._shard_los = numpy.array([lo for (lo, hi) in
+                DoLDA_Params.shard_bounds(self._word_num, self._shard_num)])
+        reducer_num = int(self.params.get('num_reducer', str(self._shard_num)))
+        self._sstats_keys = [sstats_key(shard, reducer_num) for shard in range(0, self._shard_num)]
+        
+        # Sparse e step, topics whose share of expElogthetad is below sparse_topic_threshold are skipped
+        # It falls back to dense iterations when more than sparse_max_active of topics are active
+        # 0 means dense e step
+        self._sparse_threshold = float(self.params.get('sparse_topic_threshold', '0'))
+        self._sparse_max_active = float(self.params.get('sparse_max_active', '0.5'))
+        if self._sparse_threshold > 0 and self._batch_size > 1:
+            # e_step_batch iterates all topics of the batch together
+            raise ValueError('sparse_topic_threshold needs batch_size 1, batch_size is %d' % self._batch_size)
+        # number of documents with sparse e step, and those which never left dense iterations
+        self.sparse_doc_num = 0
+        self.dense_fallback_num = 0
+        self._counter_lock = threading.Lock()
+        
+        # Number of threads running e step of buffered documents, they share the parameters
+        # Each thread runs batch_size documents at a time
+        self._thread_num = int(self.params.get('e_step_threads', '1'))
+        self._thread_pool = None
+        if self._thread_num > 1:
+            self._thread_pool = multiprocessing.dummy.Pool(self._thread_num)
+        
+        # Number of text lines parsed together
+        self._parse_chunk_size = int(self.params.get('parse_chunk_size', '1000'))
+        self._lines = []
+        self._line_keys = []
+        
+        # gamma of each document is sent to the reducer by its position,
+        # byte offset of text or ordinal of binary corpus, for the gamma store of DoLDA_Driver.py
+        self._gamma_store = '1' == self.params.get('gamma_store', '0')
+        # gamma of the last visit of documents, .npz file of positions and gamma in the task directory
+        # E step of those documents starts from it instead of a random gamma
+        self._init_positions = numpy.zeros(0, dtype=numpy.int64)
+        self._init_gamma = numpy.zeros((0, self._topic_num), dtype=self._dtype)
+        if self.params.get('gamma_init_file'):
+            gamma_init = numpy.load(self.params['gamma_init_file'])
+            self._init_positions = gamma_init['positions']
+            self._init_gamma = gamma_init['gamma'].astype(self._dtype)
+        
+        # Perplexity bound is computed only every bound_interval updates, never with 0,
+        # and only on a bound_fraction of randomly chosen documents
+        updatect = int(self.params.get('updatect', '0'))
+        bound_interval = int(self.params.get('bound_interval', '1'))
+        self._compute_bound = bound_interval > 0 and (0 == updatect % bound_interval)
+        self._bound_fraction = float(self.params.get('bound_fraction', '1.0'))
+        # each map task samples its own documents, with the task number Hadoop streaming exports
+        task_partition = int(self.params.get('task_partition', os.environ.get('mapred_task_partition', '0')))
+        self._bound_random = numpy.random.RandomState([100000001 + updatect, task_partition])
+        
+        # text, or csr for binary corpus of DoLDA_Corpus.py
+        self._input_format = self.params.get('input_format', 'text')
+        
+        # Minibatch is given as byte ranges of the whole corpus, or ordinal ranges of binary corpus
+        # Documents out of the ranges are skipped, no range means all documents
+        input_ranges = read_input_ranges(self.params)
+        self._range_starts = [start for (start, end) in input_ranges]
+        self._range_ends = [end for (start, end) in input_ranges]
+        # Input is the whole corpus or its block files, with the input file name Hadoop streaming exports
+        # Byte offsets in a block of text start from the offset of the block, records of binary corpus keep ordinals
+        self._input_start = 0
+        if 'csr' != self._input_format:
+            self._input_start = block_start(self.params.get('input_file',
+                    os.environ.get('map_input_file', os.environ.get('mapreduce_map_input_file', ''))))
+        
         # Load parameter from distributed cache
-        parameter_reader = SequenceFile.Reader('./_params')
-        key_class = parameter_reader.getKeyClass()
-        value_class = parameter_reader.getValueClass()
-        key_instance = key_class()
-        value_instance = value_class()
-        
-        while parameter_reader.next(key_instance, value_instance):
-            key_instance_str = key_instance.toString()
-            if 'new_alpha' == key_instance_str:
-                # For alpha
-                self._alpha = value_instance.toString()
-                self._alpha = numpy.fromstring(self._alpha)
-                self._alpha.shape = self._topic_num
-            elif 'new_lambda' == key_instance_str:
-                # For lambda
-                self._lambda = value_instance.toString()
-                self._lambda = numpy.fromstring(self._lambda)
-                self._lambda.shape = (self._topic_num, self._word_num)
-            elif 'new_eta' == key_instance_str:
-                # For eta
-                # loading useless
-                continue
-            else:
-                # Error
-                sys.stderr.write("Something wrong in parameter_reader\n")
-                sys.exit(1)
+        # lambda can be split into several files, one for each reducer
+        # psi(lambda) and row sums of lambda are computed once by the reducers,
+        # so E[log beta] of a word only needs a subtraction
+        # With shared_cache, tasks of a node share one decoded copy in shared_cache_dir
+        if parameters is None and '1' == self.params.get('shared_cache', '0'):
+            parameters = DoLDA_Params.read_shared_parameters(DoLDA_Params.parameter_paths(),
+                    self._topic_num, self._word_num, ('new_alpha', 'new_psi_lambda', 'new_lambda_sum'),
+                    self._dtype, self.params.get('shared_cache_dir', '/dev/shm'),
+                    int(self.params.get('shared_cache_ttl', '3600')))
+        elif parameters is None:
+            parameters = DoLDA_Params.read_parameters(DoLDA_Params.parameter_paths(),
+                    self._topic_num, self._word_num,
+                    names=('new_alpha', 'new_psi_lambda', 'new_lambda_sum'), dtype=self._dtype)
+        self._alpha = parameters['new_alpha'].astype(self._dtype)
+        self._psi_lambda = parameters['new_psi_lambda']
+        self._psi_lambda_sum = psi(parameters['new_lambda_sum']).astype(self._dtype)
         
-        parameter_reader.close()
         
-        self._Elogbeta = self.dirichlet_expectation(self._lambda)
-        self._expElogbeta = numpy.exp(self._Elogbeta)
+    def Elogbeta_columns(self, ids):
+        '''
+        E[log beta] of word ids
+        '''
+        return self._psi_lambda.take(ids) - self._psi_lambda_sum[:, numpy.newaxis]
         
         
     def dirichlet_expectation(self, alpha):
@@ -78,11 +293,12 @@ class Mapper:
         Do e step
         It comes from online LDA
         '''
+        cts = numpy.asarray(cts, dtype=self._dtype)
         # The optimal phi_{dwk} is proportional to 
         # expElogthetad_k * expElogbetad_w. phinorm is the normalizer.
         Elogthetad = self.dirichlet_expectation(gammad)
         expElogthetad = numpy.exp(Elogthetad)
-        phinorm = numpy.dot(expElogthetad, expElogbetad) + 1e-100   # scalar
+        phinorm = numpy.dot(expElogthetad, expElogbetad) + self._phinorm_eps   # scalar
         # Iterate between gamma and phi until convergence
         for it in range(0, 100):
             lastgamma = gammad
@@ -93,7 +309,7 @@ class Mapper:
                 numpy.dot(cts / phinorm, expElogbetad.T)    # inner product with n_1 w_1
             Elogthetad = self.dirichlet_expectation(gammad)
             expElogthetad = numpy.exp(Elogthetad)
-            phinorm = numpy.dot(expElogthetad, expElogbetad) + 1e-100
+            phinorm = numpy.dot(expElogthetad, expElogbetad) + self._phinorm_eps
             # If gamma hasn't changed much, we're done.
             meanchange = numpy.mean(abs(gammad - lastgamma))
             if (meanchange < self._meanchangethresh):
@@ -105,65 +321,453 @@ class Mapper:
         return (gammad, sstats, Elogthetad)
         
         
+    def e_step_document(self, ids, cts, gammad, expElogbetad):
+        '''
+        Do e step of one document, sparse or dense by sparse_topic_threshold
+        '''
+        if self._sparse_threshold > 0.:
+            return self.e_step_sparse(ids, cts, gammad, expElogbetad)
+        return self.e_step(ids, cts, gammad, expElogbetad)
+        
+        
+    def e_step_sparse(self, ids, cts, gammad, expElogbetad):
+        '''
+        Do e step only on active topics of the document
+        Topics whose share of expElogthetad is below the threshold are dropped from phinorm and the gamma update,
+        their gamma is alpha and their sstats are 0.
+        Active topics are chosen again in each iteration after SPARSE_WARMUP dense iterations.
+        phinorm is computed again over the new active topics whenever they change.
+        When the sparse iterations converge, one dense iteration checks them,
+        if gamma still moves over all topics the document stays in dense iterations until it converges.
+        '''
+        cts = numpy.asarray(cts, dtype=self._dtype)
+        max_active = self._sparse_max_active * self._topic_num
+        active = numpy.arange(self._topic_num)
+        is_sparse = False
+        # active topics are chosen from this iteration
+        warmup_end = SPARSE_WARMUP
+        
+        Elogthetad = self.dirichlet_expectation(gammad)
+        expElogthetad = numpy.exp(Elogthetad)
+        phinorm = numpy.dot(expElogthetad, expElogbetad) + self._phinorm_eps
+        for it in range(0, 100):
+            lastgamma = gammad
+            if it >= warmup_end:
+                candidates = numpy.flatnonzero(expElogthetad >= self._sparse_threshold * numpy.sum(expElogthetad))
+                if len(candidates) <= max_active:
+                    if not is_sparse or len(candidates) != len(active) or numpy.any(candidates != active):
+                        active = candidates
+                        expElogbeta_active = expElogbetad[active]
+                        phinorm = numpy.dot(expElogthetad[active], expElogbeta_active) + self._phinorm_eps
+                    is_sparse = True
+                elif is_sparse:
+                    active = numpy.arange(self._topic_num)
+                    is_sparse = False
+                    phinorm = numpy.dot(expElogthetad, expElogbetad) + self._phinorm_eps
+            
+            if is_sparse:
+                gammad = self._alpha.copy()
+                gammad[active] += expElogthetad[active] * numpy.dot(cts / phinorm, expElogbeta_active.T)
+            else:
+                gammad = self._alpha + expElogthetad * numpy.dot(cts / phinorm, expElogbetad.T)
+            Elogthetad = self.dirichlet_expectation(gammad)
+            expElogthetad = numpy.exp(Elogthetad)
+            if is_sparse:
+                phinorm = numpy.dot(expElogthetad[active], expElogbeta_active) + self._phinorm_eps
+            else:
+                phinorm = numpy.dot(expElogthetad, expElogbetad) + self._phinorm_eps
+            meanchange = numpy.mean(abs(gammad - lastgamma))
+            if (meanchange < self._meanchangethresh):
+                if not is_sparse:
+                    break
+                # check the sparse result with one dense iteration
+                densephinorm = numpy.dot(expElogthetad, expElogbetad) + self._phinorm_eps
+                densegamma = self._alpha + expElogthetad * numpy.dot(cts / densephinorm, expElogbetad.T)
+                if numpy.mean(abs(densegamma - gammad)) < self._meanchangethresh:
+                    break
+                gammad = densegamma
+                Elogthetad = self.dirichlet_expectation(gammad)
+                expElogthetad = numpy.exp(Elogthetad)
+                phinorm = numpy.dot(expElogthetad, expElogbetad) + self._phinorm_eps
+                active = numpy.arange(self._topic_num)
+                is_sparse = False
+                warmup_end = 100
+        
+        self._counter_lock.acquire()
+        self.sparse_doc_num += 1
+        if len(active) == self._topic_num:
+            self.dense_fallback_num += 1
+        self._counter_lock.release()
+        
+        sstats = numpy.zeros((self._topic_num, len(cts)), dtype=expElogthetad.dtype)
+        sstats[active] = numpy.outer(expElogthetad[active], cts/phinorm)
+        
+        return (gammad, sstats, Elogthetad)
+        
+        
+    def e_step_batch(self, ids_list, cts_list, gamma):
+        '''
+        Do e step for several documents at once
+        Documents are concatenated into one CSR matrix of word counts,
+        and each document drops out of the active set
+        when its own gamma has converged.
+        
+        ids_list - word ids of each document
+        cts_list - word counts of each document
+        gamma - initial gamma of each document. doc_num x topic_num
+        '''
+        doc_num = len(ids_list)
+        doc_lens = numpy.array([len(ids) for ids in ids_list], dtype=numpy.int64)
+        indptr = numpy.zeros(doc_num + 1, dtype=numpy.int64)
+        indptr[1:] = numpy.cumsum(doc_lens)
+        token_num = int(indptr[-1])
+        token_doc = numpy.repeat(numpy.arange(doc_num), doc_lens)
+        
+        flat_ids = numpy.zeros(token_num, dtype=numpy.int64)
+        flat_cts = numpy.zeros(token_num, dtype=self._dtype)
+        for d in range(0, doc_num):
+            flat_ids[indptr[d]:indptr[d+1]] = ids_list[d]
+            flat_cts[indptr[d]:indptr[d+1]] = cts_list[d]
+        
+        # token_num x topic_num, each row is expElogbeta of one token
+        expElogbetad = numpy.ascontiguousarray(numpy.exp(self.Elogbeta_columns(flat_ids)).T)
+        
+        Elogtheta = self.dirichlet_expectation(gamma)
+        expElogtheta = numpy.exp(Elogtheta)
+        phinorm = numpy.sum(expElogtheta[token_doc] * expElogbetad, 1) + self._phinorm_eps
+        
+        is_active = numpy.ones(doc_num, dtype=bool)
+        active = numpy.arange(doc_num)
+        # Iterate between gamma and phi until convergence
+        for it in range(0, 100):
+            tokens = numpy.flatnonzero(is_active[token_doc])
+            active_indptr = numpy.zeros(len(active) + 1, dtype=numpy.int64)
+            active_indptr[1:] = numpy.cumsum(doc_lens[active])
+            
+            lastgamma = gamma[active]
+            # Same update as e_step, for all active documents at once
+            cts_phinorm = scipy.sparse.csr_matrix(
+                (flat_cts[tokens] / phinorm[tokens], tokens, active_indptr),
+                shape=(len(active), token_num))
+            gamma_active = self._alpha + expElogtheta[active] * (cts_phinorm * expElogbetad)
+            Elogtheta_active = self.dirichlet_expectation(gamma_active)
+            gamma[active] = gamma_active
+            Elogtheta[active] = Elogtheta_active
+            expElogtheta[active] = numpy.exp(Elogtheta_active)
+            phinorm[tokens] = numpy.sum(expElogtheta[token_doc[tokens]] * expElogbetad[tokens], 1) + self._phinorm_eps
+            
+            # Documents whose gamma hasn't changed much are done.
+            meanchange = numpy.mean(abs(gamma_active - lastgamma), 1)
+            is_active[active[meanchange < self._meanchangethresh]] = False
+            active = numpy.flatnonzero(is_active)
+            if 0 == len(active):
+                break
+        
+        # Contribution of each document to the expected sufficient
+        # statistics for the M step.
+        sstats_flat = expElogtheta[token_doc].T * (flat_cts / phinorm)
+        sstats_list = [sstats_flat[:, indptr[d]:indptr[d+1]] for d in range(0, doc_num)]
+        
+        return (gamma, sstats_list, Elogtheta)
+        
+        
+    def warm_start(self, gamma, positions):
+        '''
+        Replace rows of gamma by gamma of the last visit of documents at positions
+        '''
+        if 0 == len(self._init_positions) or positions is None:
+            return gamma
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        idx = numpy.minimum(numpy.searchsorted(self._init_positions, positions), len(self._init_positions) - 1)
+        found = self._init_positions[idx] == positions
+        gamma[found] = self._init_gamma[idx[found]]
+        return gamma
+        
+        
+    def infer(self, ids_list, cts_list, positions=None):
+        '''
+        Do e step for documents with random initial gamma
+        Return (gamma, sstats_list, Elogtheta)
+        
+        positions - positions of documents, their gamma of the last visit is used when it is given
+        '''
+        doc_num = len(ids_list)
+        # Same random stream as drawing gammad for each document in turn
+        gamma = 1*self._random.gamma(100., 1./100., (doc_num, self._topic_num)).astype(self._dtype)
+        gamma = self.warm_start(gamma, positions)
+        if self._thread_pool is None or doc_num < 2:
+            return self.infer_gamma(ids_list, cts_list, gamma)
+        
+        # groups of documents run in threads
+        def infer_group((lo, hi)):
+            return self.infer_gamma(ids_list[lo:hi], cts_list[lo:hi], gamma[lo:hi])
+        results = self._thread_pool.map(infer_group, self.thread_groups(doc_num))
+        sstats_list = []
+        for (group_gamma, group_sstats_list, group_Elogtheta) in results:
+            sstats_list.extend(group_sstats_list)
+        return (numpy.vstack([result[0] for result in results]), sstats_list,
+                numpy.vstack([result[2] for result in results]))
+        
+        
+    def thread_groups(self, doc_num):
+        '''
+        Return [(lo, hi), ...] contiguous groups of documents, one for each thread
+        '''
+        bounds = [thread * doc_num / self._thread_num for thread in range(0, self._thread_num + 1)]
+        return [(bounds[thread], bounds[thread + 1]) for thread in range(0, self._thread_num)
+                if bounds[thread] < bounds[thread + 1]]
+        
+        
+    def merge_sstats(self, ids_list, sstats_list):
+        '''
+        Sum sstats of documents over their words
+        Each thread sums its group of documents into its own buffer, then the buffers are added
+        Return (word ids, sstats of the word ids)
+        '''
+        word_ids = numpy.unique(numpy.concatenate([numpy.asarray(ids, dtype=numpy.int64) for ids in ids_list]))
+        def sum_group((lo, hi)):
+            buffer = numpy.zeros((self._topic_num, len(word_ids)))
+            for d in range(lo, hi):
+                buffer[:, numpy.searchsorted(word_ids, ids_list[d])] += sstats_list[d]
+            return buffer
+        buffers = self._thread_pool.map(sum_group, self.thread_groups(len(ids_list)))
+        return (word_ids, sum(buffers[1:], buffers[0]))
+        
+        
+    def infer_gamma(self, ids_list, cts_list, gamma):
+        '''
+        Do e step for documents from initial gamma
+        Return (gamma, sstats_list, Elogtheta)
+        '''
+        doc_num = len(ids_list)
+        if self._batch_size > 1:
+            return self.e_step_batch(ids_list, cts_list, gamma)
+        
+        sstats_list = []
+        Elogtheta = numpy.zeros(gamma.shape, dtype=self._dtype)
+        for d in range(0, doc_num):
+            expElogbetad = numpy.exp(self.Elogbeta_columns(ids_list[d]))
+            (gamma[d], sstats, Elogtheta[d]) = self.e_step_document(ids_list[d], cts_list[d], gamma[d], expElogbetad)
+            sstats_list.append(sstats)
+        return (gamma, sstats_list, Elogtheta)
+        
+        
+    def report_sparse(self):
+        '''
+        Report counts of sparse e steps to Hadoop streaming counters
+        '''
+        if self.sparse_doc_num > 0:
+            sys.stderr.write('reporter:counter:DoLDA,sparse_e_steps,%d\n' % self.sparse_doc_num)
+            sys.stderr.write('reporter:counter:DoLDA,dense_fallbacks,%d\n' % self.dense_fallback_num)
+        
+        
+    def in_input_ranges(self, offset):
+        '''
+        Return whether the document at byte offset, or ordinal of binary corpus, is in the minibatch
+        '''
+        if not self._range_starts:
+            return True
+        idx = bisect.bisect_right(self._range_starts, offset) - 1
+        return idx >= 0 and offset < self._range_ends[idx]
+        
+        
+    def sample_bound(self):
+        '''
+        Return whether the next document is in the perplexity bound
+        '''
+        return self._compute_bound and \
+                (self._bound_fraction >= 1. or self._bound_random.random_sample() < self._bound_fraction)
+        
+        
+    def bound_score(self, ids, cts, gammad, Elogthetad):
+        '''
+        Compute the document part of the perplexity lower bound
+        It is accumulated in float64 whatever self._dtype is
+        '''
+        gammad = numpy.asarray(gammad, dtype=numpy.float64)
+        Elogthetad = numpy.asarray(Elogthetad, dtype=numpy.float64)
+        alpha = numpy.asarray(self._alpha, dtype=numpy.float64)
+        
+        score = 0.
+        if len(ids) > 0:
+            # log normalizer of phi for each word, log-sum-exp over topics
+            temp = Elogthetad[:, numpy.newaxis] + self.Elogbeta_columns(ids)
+            tmax = numpy.max(temp, 0)
+            phinorm = numpy.log(numpy.sum(numpy.exp(temp - tmax), 0)) + tmax
+            score += numpy.sum(cts * phinorm)
+        
+        # E[log p(theta | alpha) - log q(theta | gamma)]
+        score += numpy.sum((alpha - gammad) * Elogthetad)
+        score += numpy.sum(gammaln(gammad) - gammaln(alpha))
+        score += gammaln(numpy.sum(alpha)) - gammaln(numpy.sum(gammad))
+        return score
+        
+        
+    def shard_outputs(self, ids, sstats):
+        '''
+        Generate sstats outputs of ids, one for each vocabulary shard
+        '''
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        shards = numpy.searchsorted(self._shard_los, ids, 'right') - 1
+        for shard in numpy.unique(shards):
+            shard_columns = numpy.flatnonzero(shards == shard)
+            yield (self._sstats_keys[shard],
+                    (ids[shard_columns].tolist(), sstats[:, shard_columns].astype(self._dtype).tostring()))
+        
+        
+    def doc_outputs(self, doc_id, ids, cts, gammad, sstats, Elogthetad, position=None):
+        '''
+        Generate map outputs of one document after e step
+        '''
+        # for alpha update
+        yield ('Elogthetad', (doc_id, Elogthetad.astype(self._dtype).tostring()))
+        
+        # Map Output
+        # gamma is only kept by the reducer for the gamma store
+        if self._gamma_store:
+            yield ('gammad', (position, gammad.astype(self._dtype).tostring()))
+        if sstats is not None:
+            # None when sstats of the batch are merged
+            for output in self.shard_outputs(ids, sstats):
+                yield output
+        
+        # for perplexity, with gamma records so that the reducer of gamma sums them
+        if self.sample_bound():
+            score = self.bound_score(ids, cts, gammad, Elogthetad)
+            yield ('gammad', ('score_partial_sum', float(score)))
+            yield ('gammad', ('sum_cts_sum', int(numpy.sum(cts))))
+            yield ('gammad', ('bound_docs_sum', 1))
+        
+        
+    def flush_batch(self):
+        '''
+        Run batched e step on the buffered documents and generate their outputs
+        '''
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        
+        ids_list = [ids for (doc_id, ids, cts, position) in batch]
+        cts_list = [cts for (doc_id, ids, cts, position) in batch]
+        positions = [position for (doc_id, ids, cts, position) in batch]
+        
+        # E step
+        (gamma, sstats_list, Elogtheta) = self.infer(ids_list, cts_list, positions)
+        
+        if self._thread_pool is not None:
+            # one sstats output for the whole batch
+            (word_ids, sstats) = self.merge_sstats(ids_list, sstats_list)
+            for output in self.shard_outputs(word_ids, sstats):
+                yield output
+            sstats_list = [None] * len(batch)
+        
+        for d in range(0, len(batch)):
+            (doc_id, ids, cts, position) = batch[d]
+            for output in self.doc_outputs(doc_id, ids, cts, gamma[d], sstats_list[d], Elogtheta[d], position):
+                yield output
+        
+        
+    def flush_lines(self):
+        '''
+        Parse the buffered lines at once and generate outputs of their documents
+        Malformed lines are reported and skipped
+        '''
+        if not self._lines:
+            return
+        lines = self._lines
+        line_keys = self._line_keys
+        self._lines = []
+        self._line_keys = []
+        
+        chunk = DoLDA_Parser.parse_lines(lines, self._word_num)
+        DoLDA_Parser.report_malformed(lines, chunk.malformed)
+        for d in range(0, len(chunk)):
+            (doc_id, ids, cts) = chunk.document(d)
+            for output in self.process_document(doc_id, ids, cts, line_keys[chunk.line_indices[d]]):
+                yield output
+        
+        
+    def process_document(self, doc_id, ids, cts, position=None):
+        '''
+        Run e step on one document, or buffer it for batched e step,
+        and generate outputs
+        
+        position - byte offset of text or ordinal of binary corpus
+        '''
+        if self._batch_size > 1 or self._thread_pool is not None:
+            # Buffer the document, E step runs when the batch is full
+            # threads get batch_size documents each
+            self._batch.append((doc_id, ids, cts, position))
+            if len(self._batch) >= self._batch_size * self._thread_num:
+                for output in self.flush_batch():
+                    yield output
+            return
+        
+        expElogbetad = numpy.exp(self.Elogbeta_columns(ids))
+        gammad = 1*self._random.gamma(100., 1./100., self._topic_num).astype(self._dtype)
+        gammad = self.warm_start(gammad[numpy.newaxis, :], [position])[0]
+        
+        # E step
+        (gammad, sstats, Elogthetad) = self.e_step_document(ids, cts, gammad, expElogbetad)
+        
+        for output in self.doc_outputs(doc_id, ids, cts, gammad, sstats, Elogthetad, position):
+            yield output
+        
+        
     def __call__(self, key, value):
         '''
         Execute Map function
         
-        key - each document
+        key - byte offset of each document, doc_id of binary corpus
         value - each document content
         '''
+        if 'csr' == self._input_format:
+            # binary corpus
+            (ordinal, ids, cts) = unpack_document(value)
+            if not self.in_input_ranges(ordinal):
+                return
+            for output in self.process_document(key, ids, cts, ordinal):
+                yield output
+            return
         
-        # one_doc == doc_id word_freq_all word_id:word_freq word_id:word_freq
-        # one_doc == doc_id word_freq_all word_id:word_freq word_id:word_freq
-        # Better code is written in online hdp!
-        splitexp = re.compile(r'[ :]')
-        #splitline = [int(i) for i in splitexp.split(value.strip())]
-        splitline = splitexp.split(value.strip())
-        doc_id = splitline[0]
-        ids = [int(x) for x in splitline[2::2]]
-        cts = [int(x) for x in splitline[3::2]]
-        '''
-        one_doc = value.split()
-        doc_id = one_doc.pop(0)
-        del one_doc[0]
-        
-        # Get document information (parsing)
-        ddict = dict()
-        for each_word in one_doc:
-            temp_str = each_word.split(':')
-            target_word_idx = int(temp_str[0])
-            target_word_freq = temp_str[1]
-            if (not target_word_idx in ddict):
-                ddict[target_word_idx] = 0
-            ddict[target_word_idx] += int(target_word_freq)
-            #yield (target_word_idx, int(target_word_freq))
-        ids = ddict.keys()
-        cts = ddict.values()
-        '''
-        
-        expElogbetad = self._expElogbeta[:, ids]
-        gammad = 1*numpy.random.gamma(100., 1./100., self._topic_num)
+        key = self._input_start + key
+        if not self.in_input_ranges(key):
+            return
+        # Lines are parsed by chunks
+        self._lines.append(value)
+        self._line_keys.append(key)
+        if len(self._lines) >= self._parse_chunk_size:
+            for output in self.flush_lines():
+                yield output
         
-        # E step
-        (gammad, sstats, Elogthetad) = self.e_step(ids, cts, gammad, expElogbetad)
         
-        # for perplexity
-        phinorm = numpy.zeros(len(ids))
-        Elogtheta_d = self.dirichlet_expectation(gammad)
-        for i in range(0, len(ids)):
-            temp = Elogtheta_d + self._Elogbeta[:, ids[i]]
-            tmax = max(temp)
-            phinorm[i] = numpy.log(sum(numpy.exp(temp - tmax))) + tmax
-        score = numpy.sum(cts * phinorm)
+    def close(self):
+        '''
+        Called at the end of map task
+        E step for the remaining buffered documents
+        '''
+        for output in self.flush_lines():
+            yield output
+        for output in self.flush_batch():
+            yield output
+        # Every shard of lambda is updated even if no word of it is touched
+        for shard in range(0, self._shard_num):
+            yield (self._sstats_keys[shard], ([], ''))
+        self.report_sparse()
+        if isinstance(self._psi_lambda, DoLDA_Params.WordMajorShards):
+            sys.stderr.write('reporter:counter:DoLDA,fetched_words,%d\n' % self._psi_lambda.taken_num())
+        self.close_threads()
         
-        # for alpha update
-        yield ('Elogthetad', (doc_id, Elogthetad.tostring()))
         
-        # Map Output
-        yield ('gammad', (doc_id, gammad.tostring()))
-        yield ('sstats', (ids, sstats.tostring()))
-        yield ('score', float(score))
-        yield ('sum_cts', sum(cts))
+    def close_threads(self):
+        '''
+        Stop threads of e step
+        '''
+        if self._thread_pool is not None:
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
         
         
 # Combiner
@@ -171,42 +775,104 @@ class Combiner:
     def __init__(self):
         self._word_num = int(self.params['word_num'])
         self._topic_num = int(self.params['topic_num'])
-        self._sstats = numpy.zeros((self._topic_num, self._word_num))
-        self._ids_set = set()
+        
+        # sstats are sent in self._dtype, but summed in float64
+        self._dtype = numpy.dtype(self.params.get('dtype', 'float64'))
+        
+        # Memory budget of sstats in bytes, sums so far are emitted beyond this
+        self._memlimit = int(self.params.get('combiner_memlimit', '1073741824'))
+        
+        # sstats only for touched words, one column per word
+        # _slots maps word id to its column, -1 for untouched words
+        self._slots = numpy.zeros(self._word_num, dtype=numpy.int64) - 1
+        self._ids = numpy.zeros(0, dtype=numpy.int64)
+        self._sstats = numpy.zeros((self._topic_num, 0))
+        self._touched_num = 0
+        
+    def reserve(self, column_num):
+        '''
+        Make room for column_num touched words
+        '''
+        capacity = len(self._ids)
+        if column_num <= capacity:
+            return
+        
+        max_capacity = max(self._memlimit / (8 * self._topic_num), column_num)
+        capacity = min(max(column_num, 2 * capacity), max_capacity)
+        
+        ids = numpy.zeros(capacity, dtype=numpy.int64)
+        ids[:self._touched_num] = self._ids[:self._touched_num]
+        sstats = numpy.zeros((self._topic_num, capacity))
+        sstats[:, :self._touched_num] = self._sstats[:, :self._touched_num]
+        self._ids = ids
+        self._sstats = sstats
+        
+    def take(self):
+        '''
+        Return (ids, sstats) value of touched sstats and start again from empty sstats
+        '''
+        ids = self._ids[:self._touched_num]
+        value = (ids.tolist(), self._sstats[:, :self._touched_num].astype(self._dtype).tostring())
+        
+        self._slots[ids] = -1
+        self._ids = numpy.zeros(0, dtype=numpy.int64)
+        self._sstats = numpy.zeros((self._topic_num, 0))
+        self._touched_num = 0
+        return value
+        
+    def add_sstats(self, ids, each_sstats):
+        '''
+        Add sstats of ids to touched sstats
+        Return value of the sums taken before them when the memory budget is full, None otherwise
+        '''
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        new_ids = numpy.unique(ids[self._slots[ids] < 0])
+        
+        taken = None
+        column_num = self._touched_num + len(new_ids)
+        if self._touched_num > 0 and column_num * 8 * self._topic_num > self._memlimit:
+            taken = self.take()
+            new_ids = numpy.unique(ids)
+            column_num = len(new_ids)
+        
+        if len(new_ids) > 0:
+            self.reserve(column_num)
+            self._slots[new_ids] = numpy.arange(self._touched_num, column_num)
+            self._ids[self._touched_num:column_num] = new_ids
+            self._touched_num = column_num
+        
+        self._sstats[:, self._slots[ids]] += each_sstats
+        return taken
         
     def __call__(self, key, values):
         '''
         Execute Combiner
-        sum sufficient statistics
+        sum sufficient statistics of one key, and bound terms
         
-        key - sstats, score, sum_cts
+        key - ('sstats_sum', shard, salt) of sstats, gammad, Elogthetad
         value - each document content
         '''
-        if 'sstats' == key:
-            # sstats
+        if isinstance(key, tuple) and 'sstats_sum' == key[0]:
+            # sstats of one vocabulary shard, at least one record is emitted
             for each_value in values:
                 (ids, each_sstats) = each_value
-                each_sstats = numpy.fromstring(each_sstats)
+                each_sstats = numpy.fromstring(each_sstats, dtype=self._dtype)
                 each_sstats.shape = (self._topic_num, len(ids))
-                self._sstats[:, ids] += each_sstats
-                
-                for each_ids in ids:
-                    self._ids_set.add(each_ids)
-            
-            ids_set_list = list(self._ids_set)
-            yield ('sstats_sum', (ids_set_list, self._sstats[:, ids_set_list].tostring()))
-        elif 'score' == key:
-            # score
-            score_sum = 0
-            for each_value in values:
-                score_sum += each_value
-            yield ('gammad', ('score_partial_sum', score_sum))
-        elif 'sum_cts' == key:
-            # sum_cts
-            sum_cts_sum = 0
+                taken = self.add_sstats(ids, each_sstats)
+                if taken is not None:
+                    yield (key, taken)
+            yield (key, self.take())
+        elif 'gammad' == key:
+            # bound terms are summed, gamma of documents passes
+            sums = {}
             for each_value in values:
-                sum_cts_sum += each_value
-            yield ('gammad', ('sum_cts_sum', sum_cts_sum))
+                (each_value_key, each_value_value) = each_value
+                if each_value_key in ('score_partial_sum', 'sum_cts_sum', 'bound_docs_sum'):
+                    sums[each_value_key] = sums.get(each_value_key, 0) + each_value_value
+                else:
+                    yield (key, each_value)
+            for (each_value_key, each_value_value) in sums.iteritems():
+                yield (key, (each_value_key, each_value_value))
         else:
             # etc
             for each_value in values:
@@ -225,44 +891,43 @@ class Reducer:
         return(psi(alpha) - psi(numpy.sum(alpha, 1))[:, numpy.newaxis]) # matrix
     
     
-    def approx_bound(self, score, sum_cts_sum):
+    def approx_bound(self, score, sum_cts_sum, bound_doc_num):
         '''
         Compute lower bound of perplexity
+        
+        score - sum of document parts of the bound, computed in Mapper
+        sum_cts_sum - number of words in the documents of score
+        bound_doc_num - number of documents of score
         '''
         # get score
-        # Should be loaded variable
-        lambda_matrix = self._lambda
-        Elogbeta = self._Elogbeta
-        topic_num = self._topic_num
-        minibatch_size = self._minibatch_size
-        Elogtheta = self.dirichlet_expectation(self.gamma)
-        word_num = self._word_num
+        # sums over lambda come from the shard reducers of the last job
+        (psi_lambda_topic_sum, (lambda_psi_sum, gammaln_lambda_sum)) = self.lambda_sums()
+        psi_lambda_sum = numpy.asarray(self._psi_lambda_sum, dtype=numpy.float64)
         document_num = self._document_num
         
         # calculate score
-        alpha_vec = self._alpha
         eta_vec = self._eta
         
-        score += numpy.sum((alpha_vec - self.gamma) * Elogtheta)
-        score += numpy.sum(gammaln(self.gamma) - gammaln(alpha_vec))
-        #score += sum(gammaln(alpha_vec * topic_num) - gammaln(numpy.sum(self.gamma, 1)))
-        # Changed from oLDA, beacuse we use alpha as vector, not single value
-        score += sum(gammaln(numpy.sum(alpha_vec)) - gammaln(numpy.sum(self.gamma, 1)))
-
         # Compensate for the subsampling of the population of documents
-        score = score * document_num / minibatch_size
+        score = score * document_num / bound_doc_num
         # E[log p(beta | eta) - log q (beta | lambda)]
-        score += numpy.sum((eta_vec - lambda_matrix) * Elogbeta)
-        score += numpy.sum(gammaln(lambda_matrix) - gammaln(eta_vec))       
+        # E[log beta] is psi(lambda) - psi(lambda_sum) of each topic
+        score += numpy.dot(eta_vec, psi_lambda_topic_sum) - numpy.sum(eta_vec) * numpy.sum(psi_lambda_sum)
+        score -= lambda_psi_sum - numpy.dot(self._lambda_sum, psi_lambda_sum)
+        score += gammaln_lambda_sum - self._topic_num * numpy.sum(gammaln(eta_vec))
         #score += numpy.sum(gammaln(eta_vec * word_num) - gammaln(numpy.sum(lambda_matrix, 1)))
         # Changed from oLDA, beacuse we use eta as vector, not single value
-        score += numpy.sum(gammaln(numpy.sum(eta_vec)) - gammaln(numpy.sum(lambda_matrix, 1)))
+        score += numpy.sum(gammaln(numpy.sum(eta_vec)) - gammaln(self._lambda_sum))
         
-        perwordbound = score * minibatch_size / (document_num * sum_cts_sum)
+        perwordbound = score * bound_doc_num / (document_num * sum_cts_sum)
         perwordbound_exp = numpy.exp(-perwordbound)
         return perwordbound_exp
         
-    def __init__(self):
+    def __init__(self, parameters=None):
+        '''
+        parameters - {name: value} of all parameters,
+                     None to load them from distributed cache
+        '''
         self._word_num = int(self.params['word_num'])
         self._document_num = int(self.params['document_num'])
         self._minibatch_size = int(self.params['minibatch_size'])
@@ -276,80 +941,168 @@ class Reducer:
         rhot = pow(self._tau0 + self._updatect, -self._kappa)
         self._rhot = rhot
         
+        # Floating point type of lambda and sstats
+        # M step itself is computed in float64
+        self._dtype = numpy.dtype(self.params.get('dtype', 'float64'))
+        
+        # Number of vocabulary shards, each shard of lambda is updated separately
+        self._shard_num = int(self.params.get('num_shards', '1'))
+        self._shard_bounds = DoLDA_Params.shard_bounds(self._word_num, self._shard_num)
+        
+        # gamma of each document is written to output path gamma, keyed by its position
+        self._gamma_store = '1' == self.params.get('gamma_store', '0')
+        
+        # With fixed_eta, eta keeps its initial value instead of a Newton step in each update
+        self._fixed_eta = '1' == self.params.get('fixed_eta', '0')
+        
+        # With column_store, psi(lambda) is written word by word, so mappers read only their words
+        self._column_store = '1' == self.params.get('column_store', '0')
+        
         # Load parameter from distributed cache
-        parameter_reader = SequenceFile.Reader('./_params')
-        key_class = parameter_reader.getKeyClass()
-        value_class = parameter_reader.getValueClass()
-        key_instance = key_class()
-        value_instance = value_class()
-        
-        while parameter_reader.next(key_instance, value_instance):
-            key_instance_str = key_instance.toString()
-            if 'new_alpha' == key_instance_str:
-                # For alpha
-                self._alpha = value_instance.toString()
-                self._alpha = numpy.fromstring(self._alpha)
-                self._alpha.shape = self._topic_num
-            elif 'new_lambda' == key_instance_str:
-                # For lambda
-                self._lambda = value_instance.toString()
-                self._lambda = numpy.fromstring(self._lambda)
-                self._lambda.shape = (self._topic_num, self._word_num)
-            elif 'new_eta' == key_instance_str:
-                # For eta
-                self._eta = value_instance.toString()
-                self._eta = numpy.fromstring(self._eta)
-                self._eta.shape = self._word_num
-            else:
-                # Error
-                sys.stderr.write("Something wrong in parameter_reader\n")
-                sys.exit(1)
+        if parameters is None:
+            parameters = DoLDA_Params.read_parameters(DoLDA_Params.parameter_paths(),
+                    self._topic_num, self._word_num, dtype=self._dtype)
+        self._alpha = parameters['new_alpha']
+        self._lambda = parameters['new_lambda']
+        self._eta = parameters['new_eta']
+        self._psi_lambda = parameters['new_psi_lambda']
+        if '1' == self.params.get('lazy_lambda', '0') and not isinstance(self._lambda, DoLDA_Params.LazyLambda):
+            # only OnlineLDA keeps lambda lazily, parameter files have all of it
+            raise ValueError('lazy_lambda needs lambda of OnlineLDA with fixed_eta=1')
+        
+        # normalizer of E[log beta], it needs all words
+        self._lambda_sum = numpy.asarray(parameters['new_lambda_sum'], dtype=numpy.float64)
+        self._psi_lambda_sum = psi(parameters['new_lambda_sum'])
+        
+        # sums over lambda for the bound and the eta update, None until they are computed from lambda
+        self._lambda_sums = None
+        if 'new_psi_lambda_topic_sum' in parameters:
+            self._lambda_sums = (parameters['new_psi_lambda_topic_sum'], parameters['new_lambda_bound_sums'])
+        
+    def lambda_sums(self):
+        '''
+        Return (psi(lambda) summed over topics for each word, [sum of lambda * psi(lambda), sum of gammaln(lambda)])
+        Parameters without them, like those of OnlineLDA, get them from the whole lambda
+        '''
+        if self._lambda_sums is None:
+            self._lambda_sums = DoLDA_Params.lambda_sums(self._lambda.columns(0, self._word_num),
+                    self._psi_lambda.columns(0, self._word_num))
+        return self._lambda_sums
+        
+        
+    def Elogbeta_columns(self, lo, hi):
+        '''
+        E[log beta] of words lo to hi
+        '''
+        return self._psi_lambda.columns(lo, hi) - self._psi_lambda_sum[:, numpy.newaxis]
+        
+        
+    def update_lambda(self, sstats, lo, hi, scaled=False):
+        '''
+        Return new lambda of words lo to hi
         
-        parameter_reader.close()
+        sstats - summed sstats of words lo to hi from e step
+        scaled - sstats are already multiplied by exp(E[log beta]) of the parameters of the e step
+        '''
+        if not scaled:
+            sstats = sstats * numpy.exp(self.Elogbeta_columns(lo, hi))
+        return self._lambda.columns(lo, hi) * (1. - self._rhot) + \
+                self._rhot * (self._eta[lo:hi] + self._document_num * sstats / self._minibatch_size)
+        
+        
+    def update_lambda_ids(self, sstats, ids, scaled=False):
+        '''
+        Return new lambda of word ids
+        
+        sstats - summed sstats of word ids from e step
+        scaled - sstats are already multiplied by exp(E[log beta]) of the parameters of the e step
+        '''
+        if not scaled:
+            Elogbeta = self._psi_lambda.take(ids) - self._psi_lambda_sum[:, numpy.newaxis]
+            sstats = sstats * numpy.exp(Elogbeta)
+        return self._lambda.take(ids) * (1. - self._rhot) + \
+                self._rhot * (self._eta[ids] + self._document_num * sstats / self._minibatch_size)
+        
+        
+    def rhot(self):
+        return self._rhot
         
-        self._Elogbeta = self.dirichlet_expectation(self._lambda)
-        self._expElogbeta = numpy.exp(self._Elogbeta)
         
-        # initialize sstats
-        self.sstats = numpy.zeros((self._topic_num, self._word_num))
-        self.gamma = numpy.zeros((self._minibatch_size, self._topic_num))
+    def update_alpha(self, Elogtheta):
+        '''
+        Return new alpha, one Newton step
+        
+        Elogtheta - E[log theta] of each document in minibatch
+        '''
+        g_left_term = self.dirichlet_expectation(self._alpha)
+        q_inv = -1. / polygamma(1, self._alpha)
+        z_inv = 1. / polygamma(1, numpy.sum(self._alpha))
+        sum_s = numpy.zeros(self._topic_num)
+        denom = z_inv + numpy.sum(q_inv)
+        
+        for Elogthetad in Elogtheta:
+            g_ = Elogthetad - g_left_term
+            
+            sum_s += (g_ - ((numpy.sum(g_ * q_inv)) / denom))
+            
+        return self._alpha - sum_s * q_inv * self._rhot / self._minibatch_size
+        
+        
+    def update_eta(self):
+        '''
+        Return new eta, one Newton step
+        '''
+        if self._fixed_eta:
+            return self._eta
+        g_left_term = self.dirichlet_expectation(self._eta) * self._topic_num
+        q_inv = -1. / (self._topic_num * polygamma(1, self._eta))
+        z_inv = 1. / (self._topic_num * polygamma(1, numpy.sum(self._eta)))
+        # E[log beta] summed over topics
+        g_ = self.lambda_sums()[0] - numpy.sum(self._psi_lambda_sum) - g_left_term
+        denom = z_inv + numpy.sum(q_inv)
+        
+        return self._eta - (g_ - ((numpy.sum(g_ * q_inv)) / denom)) * q_inv * self._rhot
+        
         
     def __call__(self, key, values):
         '''
         Execute Reducer
         Do M step
         
-        key - sstats, score, sum_cts
+        key - ('sstats_sum', shard, salt) of sstats, gammad, Elogthetad
         value - each document content
         '''
-        # Get this from distributed cache
-#        topic_num = self._topic_num
-#        _eta = 1./topic_num
-        rhot = self._rhot
-        document_size = self._document_num
-        mini_batch = self._minibatch_size
-        
-        if 'sstats_sum' == key:
-            # sstats_sum
+        if isinstance(key, tuple) and 'sstats_sum' == key[0]:
+            # sstats of one vocabulary shard, summed by combiners or not
+            (lo, hi) = self._shard_bounds[key[1]]
+            self.sstats = numpy.zeros((self._topic_num, hi - lo))
             for each_value in values:
                 (ids, each_sstats) = each_value
-                each_sstats = numpy.fromstring(each_sstats)
+                each_sstats = numpy.fromstring(each_sstats, dtype=self._dtype)
                 each_sstats.shape = (self._topic_num, len(ids))
-                self.sstats[:, ids] += each_sstats
+                self.sstats[:, numpy.asarray(ids, dtype=numpy.int64) - lo] += each_sstats
             
-            # Get new lambda
-            self.sstats = self.sstats * self._expElogbeta
-            self.new_lambda = self._lambda * (1. - rhot) + \
-                    rhot * (self._eta + document_size * self.sstats / mini_batch)
+            # Get new lambda of the shard
+            self.new_lambda = self.update_lambda(self.sstats, lo, hi)
             
             # outputs computed lambda
-            yield (('parameters', 'new_lambda'), self.new_lambda.tostring())
+            # with psi(lambda) and row sums of the shard for the next E step
+            # and sums over the shard for the bound and the eta update of the next job
+            psi_new_lambda = psi(self.new_lambda)
+            yield (('parameters', DoLDA_Params.shard_key('new_lambda', lo)), self.new_lambda.astype(self._dtype).tostring())
+            if self._column_store:
+                yield (('parameters', DoLDA_Params.shard_key('new_psi_lambda_by_word', lo)), psi_new_lambda.T.astype(self._dtype).tostring())
+            else:
+                yield (('parameters', DoLDA_Params.shard_key('new_psi_lambda', lo)), psi_new_lambda.astype(self._dtype).tostring())
+            yield (('parameters', DoLDA_Params.shard_key('new_lambda_sum', lo)), numpy.sum(self.new_lambda, 1).tostring())
+            (psi_lambda_topic_sum, lambda_bound_sums) = DoLDA_Params.lambda_sums(self.new_lambda, psi_new_lambda)
+            yield (('parameters', DoLDA_Params.shard_key('new_psi_lambda_topic_sum', lo)), psi_lambda_topic_sum.tostring())
+            yield (('parameters', DoLDA_Params.shard_key('new_lambda_bound_sums', lo)), lambda_bound_sums.tostring())
         elif 'gammad' == key:
             # gammad
             score_sum = 0
             sum_cts_sum = 0
-            
-            doc_idx = 0
+            bound_doc_num = 0
             
             for each_value in values:
                 (each_value_key, each_value_value) = each_value
@@ -359,45 +1112,31 @@ class Reducer:
                 elif 'sum_cts_sum' == each_value_key:
                     # sum_cts_sum
                     sum_cts_sum += each_value_value
+                elif 'bound_docs_sum' == each_value_key:
+                    # bound_docs_sum
+                    bound_doc_num += each_value_value
                 else:
-                    # gammad
-                    gammad = numpy.fromstring(each_value_value)
-                    gammad.shape = (self._topic_num)
-                    self.gamma[doc_idx, :] = gammad
-                    doc_idx += 1
-            
-            perwordbound_exp = self.approx_bound(score_sum, sum_cts_sum)
+                    # gammad of the document at position each_value_key, only with gamma_store
+                    yield (('gamma', each_value_key), each_value_value)
             
-            yield (('infor', 'perplexity'), str(perwordbound_exp))
+            if bound_doc_num > 0:
+                perwordbound_exp = self.approx_bound(score_sum, sum_cts_sum, bound_doc_num)
+                
+                yield (('infor', 'perplexity'), str(perwordbound_exp))
 #            yield (('infor', 'rhot'), self._rhot)
 #            yield (('infor', 'updatect'), self._updatect)
         elif 'Elogthetad' == key:
             # Update alpha
-            g_left_term = self.dirichlet_expectation(self._alpha)
-            q_inv = -1. / polygamma(1, self._alpha)
-            z_inv = 1. / polygamma(1, numpy.sum(self._alpha))
-            sum_s = numpy.zeros(self._topic_num)
-            denom = z_inv + numpy.sum(q_inv)
-            
-            for each_value in values:
-                (doc_id, Elogthetad) = each_value
-                Elogthetad = numpy.fromstring(Elogthetad)
-                Elogthetad.shape = (self._topic_num)
-                g_ = Elogthetad - g_left_term
-                
-                sum_s += (g_ - ((numpy.sum(g_ * q_inv)) / denom))
-                
-            self.new_alpha = self._alpha - sum_s * q_inv * self._rhot / self._minibatch_size
+            def Elogtheta():
+                for each_value in values:
+                    (doc_id, Elogthetad) = each_value
+                    Elogthetad = numpy.fromstring(Elogthetad, dtype=self._dtype)
+                    Elogthetad.shape = (self._topic_num)
+                    yield Elogthetad
+            self.new_alpha = self.update_alpha(Elogtheta())
             
             # Update eta
-            g_left_term = self.dirichlet_expectation(self._eta) * self._topic_num
-            q_inv = -1. / (self._topic_num * polygamma(1, self._eta))
-            z_inv = 1. / (self._topic_num * polygamma(1, numpy.sum(self._eta)))
-            g_ = numpy.sum(self.dirichlet_expectation(self._lambda), axis=0) - g_left_term
-            sum_s = numpy.zeros(self._topic_num)
-            denom = z_inv + numpy.sum(q_inv)
-            
-            self.new_eta = self._eta - (g_ - ((numpy.sum(g_ * q_inv)) / denom)) * q_inv * self._rhot
+            self.new_eta = self.update_eta()
             
             # Output
             yield(('parameters', 'new_alpha'), self.new_alpha.tostring())
@@ -411,6 +1150,8 @@ class Reducer:
         
 # main function start
 if __name__ == "__main__":    
+    import dumbo
+    
     # job execute
     job = dumbo.Job()
     job.additer(Mapper, Reducer, combiner=Combiner)
@@ -0,0 +1,248 @@
+#!/usr/bin/python26
+
+'''
+Distributed Online Learning for Topic Models
+JinYeong Bak, Dongwoo Kim, Alice Oh
+http://uilab.kaist.ac.kr/research/DoLDA
+
+In-memory online LDA with the update rules of DoLDA_MR.py.
+partial_fit on a minibatch does the same update as one DoLDA_MR.py job with one mapper,
+without parameter files, Hadoop or subprocesses.
+It is for corpora that fit on one machine,
+and a reference to validate the distributed path against.
+With job parameters fixed_eta=1 and lazy_lambda=1, lambda is a DoLDA_Params.LazyLambda,
+an update costs only the words of the minibatch instead of topic_num x word_num.
+The perplexity bound still reads all of lambda, so with lazy_lambda=1 bound_interval is 0 unless it is given.
+'''
+
+import sys
+import numpy
+from scipy.special import psi
+
+import DoLDA_MR
+import DoLDA_Params
+import DoLDA_Local
+import DoLDA_Corpus
+import DoLDA_Parser
+
+
+class OnlineLDA(object):
+    '''
+    Online LDA trained one minibatch at a time
+
+    Documents are (ids, cts), word ids and word counts of each document.
+    '''
+    def __init__(self, word_num, topic_num, document_num, tau0=1024., kappa=0.7,
+                 meanchangethresh=0.001, dtype='float64', parameters=None, updatect=0, **job_params):
+        '''
+        word_num - number of words in vocabulary
+        topic_num - number of topics
+        document_num - number of documents in the whole corpus
+        parameters - [(key, array), ...] or {key: array} of initial parameters,
+                     for example from DoLDA_Params.read_parameters,
+                     None for the initial parameters of DoLDA_Driver.py
+        updatect - number of minibatches already trained
+        job_params - other job parameters of DoLDA_MR.py, for example batch_size,
+                     and lazy_lambda=1 for lazy decay of lambda, it needs fixed_eta=1
+        '''
+        self._word_num = word_num
+        self._topic_num = topic_num
+        self._dtype = numpy.dtype(dtype)
+        self._updatect = updatect
+
+        self._params = dict([(name, str(value)) for (name, value) in job_params.iteritems()])
+        self._params.update({'word_num': str(word_num), 'topic_num': str(topic_num),
+                'document_num': str(document_num), 'tau0': str(tau0), 'kappa': str(kappa),
+                'meanchangethresh': str(meanchangethresh), 'dtype': self._dtype.name})
+
+        if parameters is None:
+            parameters = DoLDA_Params.initial_parameters(topic_num, word_num, self._dtype)
+        parameters = dict(parameters)
+        self._alpha = numpy.asarray(parameters['new_alpha'], dtype=numpy.float64)
+        self._eta = numpy.asarray(parameters['new_eta'], dtype=numpy.float64)
+
+        # untouched columns of lambda only decay toward eta, when eta is fixed
+        self._lazy = '1' == self._params.get('lazy_lambda', '0')
+        if self._lazy:
+            if '1' != self._params.get('fixed_eta', '0'):
+                raise ValueError('lazy_lambda needs fixed_eta=1')
+            # the bound of an update costs topic_num x word_num
+            self._params.setdefault('bound_interval', '0')
+            self._lambda = DoLDA_Params.LazyLambda(self._dense(parameters['new_lambda']), self._eta, self._dtype)
+            self._psi_lambda = DoLDA_Params.PsiColumns(self._lambda, self._dtype)
+            self._lambda_sum = self._lambda.row_sum()
+            return
+
+        self._lambda = self._dense(parameters['new_lambda']).astype(self._dtype)
+        if 'new_psi_lambda' in parameters:
+            self._psi_lambda = self._dense(parameters['new_psi_lambda']).astype(self._dtype)
+        else:
+            self._psi_lambda = psi(self._lambda).astype(self._dtype)
+        if 'new_lambda_sum' in parameters:
+            self._lambda_sum = numpy.asarray(parameters['new_lambda_sum'], dtype=numpy.float64)
+        else:
+            self._lambda_sum = numpy.sum(self._lambda, 1, dtype=numpy.float64)
+
+    def _dense(self, matrix):
+        '''
+        Return topic_num x word_num array of matrix, ColumnShards or WordMajorShards
+        '''
+        if isinstance(matrix, (DoLDA_Params.ColumnShards, DoLDA_Params.WordMajorShards)):
+            return matrix.columns(0, self._word_num)
+        return numpy.asarray(matrix)
+
+    def job_params(self, minibatch_size):
+        '''
+        Return job parameters of DoLDA_MR.py for the next minibatch
+        '''
+        params = dict(self._params)
+        params['minibatch_size'] = str(minibatch_size)
+        params['updatect'] = str(self._updatect)
+        return params
+
+    def job_parameters(self):
+        '''
+        Return current parameters as Mapper and Reducer of DoLDA_MR.py read them
+        '''
+        shape = (self._topic_num, self._word_num)
+        if self._lazy:
+            return {'new_alpha': self._alpha, 'new_eta': self._eta, 'new_lambda': self._lambda,
+                    'new_psi_lambda': self._psi_lambda, 'new_lambda_sum': self._lambda_sum}
+        return {'new_alpha': self._alpha, 'new_eta': self._eta,
+                'new_lambda': DoLDA_Params.ColumnShards(shape, [(0, self._lambda)]),
+                'new_psi_lambda': DoLDA_Params.ColumnShards(shape, [(0, self._psi_lambda)]),
+                'new_lambda_sum': self._lambda_sum}
+
+    def parameters(self):
+        '''
+        Return current parameters, [(key, array), ...]
+        Same as the parameter file of DoLDA_Driver.py
+        '''
+        if self._lazy:
+            lambda_matrix = self._lambda.columns(0, self._word_num)
+            return [('new_alpha', self._alpha), ('new_lambda', lambda_matrix.astype(self._dtype)),
+                    ('new_eta', self._eta), ('new_psi_lambda', psi(lambda_matrix).astype(self._dtype)),
+                    ('new_lambda_sum', self._lambda_sum)]
+        return [('new_alpha', self._alpha), ('new_lambda', self._lambda), ('new_eta', self._eta),
+                ('new_psi_lambda', self._psi_lambda), ('new_lambda_sum', self._lambda_sum)]
+
+    def save(self, path):
+        '''
+        Write current parameters into a parameter file
+        '''
+        DoLDA_Params.write_parameters(path, self.parameters())
+
+    def transform(self, docs):
+        '''
+        Return gamma of docs, number of docs x topic_num
+        Parameters are not updated
+        '''
+        mapper = DoLDA_Local.job_class(DoLDA_MR.Mapper, self.job_params(len(docs)))(self.job_parameters())
+        (gamma, sstats_list, Elogtheta) = mapper.infer([ids for (ids, cts) in docs],
+                [cts for (ids, cts) in docs])
+        mapper.close_threads()
+        return gamma
+
+    def partial_fit(self, docs):
+        '''
+        Update parameters with one minibatch of docs
+        Return (gamma, perplexity), perplexity is None when the bound is not computed
+        '''
+        params = self.job_params(len(docs))
+        parameters = self.job_parameters()
+
+        # E step
+        mapper = DoLDA_Local.job_class(DoLDA_MR.Mapper, params)(parameters)
+        ids_list = [ids for (ids, cts) in docs]
+        cts_list = [cts for (ids, cts) in docs]
+        (gamma, sstats_list, Elogtheta) = mapper.infer(ids_list, cts_list)
+        mapper.close_threads()
+
+        # sstats only of words in docs
+        word_ids = numpy.unique(numpy.concatenate([numpy.asarray(ids, dtype=numpy.int64) for ids in ids_list]))
+        sstats = numpy.zeros((self._topic_num, len(word_ids)))
+        score = 0.
+        sum_cts = 0
+        bound_doc_num = 0
+        for d in range(0, len(docs)):
+            sstats[:, numpy.searchsorted(word_ids, ids_list[d])] += sstats_list[d].astype(self._dtype)
+            if mapper.sample_bound():
+                score += mapper.bound_score(ids_list[d], cts_list[d], gamma[d], Elogtheta[d])
+                sum_cts += sum(cts_list[d])
+                bound_doc_num += 1
+
+        return (gamma, self.update(len(docs), sstats, Elogtheta, score, sum_cts, bound_doc_num, word_ids))
+
+    def update(self, minibatch_size, sstats, Elogtheta, score=0., sum_cts=0, bound_doc_num=0, word_ids=None,
+               scaled=False):
+        '''
+        M step with statistics of a minibatch from E steps done elsewhere
+        Return perplexity, None when bound_doc_num is 0
+
+        sstats - topic_num x word_num sufficient statistics summed over the minibatch,
+                 or only columns of word_ids
+        Elogtheta - E[log(theta)] of each document
+        score, sum_cts, bound_doc_num - sums of bound scores and word counts of documents in the bound
+        word_ids - sorted word ids of columns of sstats, None for all words
+        scaled - sstats are already multiplied by exp(E[log beta]) of the parameters of the E steps,
+                 for E steps of older parameters
+        '''
+        params = self.job_params(minibatch_size)
+        reducer = DoLDA_Local.job_class(DoLDA_MR.Reducer, params)(self.job_parameters())
+        if self._lazy:
+            if word_ids is None:
+                word_ids = numpy.arange(self._word_num)
+            new_columns = reducer.update_lambda_ids(sstats, word_ids, scaled)
+        else:
+            if word_ids is not None:
+                full_sstats = numpy.zeros((self._topic_num, self._word_num))
+                full_sstats[:, word_ids] = sstats
+                sstats = full_sstats
+            new_lambda = reducer.update_lambda(sstats, 0, self._word_num, scaled)
+        new_alpha = reducer.update_alpha(Elogtheta)
+        new_eta = reducer.update_eta()
+        perplexity = None
+        if bound_doc_num > 0:
+            perplexity = reducer.approx_bound(score, sum_cts, bound_doc_num)
+
+        self._alpha = new_alpha
+        self._eta = new_eta
+        self._updatect += 1
+        if self._lazy:
+            self._lambda.update(reducer.rhot(), word_ids, new_columns)
+            self._lambda_sum = self._lambda.row_sum()
+            return perplexity
+
+        self._lambda = new_lambda.astype(self._dtype)
+        self._psi_lambda = psi(new_lambda).astype(self._dtype)
+        self._lambda_sum = numpy.sum(new_lambda, 1)
+
+        return perplexity
+
+
+def read_documents(path):
+    '''
+    Generate (ids, cts) of each document line of path
+    Malformed lines are reported and skipped
+    '''
+    for (first_line, lines) in DoLDA_Corpus.read_chunks(path):
+        chunk = DoLDA_Parser.parse_lines(lines)
+        DoLDA_Parser.report_malformed(lines, chunk.malformed, counter=False)
+        for (doc_id, ids, cts) in chunk.documents():
+            yield (ids, cts)
+
+
+# main function start
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        sys.exit('Usage: %s document_file_path word_num topic_num minibatch_size [output_parameter_file]' % sys.argv[0])
+
+    docs = list(read_documents(sys.argv[1]))
+    minibatch_size = int(sys.argv[4])
+    olda = OnlineLDA(int(sys.argv[2]), int(sys.argv[3]), len(docs))
+    for start in range(0, len(docs), minibatch_size):
+        (gamma, perplexity) = olda.partial_fit(docs[start:start + minibatch_size])
+        print '%d\t%s' % (start / minibatch_size, perplexity)
+
+    if len(sys.argv) > 5:
+        olda.save(sys.argv[5])
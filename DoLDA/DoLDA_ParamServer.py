@@ -0,0 +1,243 @@
+#!/usr/bin/python26
+
+'''
+Distributed Online Learning for Topic Models
+JinYeong Bak, Dongwoo Kim, Alice Oh
+http://uilab.kaist.ac.kr/research/DoLDA
+
+Asynchronous training with a parameter server, instead of one job for each minibatch.
+The server keeps the parameters in an OnlineLDA, each worker runs the E step of its own minibatches.
+For a minibatch a worker pulls alpha, row sums of lambda and only the columns of psi(lambda) of its words,
+and pushes back sufficient statistics of those columns,
+already multiplied by exp(E[log beta]) of the pulled columns, so a stale push keeps the parameters it was computed from.
+The server applies each push as soon as it comes with the lambda update of DoLDA_MR.Reducer,
+so every push is one update with its own rhot and there is no barrier between workers.
+A push computed from parameters more than staleness updates old is rejected,
+the worker pulls again and runs the E step of that minibatch again.
+Server and workers talk over sockets of multiprocessing.connection, like DoLDA_Workers.py,
+workers are started on this machine, or by hand on other machines with
+python DoLDA_ParamServer.py worker host port
+'''
+
+import os
+import sys
+import optparse
+import subprocess
+import threading
+import traceback
+import numpy
+from scipy.special import psi
+from multiprocessing.connection import Listener, Client
+
+import DoLDA_Corpus
+import DoLDA_Online
+import DoLDA_Workers
+
+
+class ParameterServer(object):
+    '''
+    Parameters of OnlineLDA pulled and updated by workers at the same time
+    '''
+    def __init__(self, olda, word_num, staleness=0, output=sys.stdout):
+        '''
+        olda - OnlineLDA of the parameters, its M step applies the pushes
+        staleness - largest number of updates applied between the pull and the push of an update
+        output - each applied update is written as updatect, perplexity and staleness
+        '''
+        self._olda = olda
+        self._word_num = word_num
+        self._staleness = staleness
+        self._output = output
+        self._lock = threading.Lock()
+        # number of applied updates
+        self._version = 0
+        self.rejected_num = 0
+
+    def version(self):
+        return self._version
+
+    def pull(self, word_ids, minibatch_size):
+        '''
+        Return (version, job parameters, alpha, lambda_sum, psi(lambda) columns of word_ids)
+        '''
+        self._lock.acquire()
+        try:
+            parameters = self._olda.job_parameters()
+            return (self._version, self._olda.job_params(minibatch_size), parameters['new_alpha'],
+                    parameters['new_lambda_sum'], parameters['new_psi_lambda'].take(word_ids))
+        finally:
+            self._lock.release()
+
+    def push(self, version, minibatch_size, word_ids, sstats, Elogtheta, score=0., sum_cts=0, bound_doc_num=0):
+        '''
+        Apply sstats of columns word_ids computed from parameters of version
+        sstats are multiplied by exp(E[log beta]) of that version
+        Return (applied, perplexity), applied is False when the update is too stale
+        '''
+        self._lock.acquire()
+        try:
+            staleness = self._version - version
+            if staleness > self._staleness:
+                self.rejected_num += 1
+                return (False, None)
+
+            perplexity = self._olda.update(minibatch_size, sstats, Elogtheta, score, sum_cts, bound_doc_num, word_ids,
+                    scaled=True)
+            self._output.write('%d\t%s\t%d\n' % (self._version, perplexity, staleness))
+            self._output.flush()
+            self._version += 1
+            return (True, perplexity)
+        finally:
+            self._lock.release()
+
+    def serve(self, connection, assignment, finished):
+        '''
+        Send assignment to a worker and serve its requests until it is done
+        Requests are (name, arguments...), replies are ('ok', result) or ('error', traceback)
+        finished - list the connection is appended to when the worker is done
+        '''
+        connection.send(assignment)
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                break
+            if 'done' == request[0]:
+                finished.append(connection)
+                break
+            try:
+                if 'pull' == request[0]:
+                    result = self.pull(*request[1:])
+                elif 'push' == request[0]:
+                    result = self.push(*request[1:])
+                else:
+                    raise ValueError('Unknown request %s' % request[0])
+                connection.send(('ok', result))
+            except Exception:
+                connection.send(('error', traceback.format_exc()))
+        connection.close()
+
+    def train(self, document_file_path, topic_num, dtype, minibatches, worker_num,
+              address=('localhost', 0), external_num=0):
+        '''
+        Train with workers until every minibatch is applied
+        minibatches - doc_indices of each minibatch, minibatch j is run by worker j modulo number of workers
+        worker_num - number of workers started on this machine
+        address - (host, port) the server listens on, port 0 for any free port
+        external_num - number of workers started by hand, they connect to address
+        '''
+        listener = Listener(address, authkey=DoLDA_Workers.authkey())
+        (host, port) = listener.address[:2]
+        sys.stderr.write('Workers connect to %s %d\n' % (host, port))
+
+        processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', host, str(port)])
+                for worker_idx in range(0, worker_num)]
+        connections = [listener.accept() for worker_idx in range(0, worker_num + external_num)]
+
+        finished = []
+        threads = []
+        for (worker_idx, connection) in enumerate(connections):
+            assignment = (os.path.abspath(document_file_path), self._word_num, topic_num, dtype,
+                    [list(doc_indices) for doc_indices in minibatches[worker_idx::len(connections)]])
+            thread = threading.Thread(target=self.serve, args=(connection, assignment, finished))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        for process in processes:
+            process.wait()
+        listener.close()
+
+        if len(finished) < len(connections):
+            raise RuntimeError('%d workers stopped before their minibatches were done'
+                    % (len(connections) - len(finished)))
+        sys.stderr.write('%d updates are applied, %d stale updates are rejected\n'
+                % (self._version, self.rejected_num))
+
+
+def request(connection, *args):
+    '''
+    Send a request to the server and return its result
+    '''
+    connection.send(args)
+    (status, result) = connection.recv()
+    if 'error' == status:
+        raise RuntimeError('Server failed\n%s' % result)
+    return result
+
+
+def run_worker(address):
+    '''
+    Run the E step of minibatches the server at address assigns
+    '''
+    connection = Client(address, authkey=DoLDA_Workers.authkey())
+    (document_file_path, word_num, topic_num, dtype, minibatches) = connection.recv()
+    ordinals = set()
+    for doc_indices in minibatches:
+        ordinals.update(doc_indices)
+    worker = DoLDA_Workers.Worker(document_file_path, word_num, topic_num, dtype, 0, 1, ordinals)
+
+    for doc_indices in minibatches:
+        word_ids = worker.assign(doc_indices)
+        applied = False
+        while not applied:
+            (version, params, alpha, lambda_sum, psi_lambda_columns) = request(connection, 'pull',
+                    word_ids, len(doc_indices))
+            (word_ids, sstats, Elogtheta, score, sum_cts, bound_doc_num) = worker.e_step(params, alpha,
+                    lambda_sum, word_ids, psi_lambda_columns)
+            sstats *= numpy.exp(psi_lambda_columns - psi(lambda_sum)[:, numpy.newaxis])
+            (applied, perplexity) = request(connection, 'push', version, len(doc_indices),
+                    word_ids, sstats, Elogtheta, score, sum_cts, bound_doc_num)
+    connection.send(('done',))
+    connection.close()
+
+
+# main function start
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and 'worker' == sys.argv[1]:
+        if len(sys.argv) < 4:
+            sys.exit('Usage: %s worker host port' % sys.argv[0])
+        run_worker((sys.argv[2], int(sys.argv[3])))
+        sys.exit(0)
+
+    option_parser = optparse.OptionParser(usage='%prog [options] word_file_path document_file_path topic_num minibatch_size tau0 kappa worker_num [output_parameter_file]')
+    option_parser.add_option('--staleness', type='int', default=0,
+            help='largest number of updates applied between the pull and the push of an update [default: %default]')
+    option_parser.add_option('--dtype', default='float64',
+            help='floating point type of lambda, gamma and sstats: float64 or float32 [default: %default]')
+    option_parser.add_option('--order', default='sequential', choices=DoLDA_Corpus.MinibatchSampler.ORDERS,
+            help='order of documents: sequential, shuffle or stratified by document length [default: %default]')
+    option_parser.add_option('--seed', type='int', default=100000001,
+            help='random seed of document order [default: %default]')
+    option_parser.add_option('--param', action='append', default=[], metavar='NAME=VALUE',
+            help='additional job parameter of DoLDA_MR.py, can be repeated')
+    option_parser.add_option('--address', default='localhost:0', metavar='HOST:PORT',
+            help='address workers connect to [default: %default]')
+    option_parser.add_option('--external', type='int', default=0,
+            help='number of workers started by hand on other machines [default: %default]')
+    (options, args) = option_parser.parse_args()
+    if len(args) < 7:
+        option_parser.error('7 arguments are needed')
+
+    word_file_path = args[0]
+    document_file_path = args[1]
+    topic_num = int(args[2])
+    minibatch_size = int(args[3])
+    tau0 = float(args[4])
+    kappa = float(args[5])
+    worker_num = int(args[6])
+
+    manifest = DoLDA_Corpus.load_manifest(document_file_path, word_file_path)
+    sampler = DoLDA_Corpus.MinibatchSampler(manifest, minibatch_size, options.order, options.seed)
+    job_params = dict([param.split('=', 1) for param in options.param])
+    olda = DoLDA_Online.OnlineLDA(manifest.word_num, topic_num, manifest.document_num, tau0, kappa,
+            dtype=options.dtype, **job_params)
+
+    (host, port) = options.address.rsplit(':', 1)
+    server = ParameterServer(olda, manifest.word_num, options.staleness)
+    server.train(document_file_path, topic_num, options.dtype, list(sampler.minibatches(0)), worker_num,
+            (host, int(port)), options.external)
+
+    if len(args) > 7:
+        olda.save(args[7])
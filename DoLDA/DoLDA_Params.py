@@ -0,0 +1,624 @@
+#!/usr/bin/python26
+
+'''
+Distributed Online Learning for Topic Models
+JinYeong Bak, Dongwoo Kim, Alice Oh
+http://uilab.kaist.ac.kr/research/DoLDA
+
+Parameter files of DoLDA.
+Parameters alpha, lambda and eta are stored in SequenceFile of TypedBytesWritable.
+Lambda can be split into column shards by vocabulary range,
+each shard is stored with key 'new_lambda:<first word id>'.
+psi(lambda) and row sums of lambda are stored along with lambda,
+so tasks get E[log beta] without computing psi over the whole lambda.
+Row sums of a shard are partial sums over its words.
+Sums over lambda for the perplexity bound and the eta update are stored along with each shard too,
+psi(lambda) summed over topics for each word, and the sums of lambda * psi(lambda) and gammaln(lambda),
+so a reducer gets them without reading the whole lambda.
+psi(lambda) can also be stored word by word with key 'new_psi_lambda_by_word:<first word id>',
+then the values of a word are contiguous and tasks read only the words they take.
+
+Values of uncompressed files are memory-mapped in place, not read.
+Files written by write_parameters keep every payload aligned
+and record dtype and shape of each array in the SequenceFile metadata.
+
+read_shared_parameters keeps decoded parameters in a node-local cache, /dev/shm by default,
+so concurrent tasks of a node with the same parameter files share one copy.
+
+LazyLambda keeps lambda of a fixed eta in memory with lazy decay of untouched columns,
+for in-memory training where an update touches only the words of one minibatch.
+'''
+
+import os
+import time
+import glob
+import shutil
+import struct
+import fcntl
+import hashlib
+import numpy
+from scipy.special import psi, gammaln
+from hadoop.io import SequenceFile
+from hadoop.io.OutputStream import DataOutputBuffer
+from hadoop.typedbytes import TypedBytesWritable
+
+SHARD_SEPARATOR = ':'
+
+# parameters sharded by vocabulary range
+SHARDED_PARAMETERS = ('new_lambda', 'new_psi_lambda')
+
+# sharded parameters stored word by word, word_num x topic_num, by key name
+WORD_MAJOR_PARAMETERS = {'new_psi_lambda_by_word': 'new_psi_lambda'}
+
+# parameters whose shards hold partial sums
+SUMMED_PARAMETERS = ('new_lambda_sum', 'new_lambda_bound_sums')
+
+# parameters of each word, shards are concatenated by vocabulary range
+CONCATENATED_PARAMETERS = ('new_psi_lambda_topic_sum',)
+
+# key of records which only align the next payload
+PADDING_KEY = 'padding'
+
+# payload alignment in bytes
+ALIGNMENT = 64
+
+# name prefix of node-local caches of parameters
+SHARED_CACHE_PREFIX = 'DoLDA_params_'
+
+# TypedBytesWritable header of a string value
+# length of typed bytes, type code, length of string
+TYPEDBYTES_HEADER = struct.Struct('>iBi')
+TYPEDBYTES_STRING_TYPES = (0, 7, 101)   # BYTES, STRING, BYTESTRING
+
+
+def shard_key(name, lo):
+    '''
+    Return key of the shard of parameter name starting at word id lo
+    '''
+    return '%s%s%d' % (name, SHARD_SEPARATOR, lo)
+
+
+def split_key(key):
+    '''
+    Return (name, lo) of a parameter key
+    lo is 0 for a key without shard
+    '''
+    (name, separator, lo) = key.partition(SHARD_SEPARATOR)
+    if separator:
+        return (name, int(lo))
+    return (name, 0)
+
+
+def shard_bounds(word_num, shard_num):
+    '''
+    Return [(lo, hi), ...] vocabulary range of each shard
+    '''
+    return [(shard * word_num / shard_num, (shard + 1) * word_num / shard_num)
+            for shard in range(0, shard_num)]
+
+
+def parameter_shape(name, topic_num, word_num):
+    '''
+    Return shape of parameter name
+    '''
+    if 'new_alpha' == name:
+        return (topic_num,)
+    elif 'new_eta' == name:
+        return (word_num,)
+    elif name in ('new_lambda', 'new_psi_lambda'):
+        return (topic_num, word_num)
+    elif 'new_lambda_sum' == name:
+        return (topic_num,)
+    elif 'new_psi_lambda_topic_sum' == name:
+        return (word_num,)
+    elif 'new_lambda_bound_sums' == name:
+        return (2,)
+    raise ValueError('Unknown parameter %s' % name)
+
+
+def parameter_paths(pattern='./_params*'):
+    '''
+    Return parameter files linked from distributed cache
+    '''
+    return sorted(glob.glob(pattern))
+
+
+class ColumnShards(object):
+    '''
+    Matrix split into column shards by vocabulary range
+    Shards are kept as loaded, so memory-mapped shards are not copied
+    '''
+    def __init__(self, shape, shards):
+        '''
+        shape - shape of the whole matrix
+        shards - [(lo, array), ...]
+        '''
+        self.shape = shape
+        shards = sorted(shards, key=lambda shard: shard[0])
+        self._los = numpy.array([lo for (lo, shard) in shards], dtype=numpy.int64)
+        self._shards = [shard for (lo, shard) in shards]
+
+        covered = sum([shard.shape[1] for shard in self._shards])
+        if covered != shape[1]:
+            raise ValueError('Shards cover %d of %d columns' % (covered, shape[1]))
+
+    def shards(self):
+        '''
+        Return [(lo, array), ...]
+        '''
+        return zip(self._los.tolist(), self._shards)
+
+    def columns(self, lo, hi):
+        '''
+        Return columns lo to hi
+        No copy when they are in one shard
+        '''
+        parts = []
+        for (shard_lo, shard) in self.shards():
+            shard_hi = shard_lo + shard.shape[1]
+            if shard_hi <= lo or hi <= shard_lo:
+                continue
+            parts.append(shard[:, max(lo, shard_lo) - shard_lo:min(hi, shard_hi) - shard_lo])
+        if 1 == len(parts):
+            return parts[0]
+        return numpy.hstack(parts)
+
+    def take(self, ids):
+        '''
+        Return columns of word ids
+        '''
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if 1 == len(self._shards):
+            return self._shards[0][:, ids]
+
+        result = numpy.empty((self.shape[0], len(ids)), dtype=self._shards[0].dtype)
+        shard_idx = numpy.searchsorted(self._los, ids, 'right') - 1
+        for shard in numpy.unique(shard_idx):
+            columns = numpy.flatnonzero(shard_idx == shard)
+            result[:, columns] = self._shards[shard][:, ids[columns] - self._los[shard]]
+        return result
+
+    def row_sum(self):
+        '''
+        Return sum of each row
+        '''
+        return sum([numpy.sum(shard, 1) for shard in self._shards])
+
+
+class WordMajorShards(object):
+    '''
+    Matrix of topic_num x word_num stored word by word, in shards of words x topic_num by vocabulary range
+    Values of a word are contiguous, so only the rows of taken words of memory-mapped shards are read
+    '''
+    def __init__(self, shape, shards):
+        '''
+        shape - shape of the whole matrix, topic_num x word_num
+        shards - [(lo, array of words x topic_num), ...]
+        '''
+        self.shape = shape
+        shards = sorted(shards, key=lambda shard: shard[0])
+        self._los = numpy.array([lo for (lo, shard) in shards], dtype=numpy.int64)
+        self._shards = [shard for (lo, shard) in shards]
+        # words taken at least once
+        self._taken = numpy.zeros(shape[1], dtype=bool)
+
+        covered = sum([shard.shape[0] for shard in self._shards])
+        if covered != shape[1]:
+            raise ValueError('Shards cover %d of %d words' % (covered, shape[1]))
+
+    def shards(self):
+        '''
+        Return [(lo, array), ...]
+        '''
+        return zip(self._los.tolist(), self._shards)
+
+    def take(self, ids):
+        '''
+        Return columns of word ids
+        '''
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        self._taken[ids] = True
+        result = numpy.empty((self.shape[0], len(ids)), dtype=self._shards[0].dtype)
+        shard_idx = numpy.searchsorted(self._los, ids, 'right') - 1
+        for shard in numpy.unique(shard_idx):
+            columns = numpy.flatnonzero(shard_idx == shard)
+            result[:, columns] = self._shards[shard][ids[columns] - self._los[shard]].T
+        return result
+
+    def columns(self, lo, hi):
+        '''
+        Return columns lo to hi
+        '''
+        return self.take(numpy.arange(lo, hi))
+
+    def taken_num(self):
+        '''
+        Return number of words taken at least once
+        '''
+        return int(numpy.sum(self._taken))
+
+
+def word_major_parameters(parameters):
+    '''
+    Return parameters, [(key, array), ...], with psi(lambda) stored word by word
+    '''
+    names = dict([(name, word_major_name) for (word_major_name, name) in WORD_MAJOR_PARAMETERS.iteritems()])
+    result = []
+    for (key, value) in parameters:
+        (name, lo) = split_key(key)
+        if name in names:
+            key = shard_key(names[name], lo)
+            value = numpy.ascontiguousarray(numpy.asarray(value).T)
+        result.append((key, value))
+    return result
+
+
+class LazyLambda(object):
+    '''
+    lambda with lazy decay of untouched columns, for a fixed eta
+    An update moves lambda - eta of every untouched column by the factor 1 - rhot.
+    Each column keeps lambda - eta of its last write and the log of the product of 1 - rhot at that time,
+    so untouched columns are decayed only when they are read,
+    and an update costs only the touched columns, not topic_num x word_num.
+    Row sums of lambda - eta are kept with the updates, they are not summed again.
+    '''
+    def __init__(self, lambda_matrix, eta, dtype='float64'):
+        '''
+        lambda_matrix - topic_num x word_num array of lambda
+        eta - eta of each word, it must not change in the updates
+        '''
+        self.shape = lambda_matrix.shape
+        self._eta = numpy.asarray(eta, dtype=numpy.float64)
+        self._offsets = (numpy.asarray(lambda_matrix, dtype=numpy.float64) - self._eta).astype(dtype)
+        self._offset_sums = numpy.sum(self._offsets, 1, dtype=numpy.float64)
+        # log of the product of 1 - rhot of all updates, and of updates until the last write of each column
+        self._log_scale = 0.
+        self._column_log_scales = numpy.zeros(self.shape[1])
+
+    def take(self, ids):
+        '''
+        Return columns of word ids
+        '''
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        decay = numpy.exp(self._log_scale - self._column_log_scales[ids])
+        return self._eta[ids] + self._offsets[:, ids] * decay
+
+    def columns(self, lo, hi):
+        '''
+        Return columns lo to hi
+        '''
+        return self.take(numpy.arange(lo, hi))
+
+    def row_sum(self):
+        '''
+        Return sum of each row
+        '''
+        return numpy.sum(self._eta) + self._offset_sums
+
+    def update(self, rhot, ids, new_columns):
+        '''
+        One update with rhot, new_columns are new lambda of word ids
+        Other columns decay toward eta
+        '''
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        old_sums = numpy.sum(self.take(ids) - self._eta[ids], 1)
+        if rhot >= 1.:
+            # every untouched column becomes eta
+            self._offsets[:] = 0.
+            self._offset_sums[:] = 0.
+            self._log_scale = 0.
+            self._column_log_scales[:] = 0.
+        else:
+            self._offset_sums = (1. - rhot) * (self._offset_sums - old_sums)
+            self._log_scale += numpy.log(1. - rhot)
+
+        new_offsets = new_columns - self._eta[ids]
+        self._offsets[:, ids] = new_offsets
+        self._offset_sums += numpy.sum(new_offsets, 1)
+        self._column_log_scales[ids] = self._log_scale
+
+
+class PsiColumns(object):
+    '''
+    psi of columns of a matrix, computed when they are read
+    '''
+    def __init__(self, matrix, dtype='float64'):
+        self.shape = matrix.shape
+        self._matrix = matrix
+        self._dtype = numpy.dtype(dtype)
+
+    def take(self, ids):
+        return psi(self._matrix.take(ids)).astype(self._dtype)
+
+    def columns(self, lo, hi):
+        return psi(self._matrix.columns(lo, hi)).astype(self._dtype)
+
+
+def lambda_sums(lambda_matrix, psi_lambda=None):
+    '''
+    Return (psi(lambda) summed over topics for each word, [sum of lambda * psi(lambda), sum of gammaln(lambda)])
+    Sums over columns of a shard are partial sums of the whole lambda
+    '''
+    lambda_matrix = numpy.asarray(lambda_matrix, dtype=numpy.float64)
+    if psi_lambda is None:
+        psi_lambda = psi(lambda_matrix)
+    psi_lambda = numpy.asarray(psi_lambda, dtype=numpy.float64)
+    return (numpy.sum(psi_lambda, 0), numpy.array([numpy.sum(lambda_matrix * psi_lambda),
+            numpy.sum(gammaln(lambda_matrix))]))
+
+
+def initial_parameters(topic_num, word_num, dtype='float64'):
+    '''
+    Return initial parameters, [(key, array), ...]
+    
+    dtype - floating point type of lambda and psi(lambda)
+    '''
+    # parameter initialized, without touching the global random state
+    random_state = numpy.random.RandomState(100000001)
+    
+    # For alpha
+    _alpha = numpy.zeros(topic_num) + 1./topic_num
+    
+    # For lambda
+    _lambda = 1*random_state.gamma(100., 1./100., (topic_num, word_num))
+    
+    # For eta
+    _eta = numpy.zeros(word_num) + 1./topic_num
+    
+    (psi_lambda_topic_sum, lambda_bound_sums) = lambda_sums(_lambda)
+    return [('new_alpha', _alpha), ('new_lambda', _lambda.astype(dtype)), ('new_eta', _eta),
+            ('new_psi_lambda', psi(_lambda).astype(dtype)), ('new_lambda_sum', numpy.sum(_lambda, 1)),
+            ('new_psi_lambda_topic_sum', psi_lambda_topic_sum), ('new_lambda_bound_sums', lambda_bound_sums)]
+
+
+def read_value(path, parameter_reader, key_instance):
+    '''
+    Read the next value of parameter_reader as a flat byte array
+    Uncompressed payloads are memory-mapped instead of read
+    Return None at the end of file
+    '''
+    if parameter_reader.isCompressed() or parameter_reader.isBlockCompressed():
+        value_instance = parameter_reader.getValueClass()()
+        if not parameter_reader.next(key_instance, value_instance):
+            return None
+        return numpy.fromstring(value_instance.toString(), dtype=numpy.uint8)
+
+    position = parameter_reader.nextKeyValuePosition(key_instance)
+    if position is None:
+        return None
+    (value_position, value_length) = position
+
+    parameter_file = open(path, 'rb')
+    parameter_file.seek(value_position)
+    (typedbytes_length, type_code, payload_length) = \
+            TYPEDBYTES_HEADER.unpack(parameter_file.read(TYPEDBYTES_HEADER.size))
+    parameter_file.close()
+    if type_code not in TYPEDBYTES_STRING_TYPES or \
+            value_length != TYPEDBYTES_HEADER.size + payload_length:
+        raise IOError('%s: value of %s is not a string' % (path, key_instance.toString()))
+
+    if 0 == payload_length:
+        return numpy.zeros(0, dtype=numpy.uint8)
+    return numpy.memmap(path, dtype=numpy.uint8, mode='r',
+            offset=value_position + TYPEDBYTES_HEADER.size, shape=(payload_length,))
+
+
+def read_parameters(paths, topic_num, word_num, names=None, dtype='float64'):
+    '''
+    Read parameters from SequenceFiles
+    Sharded parameters are returned as ColumnShards, or WordMajorShards when they are stored word by word
+
+    paths - parameter files
+    names - parameters to load, None for all
+    dtype - dtype of sharded parameters in files without metadata,
+            other parameters are always float64
+    '''
+    parameters = dict()
+    shards = dict()
+    word_shards = dict()
+    word_major_names = set()
+    for path in paths:
+        parameter_reader = SequenceFile.Reader(path)
+        metadata = parameter_reader.getMetadata()
+        key_instance = parameter_reader.getKeyClass()()
+
+        while True:
+            value = read_value(path, parameter_reader, key_instance)
+            if value is None:
+                break
+            key = key_instance.toString()
+            (name, lo) = split_key(key)
+            word_major = name in WORD_MAJOR_PARAMETERS
+            if word_major:
+                name = WORD_MAJOR_PARAMETERS[name]
+                word_major_names.add(name)
+            if PADDING_KEY == name or (names is not None and name not in names):
+                continue
+
+            # files written by reducers have no metadata
+            if key + '.dtype' in metadata.keys():
+                value = value.view(metadata.get(key + '.dtype'))
+            elif name in SHARDED_PARAMETERS:
+                value = value.view(dtype)
+            else:
+                value = value.view(numpy.float64)
+
+            if key + '.shape' in metadata.keys():
+                value.shape = tuple([int(x) for x in metadata.get(key + '.shape').split(',')])
+            elif word_major:
+                value.shape = (len(value) / topic_num, topic_num)
+            elif name in SHARDED_PARAMETERS:
+                value.shape = (topic_num, len(value) / topic_num)
+            elif name not in CONCATENATED_PARAMETERS:
+                value.shape = parameter_shape(name, topic_num, word_num)
+
+            if name in SHARDED_PARAMETERS:
+                # column shard
+                shards.setdefault(name, []).append((lo, value))
+            elif name in CONCATENATED_PARAMETERS:
+                # values of the words of a shard
+                word_shards.setdefault(name, []).append((lo, value))
+            elif name in SUMMED_PARAMETERS and name in parameters:
+                # partial sum of shard
+                parameters[name] = parameters[name] + value
+            else:
+                parameters[name] = value
+
+        parameter_reader.close()
+
+    for (name, name_shards) in shards.iteritems():
+        if name in word_major_names:
+            parameters[name] = WordMajorShards(parameter_shape(name, topic_num, word_num), name_shards)
+        else:
+            parameters[name] = ColumnShards(parameter_shape(name, topic_num, word_num), name_shards)
+    for (name, name_shards) in word_shards.iteritems():
+        parameters[name] = numpy.concatenate([value for (lo, value) in sorted(name_shards, key=lambda shard: shard[0])])
+        if len(parameters[name]) != word_num:
+            raise ValueError('Shards of %s cover %d of %d words' % (name, len(parameters[name]), word_num))
+
+    return parameters
+
+
+def parameter_files_key(paths, names, dtype='float64'):
+    '''
+    Return key of parameter files, md5 of sync marker and size of each file
+    Sync markers are random for each written file, so new files get a new key
+    '''
+    digest = hashlib.md5()
+    for path in sorted(paths):
+        parameter_reader = SequenceFile.Reader(path)
+        digest.update(parameter_reader.getSync() or '')
+        parameter_reader.close()
+        digest.update('%d,' % os.path.getsize(path))
+    digest.update('%s,%s' % (','.join(sorted(names)), numpy.dtype(dtype).name))
+    return digest.hexdigest()
+
+
+def remove_stale_caches(cache_dir, ttl, keep=None):
+    '''
+    Remove caches of parameters in cache_dir not used for ttl seconds
+    Tasks which still map them keep their pages until they exit
+    keep - cache path which is never removed
+    '''
+    now = time.time()
+    for filename in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, filename)
+        if not filename.startswith(SHARED_CACHE_PREFIX) or \
+                (keep is not None and path in (keep, keep + '.lock')):
+            continue
+        try:
+            if os.path.getmtime(path) >= now - ttl:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            # removed by another task
+            pass
+
+
+def read_shared_parameters(paths, topic_num, word_num, names, dtype='float64', cache_dir='/dev/shm', ttl=3600):
+    '''
+    Read parameters through a node-local cache of decoded arrays
+    The first task publishes the parameters as .npy files in a directory of cache_dir,
+    the other tasks with the same parameter files memory-map them read-only.
+    Sharded parameters are published as one array of dtype, returned as ColumnShards of one shard.
+    Caches not used for ttl seconds are removed when a new one is published.
+    Without cache_dir, parameters are read as read_parameters does.
+    '''
+    if not os.path.isdir(cache_dir):
+        return read_parameters(paths, topic_num, word_num, names, dtype)
+
+    cache_path = os.path.join(cache_dir, SHARED_CACHE_PREFIX + parameter_files_key(paths, names, dtype))
+    # one task of the node decodes, the others wait for it
+    lock_file = open(cache_path + '.lock', 'a')
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    try:
+        os.utime(cache_path + '.lock', None)
+        if os.path.isdir(cache_path):
+            os.utime(cache_path, None)
+        else:
+            parameters = read_parameters(paths, topic_num, word_num, names, dtype)
+            temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            os.mkdir(temp_path)
+            for (name, value) in parameters.iteritems():
+                if isinstance(value, WordMajorShards):
+                    # kept word by word
+                    value = numpy.asarray(numpy.vstack([rows for (lo, rows) in value.shards()]), dtype=dtype)
+                    name = name + '.by_word'
+                elif isinstance(value, ColumnShards):
+                    value = numpy.asarray(value.columns(0, value.shape[1]), dtype=dtype)
+                numpy.save(os.path.join(temp_path, name + '.npy'), value)
+            # published at once, a crash never leaves a partial cache
+            try:
+                os.rename(temp_path, cache_path)
+            except OSError:
+                # published by a task holding a lock file removed as stale
+                shutil.rmtree(temp_path)
+                if not os.path.isdir(cache_path):
+                    raise
+            remove_stale_caches(cache_dir, ttl, cache_path)
+
+        # mapped under the lock, so the cache is not removed before
+        parameters = dict()
+        for name in names:
+            word_major_path = os.path.join(cache_path, name + '.by_word.npy')
+            if os.path.exists(word_major_path):
+                value = WordMajorShards(parameter_shape(name, topic_num, word_num),
+                        [(0, numpy.load(word_major_path, mmap_mode='r'))])
+            else:
+                value = numpy.load(os.path.join(cache_path, name + '.npy'), mmap_mode='r')
+                if name in SHARDED_PARAMETERS:
+                    value = ColumnShards(parameter_shape(name, topic_num, word_num), [(0, value)])
+            parameters[name] = value
+    finally:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+    return parameters
+
+
+def _record_length(key_instance, value_length):
+    '''
+    Return length of a SequenceFile record
+    '''
+    key_buffer = DataOutputBuffer()
+    key_instance.write(key_buffer)
+    # record length, key length, key, typed bytes header, payload
+    return 4 + 4 + key_buffer.getSize() + TYPEDBYTES_HEADER.size + value_length
+
+
+def write_parameters(path, parameters):
+    '''
+    Write parameters into SequenceFile
+    Each payload is aligned to ALIGNMENT bytes, so it can be memory-mapped
+
+    parameters - [(key, array), ...]
+    '''
+    metadata = SequenceFile.Metadata()
+    for (key, value) in parameters:
+        metadata.set(key + '.dtype', str(value.dtype))
+        metadata.set(key + '.shape', ','.join([str(x) for x in value.shape]))
+
+    writer = SequenceFile.createWriter(path, TypedBytesWritable, TypedBytesWritable, metadata)
+
+    for (key, value) in parameters:
+        output_key = TypedBytesWritable()
+        output_key.set(key)
+
+        # padding record, so that the payload starts at aligned position
+        # no sync marker is written between sync() and the next two records
+        writer.sync()
+        padding_key = TypedBytesWritable()
+        padding_key.set(PADDING_KEY)
+        payload_position = writer.getLength() + _record_length(padding_key, 0) + \
+                _record_length(output_key, 0)
+        padding_value = TypedBytesWritable()
+        padding_value.set('\0' * ((-payload_position) % ALIGNMENT))
+        writer.append(padding_key, padding_value)
+
+        output_value = TypedBytesWritable()
+        output_value.set(numpy.ascontiguousarray(value).tostring())
+        writer.append(output_key, output_value)
+
+    writer.close()
@@ -0,0 +1,194 @@
+#!/usr/bin/python26
+
+'''
+Distributed Online Learning for Topic Models
+JinYeong Bak, Dongwoo Kim, Alice Oh
+http://uilab.kaist.ac.kr/research/DoLDA
+
+Parser of documents in text, doc_id word_freq_all word_id:word_freq word_id:word_freq ...
+A chunk of lines is checked and parsed at once with numpy into flat arrays of word ids and counts,
+instead of splitting each line into lists of Python ints.
+Malformed lines are reported by their index in the chunk, they are never parsed partially.
+Word ids and counts must fit in int32, the integer type of the binary corpus.
+'''
+
+import sys
+import numpy
+
+# characters of the words part
+NEWLINE = ord('\n')
+COLON = ord(':')
+ZERO = ord('0')
+NINE = ord('9')
+WHITESPACES = [ord(x) for x in ' \t\r\n']
+
+# largest word id or count, larger numbers are clamped by numpy.fromstring or wrap in int32
+MAX_NUMBER = numpy.iinfo(numpy.int32).max
+
+
+class ParsedChunk(object):
+    '''
+    Documents parsed from a chunk of lines
+
+    doc_ids - doc_id of each document
+    ids - word ids of all documents
+    cts - word counts of all documents
+    doc_offsets - words of document d are ids[doc_offsets[d]:doc_offsets[d+1]]
+    line_indices - index of the line of each document in the chunk
+    malformed - indices of malformed lines in the chunk
+    '''
+    def __init__(self, doc_ids, ids, cts, doc_offsets, line_indices, malformed):
+        self.doc_ids = doc_ids
+        self.ids = ids
+        self.cts = cts
+        self.doc_offsets = doc_offsets
+        self.line_indices = line_indices
+        self.malformed = malformed
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def document(self, d):
+        '''
+        Return (doc_id, ids, cts) of document d
+        '''
+        (start, end) = (self.doc_offsets[d], self.doc_offsets[d + 1])
+        return (self.doc_ids[d], self.ids[start:end], self.cts[start:end])
+
+    def documents(self):
+        '''
+        Generate (doc_id, ids, cts) of each document
+        '''
+        for d in range(0, len(self.doc_ids)):
+            yield self.document(d)
+
+    def token_counts(self):
+        '''
+        Return sum of word counts of each document
+        '''
+        sums = numpy.zeros(len(self.doc_ids), dtype=numpy.int64)
+        word_nums = numpy.diff(self.doc_offsets)
+        non_empty = numpy.flatnonzero(word_nums > 0)
+        if len(non_empty) > 0:
+            sums[non_empty] = numpy.add.reduceat(self.cts, self.doc_offsets[non_empty])
+        return sums
+
+
+def count_per_line(line_of_char, mask, line_num):
+    '''
+    Return number of masked characters of each line
+    '''
+    # line_num is appended, so the result has at least line_num elements
+    return numpy.bincount(numpy.concatenate((line_of_char[mask], [line_num])))[:line_num]
+
+
+def check_words(bodies):
+    '''
+    Check words parts of lines, each word must be digits:digits
+    Return (mask of malformed lines, number of words of each line)
+    bodies - words parts of lines, without newline
+    '''
+    # spaces around the chunk, so every colon and word has a neighbor
+    chars = numpy.fromstring(' ' + '\n'.join(bodies) + ' ', dtype=numpy.uint8)
+    line_of_char = numpy.cumsum(chars == NEWLINE)
+
+    is_colon = chars == COLON
+    is_digit = (chars >= ZERO) & (chars <= NINE)
+    is_space = numpy.zeros(len(chars), dtype=bool)
+    for whitespace in WHITESPACES:
+        is_space |= chars == whitespace
+
+    # unknown characters, and colons without digits on both sides
+    is_bad = ~(is_colon | is_digit | is_space)
+    colons = numpy.flatnonzero(is_colon)
+    is_bad[colons[~(is_digit[colons - 1] & is_digit[colons + 1])]] = True
+
+    # every word has exactly one colon
+    is_word_start = numpy.zeros(len(chars), dtype=bool)
+    is_word_start[1:] = ~is_space[1:] & is_space[:-1]
+
+    line_num = len(bodies)
+    bad_nums = count_per_line(line_of_char, is_bad, line_num)
+    colon_nums = count_per_line(line_of_char, is_colon, line_num)
+    word_nums = count_per_line(line_of_char, is_word_start, line_num)
+    return ((bad_nums > 0) | (colon_nums != word_nums), word_nums)
+
+
+def parse_lines(lines, word_num=None):
+    '''
+    Parse a chunk of document lines
+    Return ParsedChunk
+
+    word_num - word ids must be less than word_num, None for no limit
+    Lines with numbers larger than MAX_NUMBER are malformed
+    '''
+    doc_ids = []
+    bodies = []
+    line_indices = []
+    malformed = []
+    for (idx, line) in enumerate(lines):
+        # doc_id word_freq_all words
+        fields = line.split(None, 2)
+        if len(fields) < 2 or not fields[1].isdigit():
+            malformed.append(idx)
+            continue
+        doc_ids.append(fields[0])
+        line_indices.append(idx)
+        if len(fields) > 2:
+            bodies.append(fields[2].rstrip())
+        else:
+            bodies.append('')
+
+    pair_nums = numpy.zeros(0, dtype=numpy.int64)
+    if bodies:
+        (is_malformed, pair_nums) = check_words(bodies)
+        if numpy.any(is_malformed):
+            malformed.extend([line_indices[d] for d in numpy.flatnonzero(is_malformed)])
+            good = numpy.flatnonzero(~is_malformed)
+            doc_ids = [doc_ids[d] for d in good]
+            bodies = [bodies[d] for d in good]
+            line_indices = [line_indices[d] for d in good]
+            pair_nums = pair_nums[good]
+
+    # all numbers of the chunk at once
+    numbers = numpy.fromstring(' '.join(bodies).replace(':', ' '), dtype=numpy.int64, sep=' ')
+    if len(numbers) != 2 * numpy.sum(pair_nums):
+        raise ValueError('Parsed %d numbers, expected %d' % (len(numbers), 2 * numpy.sum(pair_nums)))
+    ids = numbers[0::2]
+    cts = numbers[1::2]
+    doc_offsets = numpy.zeros(len(bodies) + 1, dtype=numpy.int64)
+    doc_offsets[1:] = numpy.cumsum(pair_nums)
+
+    is_bad_pair = (ids > MAX_NUMBER) | (cts > MAX_NUMBER)
+    if word_num is not None:
+        is_bad_pair |= ids >= word_num
+    if numpy.any(is_bad_pair):
+        # documents with unknown words or too large numbers
+        pair_docs = numpy.repeat(numpy.arange(len(bodies)), pair_nums)
+        is_malformed = numpy.zeros(len(bodies), dtype=bool)
+        is_malformed[pair_docs[is_bad_pair]] = True
+        malformed.extend([line_indices[d] for d in numpy.flatnonzero(is_malformed)])
+        good = numpy.flatnonzero(~is_malformed)
+        ids = ids[~is_malformed[pair_docs]]
+        cts = cts[~is_malformed[pair_docs]]
+        doc_ids = [doc_ids[d] for d in good]
+        line_indices = [line_indices[d] for d in good]
+        doc_offsets = numpy.zeros(len(good) + 1, dtype=numpy.int64)
+        doc_offsets[1:] = numpy.cumsum(pair_nums[good])
+
+    return ParsedChunk(doc_ids, ids, cts, doc_offsets,
+            numpy.array(line_indices, dtype=numpy.int64), numpy.array(sorted(malformed), dtype=numpy.int64))
+
+
+def report_malformed(lines, malformed, counter=True, limit=10):
+    '''
+    Report malformed lines to stderr
+    counter - also increase Hadoop streaming counter DoLDA.malformed_lines
+    limit - number of lines written
+    '''
+    if 0 == len(malformed):
+        return
+    for idx in malformed[:limit]:
+        sys.stderr.write('Malformed line: %s\n' % lines[idx].rstrip()[:200])
+    if counter:
+        sys.stderr.write('reporter:counter:DoLDA,malformed_lines,%d\n' % len(malformed))
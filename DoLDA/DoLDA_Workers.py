@@ -0,0 +1,278 @@
+#!/usr/bin/python26
+
+'''
+Distributed Online Learning for Topic Models
+JinYeong Bak, Dongwoo Kim, Alice Oh
+http://uilab.kaist.ac.kr/research/DoLDA
+
+Long-lived workers for the E step of DoLDA_MR.py.
+Worker processes start once, load their shard of the corpus into memory and keep psi(lambda).
+For each minibatch the driver sends each worker its documents,
+then only the columns of psi(lambda) of their words with alpha and row sums of lambda.
+Workers return sufficient statistics of those columns, and the driver does the M step with OnlineLDA.
+Driver and workers talk over sockets of multiprocessing.connection,
+workers are started on this machine, or by hand on other machines with
+python DoLDA_Workers.py worker host port
+and the same DOLDA_AUTHKEY environment variable as the driver.
+'''
+
+import os
+import sys
+import optparse
+import subprocess
+import traceback
+import binascii
+import numpy
+from multiprocessing.connection import Listener, Client
+
+import DoLDA_MR
+import DoLDA_Params
+import DoLDA_Parser
+import DoLDA_Corpus
+import DoLDA_Local
+import DoLDA_Online
+
+
+def authkey():
+    '''
+    Return authentication key of driver and workers, from DOLDA_AUTHKEY or a new random one
+    '''
+    if not os.environ.get('DOLDA_AUTHKEY'):
+        os.environ['DOLDA_AUTHKEY'] = binascii.hexlify(os.urandom(16))
+    return os.environ['DOLDA_AUTHKEY']
+
+
+class Worker(object):
+    '''
+    E step of documents in one shard of the corpus
+    Documents of line index worker_idx, worker_idx + worker_num, ... are in the shard,
+    or documents of line index in ordinals when it is given
+    '''
+    def __init__(self, document_file_path, word_num, topic_num, dtype, worker_idx, worker_num, ordinals=None):
+        self._word_num = word_num
+        self._topic_num = topic_num
+        self._dtype = numpy.dtype(dtype)
+        self._worker_idx = worker_idx
+        # only the columns of words in the current minibatch are up to date
+        self._psi_lambda = numpy.zeros((topic_num, word_num), dtype=self._dtype)
+
+        self._docs = dict()
+        for (first_line, lines) in DoLDA_Corpus.read_chunks(document_file_path):
+            chunk = DoLDA_Parser.parse_lines(lines, word_num)
+            for d in range(0, len(chunk)):
+                ordinal = first_line + int(chunk.line_indices[d])
+                if (ordinals is None and worker_idx == ordinal % worker_num) or \
+                        (ordinals is not None and ordinal in ordinals):
+                    (doc_id, ids, cts) = chunk.document(d)
+                    self._docs[ordinal] = (ids, cts)
+        self._ordinals = []
+
+    def document_num(self):
+        return len(self._docs)
+
+    def assign(self, ordinals):
+        '''
+        Documents of the next E step, in order of ordinals as a map task reads them
+        Return word ids of the documents
+        '''
+        self._ordinals = sorted(ordinals)
+        if not self._ordinals:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate([self._docs[ordinal][0] for ordinal in self._ordinals]))
+
+    def e_step(self, params, alpha, lambda_sum, word_ids, psi_lambda_columns):
+        '''
+        E step of assigned documents with new columns of psi(lambda)
+        Return (word ids, sstats of the word ids, Elogtheta, score, sum_cts, bound_doc_num)
+        '''
+        self._psi_lambda[:, word_ids] = psi_lambda_columns
+        parameters = {'new_alpha': alpha, 'new_lambda_sum': lambda_sum,
+                'new_psi_lambda': DoLDA_Params.ColumnShards(self._psi_lambda.shape, [(0, self._psi_lambda)])}
+        # each worker samples its own documents for the bound, like a map task
+        mapper = DoLDA_Local.job_class(DoLDA_MR.Mapper, dict(params, task_partition=str(self._worker_idx)))(parameters)
+
+        ids_list = [self._docs[ordinal][0] for ordinal in self._ordinals]
+        cts_list = [self._docs[ordinal][1] for ordinal in self._ordinals]
+        if not ids_list:
+            return (word_ids, numpy.zeros((self._topic_num, 0)), numpy.zeros((0, self._topic_num)), 0., 0, 0)
+        (gamma, sstats_list, Elogtheta) = mapper.infer(ids_list, cts_list)
+        mapper.close_threads()
+
+        sstats = numpy.zeros((self._topic_num, len(word_ids)))
+        score = 0.
+        sum_cts = 0
+        bound_doc_num = 0
+        for d in range(0, len(ids_list)):
+            sstats[:, numpy.searchsorted(word_ids, ids_list[d])] += sstats_list[d].astype(self._dtype)
+            if mapper.sample_bound():
+                score += mapper.bound_score(ids_list[d], cts_list[d], gamma[d], Elogtheta[d])
+                sum_cts += int(numpy.sum(cts_list[d]))
+                bound_doc_num += 1
+        return (word_ids, sstats, Elogtheta, score, sum_cts, bound_doc_num)
+
+
+def run_worker(address):
+    '''
+    Serve requests of the driver at address until it says stop
+    Requests are (name, arguments...), replies are ('ok', result) or ('error', traceback)
+    '''
+    connection = Client(address, authkey=authkey())
+    worker = None
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if 'stop' == request[0]:
+            break
+        try:
+            if 'load' == request[0]:
+                worker = Worker(*request[1:])
+                result = worker.document_num()
+            elif 'assign' == request[0]:
+                result = worker.assign(*request[1:])
+            elif 'e_step' == request[0]:
+                result = worker.e_step(*request[1:])
+            else:
+                raise ValueError('Unknown request %s' % request[0])
+            connection.send(('ok', result))
+        except Exception:
+            connection.send(('error', traceback.format_exc()))
+    connection.close()
+
+
+class WorkerPool(object):
+    '''
+    Driver side of long-lived workers
+    '''
+    def __init__(self, document_file_path, word_num, topic_num, dtype, worker_num,
+                 address=('localhost', 0), external_num=0):
+        '''
+        worker_num - number of workers started on this machine
+        address - (host, port) the driver listens on, port 0 for any free port
+        external_num - number of workers started by hand, they connect to address
+        '''
+        self._word_num = word_num
+        self._topic_num = topic_num
+        self._listener = Listener(address, authkey=authkey())
+        (host, port) = self._listener.address[:2]
+        sys.stderr.write('Workers connect to %s %d\n' % (host, port))
+
+        self._processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', host, str(port)])
+                for worker_idx in range(0, worker_num)]
+        self._connections = [self._listener.accept() for worker_idx in range(0, worker_num + external_num)]
+
+        # documents are sharded by line index
+        worker_num = len(self._connections)
+        self._worker_num = worker_num
+        document_nums = self._request([('load', os.path.abspath(document_file_path), word_num, topic_num, dtype,
+                worker_idx, worker_num) for worker_idx in range(0, worker_num)])
+        sys.stderr.write('%d documents are loaded in %d workers\n' % (sum(document_nums), worker_num))
+
+    def _request(self, requests):
+        '''
+        Send one request to each worker and return their results
+        Workers run requests at the same time
+        '''
+        for (connection, request) in zip(self._connections, requests):
+            connection.send(request)
+        results = []
+        for (worker_idx, connection) in enumerate(self._connections):
+            (status, result) = connection.recv()
+            if 'error' == status:
+                raise RuntimeError('Worker %d failed\n%s' % (worker_idx, result))
+            results.append(result)
+        return results
+
+    def e_step(self, params, parameters, doc_indices):
+        '''
+        E step of documents doc_indices on workers
+        Return (sstats, Elogtheta, score, sum_cts, bound_doc_num, word_ids) for OnlineLDA.update,
+        sstats only of word_ids of the documents
+
+        params - job parameters of DoLDA_MR.py
+        parameters - {name: value} of new_alpha, new_psi_lambda and new_lambda_sum
+        '''
+        doc_indices = numpy.asarray(doc_indices, dtype=numpy.int64)
+        word_ids_list = self._request([('assign', doc_indices[doc_indices % self._worker_num == worker_idx].tolist())
+                for worker_idx in range(0, self._worker_num)])
+
+        results = self._request([('e_step', params, parameters['new_alpha'], parameters['new_lambda_sum'],
+                word_ids, parameters['new_psi_lambda'].take(word_ids)) for word_ids in word_ids_list])
+
+        word_ids = numpy.unique(numpy.concatenate(word_ids_list))
+        sstats = numpy.zeros((self._topic_num, len(word_ids)))
+        for (worker_word_ids, worker_sstats, Elogtheta, score, sum_cts, bound_doc_num) in results:
+            sstats[:, numpy.searchsorted(word_ids, worker_word_ids)] += worker_sstats
+        Elogtheta = numpy.vstack([result[2] for result in results])
+        return (sstats, Elogtheta, sum([result[3] for result in results]),
+                sum([result[4] for result in results]), sum([result[5] for result in results]), word_ids)
+
+    def partial_fit(self, olda, doc_indices):
+        '''
+        Update OnlineLDA olda with one minibatch of documents doc_indices
+        Return perplexity, None when the bound is not computed
+        '''
+        stats = self.e_step(olda.job_params(len(doc_indices)), olda.job_parameters(), doc_indices)
+        return olda.update(len(doc_indices), *stats)
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(('stop',))
+            connection.close()
+        for process in self._processes:
+            process.wait()
+        self._listener.close()
+
+
+# main function start
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and 'worker' == sys.argv[1]:
+        if len(sys.argv) < 4:
+            sys.exit('Usage: %s worker host port' % sys.argv[0])
+        run_worker((sys.argv[2], int(sys.argv[3])))
+        sys.exit(0)
+
+    option_parser = optparse.OptionParser(usage='%prog [options] word_file_path document_file_path topic_num minibatch_size tau0 kappa worker_num [output_parameter_file]')
+    option_parser.add_option('--dtype', default='float64',
+            help='floating point type of lambda, gamma and sstats: float64 or float32 [default: %default]')
+    option_parser.add_option('--order', default='sequential', choices=DoLDA_Corpus.MinibatchSampler.ORDERS,
+            help='order of documents: sequential, shuffle or stratified by document length [default: %default]')
+    option_parser.add_option('--seed', type='int', default=100000001,
+            help='random seed of document order [default: %default]')
+    option_parser.add_option('--param', action='append', default=[], metavar='NAME=VALUE',
+            help='additional job parameter of DoLDA_MR.py, can be repeated')
+    option_parser.add_option('--address', default='localhost:0', metavar='HOST:PORT',
+            help='address workers connect to [default: %default]')
+    option_parser.add_option('--external', type='int', default=0,
+            help='number of workers started by hand on other machines [default: %default]')
+    (options, args) = option_parser.parse_args()
+    if len(args) < 7:
+        option_parser.error('7 arguments are needed')
+
+    word_file_path = args[0]
+    document_file_path = args[1]
+    topic_num = int(args[2])
+    minibatch_size = int(args[3])
+    tau0 = float(args[4])
+    kappa = float(args[5])
+    worker_num = int(args[6])
+
+    manifest = DoLDA_Corpus.load_manifest(document_file_path, word_file_path)
+    sampler = DoLDA_Corpus.MinibatchSampler(manifest, minibatch_size, options.order, options.seed)
+    job_params = dict([param.split('=', 1) for param in options.param])
+    olda = DoLDA_Online.OnlineLDA(manifest.word_num, topic_num, manifest.document_num, tau0, kappa,
+            dtype=options.dtype, **job_params)
+
+    (host, port) = options.address.rsplit(':', 1)
+    pool = WorkerPool(document_file_path, manifest.word_num, topic_num, options.dtype, worker_num,
+            (host, int(port)), options.external)
+    try:
+        for (updatect, doc_indices) in enumerate(sampler.minibatches(0)):
+            print '%d\t%s' % (updatect, pool.partial_fit(olda, doc_indices))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+
+    if len(args) > 7:
+        olda.save(args[7])
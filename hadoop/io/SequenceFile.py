@@ -314,6 +314,9 @@ class Reader(object):
     def getMetadata(self):
         return self._metadata
 
+    def getSync(self):
+        return self._sync
+
     def isBlockCompressed(self):
         return self._block_compressed
 
@@ -367,6 +370,24 @@ class Reader(object):
             key_length = readVInt(keys_len)
             return DataInputBuffer(keys.read(key_length))
 
+    def nextKeyValuePosition(self, key):
+        # Read the next key and skip over its value.
+        # Returns (position, length) of the raw value, None at the end.
+        if self._block_compressed or self._decompress:
+            raise NotImplementedError("Value position of compressed file")
+
+        record_length = self._readRecordLength()
+        if record_length < 0:
+            return None
+
+        key_length = self._stream.readInt()
+        key.readFields(DataInputBuffer(self._stream.read(key_length)))
+
+        position = self._stream.getPos()
+        value_length = record_length - key_length
+        self._stream.seek(position + value_length)
+        return (position, value_length)
+
     def nextKey(self, key):
         buf = self.nextRawKey()
         if not buf: